@@ -1,59 +1,565 @@
 # !/usr/bin/env python
-from metastream import MetaStream
-from libutils import run_cmd
-from json import dumps, loads, load
+from metastream import MetaStream, STREAM_MAGIC, STREAM_VERSION, STREAM_HEADER, \
+    SECTION_LEN, DIGEST_LEN, JOURNAL_SUFFIX, TEMP_SUFFIX, JOURNAL_APPEND, JOURNAL_DELETE, \
+    CATALOG_FILE, STREAM_CODECS, BLOB_SUFFIX, config
+from libutils import run_argv
+from gpt import is_gpt_snapshot, gpt_restore
+from logging import debug
+from json import loads, JSONEncoder
 from json.decoder import JSONDecodeError
-from datetime import datetime
+from struct import unpack_from, calcsize, error as StructError
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing as mp
+from tempfile import mkdtemp
+from shutil import rmtree
+import binascii
 import hashlib
-import base64
-import sys
+import mmap
+import zlib
+import lzma
 import os
 
+def verify_stream_file(file_name, keys=None):
+    """Decodes and validates one stream file in a worker process
+    Returns:
+    A tuple: return code, message, decoded streams, stream roots,
+    corrupted chunks
+    """
+    recovery = BryckRecovery()
+    rc, msg = recovery.get_type(file_name, keys)
+    return rc, msg, recovery.stream, recovery.stream_roots, recovery.corrupt_chunks
+
+
 class BryckRecovery(MetaStream):
         def __init__(self):
             super().__init__()
+            self.corrupt_chunks = {}
+            # blobs appended by the replayed journals
+            self.journal_blobs = set()
+            self.stream_files = {}
+            self.stream_keys = {}
 
-        def read_streams(self, dir_location):
+        def read_streams(self, dir_location, keys=None, parallel=False,
+                         num_workers=max(1, int(0.8*mp.cpu_count()))):
+            """Decodes and validates every stream of a directory from the
+            storage backend
+            Args:
+            dir_location: backup directory, with a trailing slash
+            keys: chunk keys to be decoded and verified, None for all
+            parallel: spread decoding over a pool of num_workers processes
+            Returns:
+            A tuple: success count, error count, error files, stream types
+            """
+            try:
+                return self.backend.read_all(self, dir_location, keys, parallel, num_workers)
+            finally:
+                self.backend.close()
+
+        def read_stream_files(self, dir_location, keys=None, parallel=False,
+                              num_workers=1):
+            """Decodes and validates every stream file in a directory
+            Returns:
+            A tuple: success count, error count, error files, stream types
+            """
             err_files = []
             err_count = 0
             suc_count = 0
             types = []
-            files = os.listdir(dir_location)
-            for file in files:
-                if os.path.isfile(dir_location + file):
-                    rc, msg = self.get_type(dir_location + file)
-                    if rc:
-                        err_files.append(dir_location + file)
-                        err_count += 1
-                    else:
-                        suc_count += 1
+            files = self.list_stream_files(dir_location)
+
+            if parallel and len(files) > 1:
+                results = self.read_streams_parallel(files, keys, num_workers)
+            else:
+                results = (self.get_type(file_name, keys) for file_name in files)
+
+            for file_name, (rc, msg) in zip(files, results):
+                if rc:
+                    err_files.append(file_name)
+                    err_count += 1
+                    if rc == 2:
+                        # intact chunks of a damaged file are still usable
                         types.append(msg[0])
+                else:
+                    suc_count += 1
+                    types.append(msg[0])
+                    for stream_type in msg:
+                        self.stream_files[stream_type] = file_name
             return suc_count, err_count, err_files, types
 
-        def get_type(self, file_name):
-            f = open(file_name)
-            data_bytes = f.read()
+        def list_stream_files(self, dir_location):
+            if not self.backend.files:
+                raise ValueError(config.get('stream_backend') + self.msg['backend_files_err'])
+            files = []
+            for file in os.listdir(dir_location):
+                if file.endswith(JOURNAL_SUFFIX) or file.endswith(TEMP_SUFFIX) or \
+                        file == config.get('catalog_file', CATALOG_FILE) or \
+                        file.startswith(config.get('stream_db', 'streams.db')):
+                    continue
+                if os.path.isfile(dir_location + file):
+                    files.append(dir_location + file)
+            return files
+
+        def walk_streams(self, dir_location, keys=None, blobs=None):
+            """Decodes the stream files newest first, one at a time
+            Args:
+            blobs: as for get_type
+            Yields:
+            file name, stream type, stream
+            """
+            files = self.list_stream_files(dir_location)
+            files.sort(key=lambda file_name: os.stat(file_name).st_mtime_ns, reverse=True)
+            for file_name in files:
+                merged = self.stream
+                self.stream = {}
+                try:
+                    rc, msg = self.get_type(file_name, keys, blobs)
+                    loaded = self.stream
+                finally:
+                    self.stream = merged
+                if rc == 1:
+                    debug("Skipping corrupted stream file " + file_name)
+                    continue
+                for stream_type in msg:
+                    yield file_name, stream_type, loaded[stream_type]
+
+        def iter_streams(self, dir_location, keys=None):
+            """Yields validated (stream type, stream) pairs newest first
+            without merging them into self.stream, so a stream is freed
+            as soon as the caller drops it.
+            """
+            for file_name, stream_type, stream in self.walk_streams(dir_location, keys):
+                yield stream_type, stream
+
+        def find_latest(self, dir_location, stream_type, keys=None):
+            """Returns the newest valid stream of the given type
+            Returns:
+            A tuple: return code, stream or error message
+            """
+            for s_type, stream in self.iter_streams(dir_location, keys):
+                if s_type == stream_type:
+                    return 0, stream
+            return 1, stream_type + self.msg['Stream_err']
+
+        def read_streams_parallel(self, files, keys, num_workers):
+            """Verifies the files in worker processes and merges their
+            streams in file order, so the result matches a serial scan.
+            """
+            results = []
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                for rc, msg, stream, roots, corrupt in executor.map(
+                        verify_stream_file, files, repeat(keys)):
+                    self.stream.update(stream)
+                    self.stream_roots.update(roots)
+                    self.corrupt_chunks.update(corrupt)
+                    results.append((rc, msg))
+            return results
+
+        def read_stream_by_type(self, dir_location, stream_type, keys=None, blobs=None):
+            """Loads the latest stream of a type from the storage backend
+            Args:
+            dir_location: backup directory, with a trailing slash
+            stream_type: stream to be loaded
+            keys: chunk keys to be loaded, None for all
+            blobs: False to load the chunks without the blobs they refer to
+            Returns:
+            A tuple: return code, list of stream types or error message
+            """
+            try:
+                return self.backend.read_type(self, dir_location, stream_type, keys, blobs)
+            finally:
+                self.backend.close()
+
+        def read_latest_chunk(self, dir_location, stream_type, key):
+            """Loads the latest chunk of a type stored under key, along
+            with the blob it refers to
+            Returns:
+            A tuple: return code, chunk value or error message
+            """
+            try:
+                return self.backend.latest_chunk(self, dir_location, stream_type, key)
+            finally:
+                self.backend.close()
+
+        def read_file_by_type(self, dir_location, stream_type, keys=None, blobs=None):
+            """Loads the newest chunk of every key of stream_type. A backup
+            generation only holds the drives that changed, so the stream
+            files are decoded newest first, starting with the one the
+            catalog lists for stream_type, until every key in keys is
+            found. All of them are decoded when keys is None. The catalog
+            is updated when it is missing or stale.
+            Returns:
+            A tuple: return code, list of stream types or error message
+            """
+            files = self.list_stream_files(dir_location)
+            files.sort(key=lambda file_name: os.stat(file_name).st_mtime_ns, reverse=True)
+            entry = self.load_catalog(dir_location).get(stream_type)
+            latest = None
+            if entry and self.catalog_entry_valid(dir_location, entry):
+                latest = os.path.join(dir_location, entry['file'])
+            if latest in files:
+                files.remove(latest)
+                files.insert(0, latest)
+            else:
+                debug("Stream catalog missing or stale, scanning " + dir_location)
+            missing = set(keys) if keys is not None else None
+            blob_type = stream_type + BLOB_SUFFIX
+            for file_name in files:
+                if missing is not None and not missing:
+                    break
+                merged = self.stream
+                self.stream = {}
+                try:
+                    rc, msg = self.get_type(file_name, missing, blobs)
+                    loaded = self.stream
+                finally:
+                    self.stream = merged
+                if rc == 1:
+                    debug("Skipping corrupted stream file " + file_name)
+                    continue
+                if stream_type not in loaded:
+                    continue
+                if stream_type not in self.stream:
+                    self.stream[stream_type] = dict(loaded[stream_type], data={})
+                    if latest is None:
+                        self.update_catalog(file_name, [stream_type])
+                # the chunks of a newer generation win
+                data = self.stream[stream_type]['data']
+                found = {key: value for key, value in loaded[stream_type]['data'].items()
+                         if key not in data}
+                data.update(found)
+                if missing is not None:
+                    missing -= set(found)
+                if blob_type in loaded:
+                    used = set(value['blob'] for value in found.values()
+                               if isinstance(value, dict) and 'blob' in value)
+                    self.blob_stream(stream_type)
+                    self.stream[blob_type]['data'].update(
+                        (digest, blob) for digest, blob in loaded[blob_type]['data'].items()
+                        if blobs or digest in used)
+            if stream_type not in self.stream:
+                return 1, stream_type + self.msg['Stream_err']
+            # an older generation may hold an intact copy of a damaged chunk
+            for s_type in (stream_type, blob_type):
+                if s_type in self.corrupt_chunks:
+                    data = self.stream.get(s_type, {}).get('data', {})
+                    self.corrupt_chunks[s_type] = [key for key in self.corrupt_chunks[s_type]
+                                                   if key not in data]
+            types = [s_type for s_type in (stream_type, blob_type) if s_type in self.stream]
+            if any(self.corrupt_chunks.get(s_type) for s_type in types):
+                return 2, types
+            return 0, types
+
+        def catalog_entry_valid(self, dir_location, entry):
+            try:
+                st = os.stat(os.path.join(dir_location, entry['file']))
+                return st.st_size == entry['size'] and st.st_mtime_ns == entry['mtime']
+            except (OSError, KeyError, TypeError) as err:
+                return False
+
+        def get_type(self, file_name, keys=None, blobs=None):
+            """Decodes a stream file and replays its journal
+            Args:
+            keys: chunk keys to be decoded, None for all
+            blobs: True for all the blobs, False for none, None for
+            those the decoded chunks refer to
+            """
+            # Decode straight from the page cache; only the decoded
+            # values are copied out of the mapping.
+            with open(file_name, "rb") as f:
+                if os.fstat(f.fileno()).st_size:
+                    data_bytes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data_bytes = None
+            # a chunk replayed from the journal may refer to a blob only
+            # the stream file holds, its blobs can not be filtered by the
+            # chunks of the file
+            journal = os.path.exists(file_name + JOURNAL_SUFFIX)
+            if blobs is None and journal and keys:
+                blobs = True
+            if data_bytes is None:
+                rc, msg = self.decode_stream(b"", keys)
+            else:
+                try:
+                    rc, msg = self.decode_stream(data_bytes, keys, blobs)
+                finally:
+                    data_bytes.close()
+            if rc != 1 and journal:
+                self.replay_journal(file_name + JOURNAL_SUFFIX, keys, blobs)
+            return rc, msg
+
+        def replay_journal(self, log_name, keys=None, blobs=None):
+            """Applies the journal entries of a stream file in order.
+            Replay stops at the first torn or corrupted entry, which is
+            what a crash in the middle of an append leaves behind.
+            """
+            f = open(log_name, "rb")
+            view = memoryview(f.read())
             f.close()
-            return self.decode_stream(data_bytes)
+            offset = 0
+            applied = 0
+            while offset < len(view):
+                try:
+                    entry_len, = unpack_from(SECTION_LEN, view, offset)
+                    start = offset + calcsize(SECTION_LEN)
+                    payload = view[start:start + entry_len]
+                    digest = view[start + entry_len:start + entry_len + DIGEST_LEN]
+                    if len(payload) != entry_len or self.chunk_digest(payload) != digest:
+                        break
+                    op = bytes(payload[:1])
+                    type_len, = unpack_from(SECTION_LEN, payload, 1)
+                    pos = 1 + calcsize(SECTION_LEN)
+                    stream_type = str(payload[pos:pos + type_len], 'utf-8')
+                    pos += type_len
+                    codec_len, = unpack_from(SECTION_LEN, payload, pos)
+                    pos += calcsize(SECTION_LEN)
+                    codec = str(payload[pos:pos + codec_len], 'utf-8')
+                    record = payload[pos + codec_len:]
+                    key = self.chunk_key(record)
+                    offset = start + entry_len + DIGEST_LEN
+                    if op == JOURNAL_APPEND:
+                        self.stream_keys.setdefault(stream_type, set()).add(key)
+                        if stream_type.endswith(BLOB_SUFFIX):
+                            self.journal_blobs.add(key)
+                    elif op == JOURNAL_DELETE:
+                        self.stream_keys.get(stream_type, set()).discard(key)
+                    parent = stream_type[:-len(BLOB_SUFFIX)]
+                    if stream_type.endswith(BLOB_SUFFIX) and parent in self.stream:
+                        self.blob_stream(parent)
+                    # blobs are few and shared, only drive chunks are filtered
+                    if stream_type not in self.stream or (keys is not None and
+                            not stream_type.endswith(BLOB_SUFFIX) and key not in keys) or \
+                            (blobs is False and stream_type.endswith(BLOB_SUFFIX)):
+                        continue
+                    if op == JOURNAL_APPEND:
+                        self.stream[stream_type]['data'][key] = \
+                            self.chunk_value(record, STREAM_CODECS[codec][1])
+                    elif op == JOURNAL_DELETE:
+                        self.stream[stream_type]['data'].pop(key, None)
+                    if key in self.corrupt_chunks.get(stream_type, []):
+                        self.corrupt_chunks[stream_type].remove(key)
+                    applied += 1
+                except (StructError, UnicodeDecodeError, ValueError, KeyError,
+                        zlib.error, lzma.LZMAError) as err:
+                    break
+            if offset < len(view):
+                debug("Discarded torn journal tail of " + log_name)
+            return applied
+
+        def decode_stream(self, data_bytes, keys=None, blobs=None):
+            """Decodes a v1 or v2 stream and merges it into self.stream
+            Args:
+            data_bytes: content of the stream file
+            keys: chunk keys to be decoded and verified, None for all
+            blobs: True for all the blobs, False for none, None for those
+            the decoded chunks refer to
+            Returns:
+            A tuple: return code, list of stream types or error message
+            return code 2 means some chunks were corrupted; the intact
+            ones were merged and the bad keys recorded in corrupt_chunks
+            """
+            if data_bytes[:len(STREAM_MAGIC)] == STREAM_MAGIC:
+                return self.decode_stream_v2(data_bytes, keys, blobs)
+            return self.decode_stream_v1(data_bytes)
 
-        def decode_stream(self, data_bytes):
-            data_bytes = base64.b64decode(data_bytes)
-            ascii_stream = data_bytes.decode('ascii')
-            ascii_stream = ascii_stream.replace("'", "\"")
+        def decode_stream_v1(self, data_bytes):
             try:
-                data = loads(ascii_stream)
-                if not self.validate(list(data.keys())[0],data):
+                encoded = data_bytes
+                data_bytes = binascii.a2b_base64(encoded)
+                self.release_pages(encoded, len(encoded))
+                if b"'" in data_bytes:
+                    data_bytes = data_bytes.replace(b"'", b"\"")
+                data = loads(data_bytes.decode('ascii'))
+                del data_bytes
+                stream_type = list(data.keys())[0]
+                checksum = data[stream_type]['checksum']
+                if not self.validate(stream_type,data):
                     return 1, self.msg['file_corrupt']
+                self.stream_roots[stream_type] = checksum
                 self.stream.update(data)
                 return 0, list(data.keys())
-            except JSONDecodeError as err:
+            except (JSONDecodeError, binascii.Error, UnicodeDecodeError,
+                    IndexError, KeyError, TypeError, AttributeError) as err:
+                return 1, self.msg['file_corrupt']
+
+        def decode_stream_v2(self, data_bytes, keys=None, blobs=None):
+            view = memoryview(data_bytes)
+            data = {}
+            blob_keys = {}
+            roots = {}
+            corrupt = {}
+            try:
+                offset = len(STREAM_MAGIC)
+                version, count = unpack_from(STREAM_HEADER, view, offset)
+                offset += calcsize(STREAM_HEADER)
+                if version != STREAM_VERSION or not count:
+                    return 1, self.msg['file_corrupt']
+                for i in range(count):
+                    body_len, = unpack_from(SECTION_LEN, view, offset)
+                    offset += calcsize(SECTION_LEN)
+                    body = view[offset:offset + body_len]
+                    offset += body_len
+                    root = view[offset:offset + DIGEST_LEN]
+                    offset += DIGEST_LEN
+                    if len(body) != body_len or len(root) != DIGEST_LEN:
+                        return 1, self.msg['file_corrupt']
+                    release = None
+                    if isinstance(data_bytes, mmap.mmap):
+                        release = lambda end, start=offset - body_len - DIGEST_LEN: \
+                            self.release_pages(data_bytes, start + end)
+                    stream_type, stream, bad = self.decode_section(body, root, keys,
+                                                                   release, blob_keys, blobs)
+                    data[stream_type] = stream
+                    roots[stream_type] = root.hex()
+                    if bad:
+                        corrupt[stream_type] = bad
+                if offset != len(view):
+                    return 1, self.msg['file_corrupt']
+            except (StructError, JSONDecodeError, UnicodeDecodeError,
+                    ValueError, KeyError, zlib.error, lzma.LZMAError) as err:
                 return 1, self.msg['file_corrupt']
+            self.stream.update(data)
+            self.stream_roots.update(roots)
+            if corrupt:
+                debug("Corrupted chunks: {}".format(corrupt))
+                self.corrupt_chunks.update(corrupt)
+                return 2, list(data.keys())
+            return 0, list(data.keys())
+
+        def release_pages(self, mapping, end):
+            """Drops the already decoded part of a mapped stream file from
+            the page tables, so it does not add to the decoded copy in RSS
+            """
+            if not isinstance(mapping, mmap.mmap) or not hasattr(mmap, 'MADV_DONTNEED'):
+                return
+            end -= end % mmap.PAGESIZE
+            if end > 0:
+                mapping.madvise(mmap.MADV_DONTNEED, 0, end)
+
+        def decode_section(self, body, root, keys=None, release=None, blob_keys=None,
+                           blobs=None):
+            """Parses one v2 stream section in place
+            The stored chunk digests are trusted only when they fold up
+            to the section root. Then just the requested chunks need to be
+            hashed, and a chunk that does not match its digest is dropped
+            and reported instead of failing the whole section.
+            A blob section is filtered by the blobs the already decoded
+            chunks refer to, which blob_keys collects per blob stream,
+            unless blobs asks for all of them or none.
+            Returns:
+            A tuple: stream type, stream, list of corrupted chunk keys
+            """
+            header_len, = unpack_from(SECTION_LEN, body, 0)
+            offset = calcsize(SECTION_LEN)
+            header = body[offset:offset + header_len]
+            offset += header_len
+            chunks, = unpack_from(SECTION_LEN, body, offset)
+            offset += calcsize(SECTION_LEN)
+            records = []
+            for i in range(chunks):
+                record, digest, offset = self.read_record(body, offset)
+                records.append((record, digest, offset))
+            if offset != len(body):
+                raise ValueError("trailing bytes in section")
+
+            header_digest = self.chunk_digest(header)
+            verify = self.merkle_root([header_digest] +
+                                      [digest for record, digest, end in records]) == root
+            if not verify:
+                # Either a stored digest or the data itself is damaged,
+                # only a full rehash can tell which.
+                actual = [self.chunk_digest(record) for record, digest, end in records]
+                if self.merkle_root([header_digest] + actual) != root:
+                    raise ValueError("section checksum mismatch")
+
+            stream = loads(str(header, 'utf-8'))
+            stream_type = stream.pop('type')
+            decompress = STREAM_CODECS[stream.get('codec', 'none')][1]
+            stream['data'] = {}
+            bad = []
+            all_keys = self.stream_keys[stream_type] = set()
+            if stream_type.endswith(BLOB_SUFFIX) and blobs is not None:
+                keys = None if blobs else ()
+            elif keys is not None and stream_type.endswith(BLOB_SUFFIX):
+                keys = blob_keys.get(stream_type, ()) if blob_keys is not None else None
+            for i, (record, digest, end) in enumerate(records):
+                key = self.chunk_key(record)
+                all_keys.add(key)
+                if keys is not None and key not in keys:
+                    continue
+                if verify and self.chunk_digest(record) != digest:
+                    bad.append(key if key is not None else "#{}".format(i))
+                    continue
+                value = stream['data'][key] = self.chunk_value(record, decompress)
+                if blob_keys is not None and isinstance(value, dict) and 'blob' in value:
+                    blob_keys.setdefault(stream_type + BLOB_SUFFIX, set()).add(value['blob'])
+                if release:
+                    release(end)
+            return stream_type, stream, bad
+
+        def read_record(self, body, offset):
+            record_len, = unpack_from(SECTION_LEN, body, offset)
+            offset += calcsize(SECTION_LEN)
+            record = body[offset:offset + record_len]
+            offset += record_len
+            digest = body[offset:offset + DIGEST_LEN]
+            offset += DIGEST_LEN
+            if len(record) != record_len or len(digest) != DIGEST_LEN:
+                raise ValueError("truncated chunk")
+            return record, bytes(digest), offset
+
+        def chunk_key(self, record):
+            try:
+                key_len, = unpack_from(SECTION_LEN, record, 0)
+                pos = calcsize(SECTION_LEN)
+                if pos + key_len >= len(record):
+                    return None
+                return str(record[pos:pos + key_len], 'utf-8')
+            except (StructError, UnicodeDecodeError):
+                return None
+
+        def chunk_value(self, record, decompress=bytes):
+            key_len, = unpack_from(SECTION_LEN, record, 0)
+            pos = calcsize(SECTION_LEN) + key_len
+            tag = bytes(record[pos:pos + 1])
+            value = decompress(record[pos + 1:])
+            if tag == b's':
+                return str(value, 'utf-8')
+            if tag == b'b':
+                return bytes(value)
+            if tag == b'j':
+                return loads(str(value, 'utf-8'))
+            raise ValueError("unknown chunk tag")
+
+        def header_file(self, stream_type, drive_name):
+            """Gives a file holding the backed up header of a drive
+            Old streams store the path of a header file, newer ones a blob
+            which is written out to a temporary directory
+            Returns:
+            A tuple: return code, file name or error message, temporary
+            directory to be removed by the caller or None
+            """
+            rc, ref = self.read_chunk(stream_type, drive_name)
+            if rc:
+                return 1, ref, None
+            if not isinstance(ref, dict):
+                return 0, ref, None
+            rc, blob = self.read_blob(stream_type, ref)
+            if rc:
+                return 1, blob, None
+            tmp_dir = mkdtemp()
+            file_name = tmp_dir + "/header.bin"
+            with open(file_name, "wb") as f:
+                f.write(blob)
+            return 0, file_name, tmp_dir
 
         def validate(self,stream_type,data):
             org_checksum = data[stream_type]['checksum']
             del data[stream_type]['checksum']
             hasher = hashlib.md5()
-            hasher.update(dumps(data,sort_keys=True).encode('utf-8'))
+            # hash the canonical dump piecewise instead of building it
+            for piece in JSONEncoder(sort_keys=True).iterencode(data):
+                hasher.update(piece.encode('utf-8'))
             checksum = hasher.hexdigest()
             if checksum == org_checksum:
                 return True
@@ -64,13 +570,18 @@ class EncRecovery(BryckRecovery):
         super().__init__()
 
     def restore_header(self,stream_type,drive_name):
-        file_name = self.stream[stream_type]['data'][drive_name]
-        cmd = "sudo cryptsetup luksDump " + file_name
-        rc, msg, err = run_cmd(cmd)
+        rc, file_name, tmp_dir = self.header_file(stream_type, drive_name)
         if rc:
-            return 1, "ENC backup failed"
-        cmd = "yes | sudo cryptsetup luksHeaderRestore " + drive_name + " --header-backup-file " + file_name
-        rc, msg, err = run_cmd(cmd)
+            return 1, file_name
+        try:
+            rc, msg, err = run_argv(["sudo", "cryptsetup", "luksDump", file_name])
+            if rc:
+                return 1, "ENC backup failed"
+            rc, msg, err = run_argv(["sudo", "cryptsetup", "luksHeaderRestore", drive_name,
+                                     "--header-backup-file", file_name], input="YES\n")
+        finally:
+            if tmp_dir:
+                rmtree(tmp_dir, ignore_errors=True)
         if not rc:
             return 0, "Successfully recovered"
         return 1, "Failed to restore from recovery"
@@ -79,12 +590,39 @@ class PartRecovery(BryckRecovery):
     def __init__(self):
         super().__init__()
 
-    def restore_header(self,stream_type,drive_name):
-        file_name = self.stream[stream_type]['data'][drive_name]
-        cmd = "sudo sfdisk --force " + drive_name + " < " + file_name
-        rc, msg, err = run_cmd(cmd)
-        cmd = "sudo partprobe"
-        run_cmd(cmd)
+    def restore_header(self,stream_type,drive_name,reread=True):
+        """Restores the backed up partition table of a drive
+        Args:
+        reread: have the kernel re-read the table, callers restoring many
+        drives re-read them all at once instead
+        """
+        rc, ref = self.read_chunk(stream_type, drive_name)
+        if not rc and isinstance(ref, dict):
+            rc, blob = self.read_blob(stream_type, ref)
+            if rc:
+                return 1, blob
+            if is_gpt_snapshot(blob):
+                rc, err = gpt_restore(drive_name, blob)
+                if reread:
+                    run_argv(["sudo", "partprobe", drive_name])
+                if rc:
+                    debug(err)
+                    return 1, "Failed to restore the partition drive"
+                return 0, "Successfully recovered"
+        rc, file_name, tmp_dir = self.header_file(stream_type, drive_name)
+        if rc:
+            return 1, file_name
+        argv = ["sudo", "sfdisk", "--force"]
+        if not reread:
+            argv += ["--no-reread", "--no-tell-kernel"]
+        argv.append(drive_name)
+        try:
+            rc, msg, err = run_argv(argv, stdin_file=file_name)
+        finally:
+            if tmp_dir:
+                rmtree(tmp_dir, ignore_errors=True)
+        if reread:
+            run_argv(["sudo", "partprobe"])
         if rc:
             return 1, "Failed to restore the partition drive"
         return 0, "Successfully recovered"
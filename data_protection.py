@@ -1,5 +1,6 @@
 from logging import debug
-from libutils import run_cmd
+from libutils import run_argv, load_cache, save_cache
+from sysstate import get_snapshot, invalidate_snapshot
 
 
 def data_protection_setup(devices, raid_name, raid_level):
@@ -13,9 +14,13 @@ def data_protection_setup(devices, raid_name, raid_level):
     data_protection_reset(raid_name, devices)
     debug("Creating raid {} level {} devices: {} ".format(raid_name, raid_level,
                                                           ','.join(devices)))
-    cmd = "yes | sudo mdadm --create  " + raid_name + " --level=" + str(raid_level) + \
-          " --raid-devices=" + str(len(devices)) + " " + ' '.join(devices) + ""
-    return run_cmd(cmd)
+    # --run skips the confirmation mdadm asks for when a device holds an
+    # old file system
+    result = run_argv(["sudo", "mdadm", "--create", raid_name, "--run",
+                       "--level=" + str(raid_level),
+                       "--raid-devices=" + str(len(devices))] + list(devices))
+    invalidate_snapshot()
+    return result
 
 
 def data_protection_stop(raid_name):
@@ -30,8 +35,9 @@ def data_protection_stop(raid_name):
     if not raid_dev:
         debug("Raid "+raid_name+" not running")
         return 0, "", ""
-    cmd = "sudo mdadm --stop  " + raid_name + ""
-    return run_cmd(cmd)
+    result = run_argv(["sudo", "mdadm", "--stop", raid_name])
+    invalidate_snapshot()
+    return result
 
 
 def data_protection_start():
@@ -40,16 +46,92 @@ def data_protection_start():
     Returns:
     A tuple: return code, stderr, stdout"""
     debug("Starting raid")
-    cmd = "sudo mdadm --assemble --scan"
-    rc, err, out = run_cmd(cmd)
+    rc, err, out = run_argv(["sudo", "mdadm", "--assemble", "--scan"])
+    invalidate_snapshot()
 
     if rc:
-        cmd = "sudo mdadm --examine --scan | sudo tee /etc/mdadm/mdadm.conf"
-        return run_cmd(cmd)
+        rc, conf, err = run_argv(["sudo", "mdadm", "--examine", "--scan"])
+        if rc:
+            return rc, conf, err
+        return run_argv(["sudo", "tee", "/etc/mdadm/mdadm.conf"], input=conf)
 
     return rc,err,out
 
 
+def data_protection_identity(raid_name, devices):
+    """reads the identity of a running raid, what data_protection_assemble
+    needs to start it again without a scan.
+    Args:
+    raid_name: The name of the raid
+    devices: list of the devices of the raid, by their stable names
+    Returns:
+    A tuple: return code, identity dict or error message"""
+    rc, out, err = run_argv(["sudo", "mdadm", "--detail", "--export", raid_name])
+    if rc:
+        return rc, err
+    detail = dict(line.split("=", 1) for line in out.splitlines() if "=" in line)
+    if 'MD_UUID' not in detail:
+        return 1, "No uuid in the details of raid " + raid_name
+    return 0, {'uuid': detail['MD_UUID'], 'devices': list(devices)}
+
+
+def data_protection_assemble(raid_name, uuid, devices):
+    """assembles a raid from the given devices only, no device is scanned.
+    Args:
+    raid_name: The name of the raid
+    uuid: uuid of the raid, devices of another array are refused
+    devices: list of the devices of the raid
+    Returns:
+    A tuple: return code, stdout, stderr"""
+    if data_protection_get_dev(raid_name):
+        debug("Raid " + raid_name + " already running")
+        return 0, "", ""
+    debug("Assembling raid {} uuid {} devices: {}".format(raid_name, uuid, ','.join(devices)))
+    return run_argv(["sudo", "mdadm", "--assemble", raid_name, "--uuid=" + uuid] + list(devices))
+
+
+def data_protection_start_arrays(arrays):
+    """assembles the given raids concurrently.
+    Args:
+    arrays: raid name mapped to its data_protection_identity
+    Returns:
+    A tuple: return code, stdout, stderr of the first failure"""
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, len(arrays))) as executor:
+        results = list(executor.map(lambda name: data_protection_assemble(
+            name, arrays[name]['uuid'], arrays[name]['devices']), arrays))
+    invalidate_snapshot()
+    for rc, out, err in results:
+        if rc:
+            return rc, out, err
+    return 0, "", ""
+
+
+def load_raid_identity(cache_file, key):
+    """Loads the raid identities stored for a Bryck on this host
+    Args:
+    cache_file: raid identity cache file
+    key: serial number of the Bryck
+    Returns:
+    raid name mapped to its identity or None when none is stored
+    """
+    cache = load_cache(cache_file, "raid identity")
+    return cache.get(key) if cache is not None else None
+
+
+def save_raid_identity(cache_file, key, arrays):
+    """Stores the raid identities of a Bryck on this host, next to the
+    ones of the other Brycks. A failure only costs the next mount a scan
+    Args:
+    cache_file: raid identity cache file
+    key: serial number of the Bryck
+    arrays: raid name mapped to its identity
+    """
+    cache = load_cache(cache_file, "raid identity") or {}
+    cache[key] = arrays
+    save_cache(cache_file, "raid identity", cache)
+
+
 def data_protection_reset(raid_device, devices):
     """resets all the devices in raid.
     Args:
@@ -62,16 +144,20 @@ def data_protection_reset(raid_device, devices):
     return_code = 0
     out_msg = ""
     err_msg = ""
-    cmd="sudo mdadm --stop "+raid_device
-    run_cmd(cmd)
-    cmd = "sudo mdadm --zero-superblock " + ' '.join(devices) + ""
-    return run_cmd(cmd)
+    run_argv(["sudo", "mdadm", "--stop", raid_device])
+    invalidate_snapshot()
+    return data_protection_zero(devices)
+
+
+def data_protection_zero(devices):
+    """clears the raid superblock of the devices.
+    Args:
+    devices: list of devices that needs to be cleared.
+    Returns:
+    A tuple: return code, stdout, stderr"""
+    return run_argv(["sudo", "mdadm", "--zero-superblock"] + list(devices))
 
 
 def data_protection_get_dev(raid_name):
-    cmd = "ls -l " +raid_name
-    rc, out, err = run_cmd(cmd)
-    if rc:
-        return ""
-    dev = "/dev/"+out.split("/")[-1]
-    return dev.rstrip("\n")
+    # the raid name is a udev symlink to the md device
+    return get_snapshot().md_device(raid_name)
@@ -0,0 +1,120 @@
+# !/usr/bin/env python
+from logging import debug
+from libutils import get_config
+from sysstate import invalidate_snapshot
+from time import monotonic, sleep
+import os
+
+config = get_config()
+
+# Seconds to wait for a device node, udev may be slow on a busy host
+DEVICE_WAIT_TIMEOUT = 16
+# Polling interval when inotify is not available
+DEVICE_POLL_INTERVAL = 0.032
+
+# inotify(7) flags, udev creates nodes and renames its symlinks in place
+IN_ATTRIB = 0x00000004
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_ATTRIB | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+LIBC = None
+
+
+def inotify_open():
+    """Opens an inotify instance
+    Returns:
+    A tuple: libc and the inotify file descriptor, None when inotify is
+    not available
+    """
+    global LIBC
+    try:
+        if LIBC is None:
+            import ctypes
+            LIBC = ctypes.CDLL(None, use_errno=True)
+        fd = LIBC.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return LIBC, fd
+
+
+def watch_directory(inotify, watched, path):
+    """Watches the deepest existing directory above path, /dev/md only
+    exists once the first md device is there"""
+    libc, fd = inotify
+    directory = os.path.dirname(path)
+    while directory not in watched:
+        if os.path.isdir(directory):
+            watched.add(directory)
+            if libc.inotify_add_watch(fd, directory.encode('utf-8'), WATCH_MASK) < 0:
+                debug("Failed to watch " + directory)
+            return
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return
+        directory = parent
+
+
+def close_later(fd):
+    from threading import Thread
+    Thread(target=os.close, args=(fd,), daemon=True).start()
+
+
+def poll_devices(missing, deadline):
+    while missing and monotonic() < deadline:
+        sleep(DEVICE_POLL_INTERVAL)
+        missing = [path for path in missing if not os.path.exists(path)]
+    return missing
+
+
+def wait_for_devices(paths, timeout=None):
+    """Waits until all the device nodes exist. Returns as soon as the last
+    one is created, woken by inotify on their directories, or polls when
+    inotify is not available
+    Args:
+    paths: device nodes or their udev symlinks, md, dm-crypt and partition
+    nodes alike
+    timeout: seconds to wait, defaults to config device_wait_timeout
+    Returns:
+    A tuple: return code, stdout, stderr naming the missing nodes
+    """
+    from select import select
+    if timeout is None:
+        timeout = config.get('device_wait_timeout', DEVICE_WAIT_TIMEOUT)
+    deadline = monotonic() + timeout
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        debug("Waiting for the devices " + ','.join(missing))
+        inotify = inotify_open()
+        if inotify is None:
+            missing = poll_devices(missing, deadline)
+        else:
+            watched = set()
+            try:
+                while True:
+                    for path in missing:
+                        watch_directory(inotify, watched, path)
+                    # checked after the watches are added, nothing is missed
+                    missing = [path for path in missing if not os.path.exists(path)]
+                    remaining = deadline - monotonic()
+                    if not missing or remaining <= 0:
+                        break
+                    if select([inotify[1]], [], [], remaining)[0]:
+                        try:
+                            os.read(inotify[1], 65536)
+                        except BlockingIOError:
+                            pass
+            finally:
+                # closing an inotify instance waits for the kernel to
+                # release its watches, the caller need not
+                close_later(inotify[1])
+            # the snapshot predates the new nodes
+            invalidate_snapshot()
+    if missing:
+        return 1, "", "Devices did not appear: " + ','.join(missing)
+    return 0, "", ""
@@ -0,0 +1,571 @@
+# !/usr/bin/env python
+from metastream import MetaStream
+from bryckrecovery import BryckRecovery
+from drtest import generate_string
+from libutils import run_cmd, run_argv
+from pipeline import StepPipeline
+from partition import partition_layout, partition_map_drives, LINUX_FS_TYPE
+from metastream import PartStream
+from bryckrecovery import PartRecovery
+from gpt import gpt_snapshot, GPT_HEADER
+from devwait import wait_for_devices
+from sysstate import SystemSnapshot
+import devwait
+from nvme import nvme_sysfs_drives, nvme_list_drives, sata_sysfs_drives, sata_list_drives
+
+from json import dumps, loads
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+import random
+from tempfile import mkdtemp
+from shutil import rmtree
+import multiprocessing as mp
+import subprocess
+import metastream
+import hashlib
+import struct
+import uuid
+import zlib
+import base64
+import sys
+import os
+
+
+def encode_fresh(stream, encode, type):
+    # v1 hashes any checksum left behind by a previous encode
+    stream.stream[type].pop('checksum', None)
+    return encode(type)
+
+
+def random_string(length):
+    # same alphabet as drtest.generate_string, fast enough for large chunks
+    return base64.b32encode(os.urandom(length))[:length].decode('ascii')
+
+
+def build_stream(type, chunks, key_len, chunk_len):
+    stream = MetaStream()
+    stream.create_stream(id='1234', type=type, filename='')
+    for i in range(chunks):
+        stream.append_chunk(type, generate_string(key_len), random_string(chunk_len))
+    return stream
+
+
+def timed(func, *args, rounds=20):
+    start = perf_counter()
+    for i in range(rounds):
+        result = func(*args)
+    return (perf_counter() - start) / rounds, result
+
+
+def bench_format(chunks=100, key_len=10, chunk_len=20000):
+    """Compares encode/decode throughput of the v1 and v2 stream formats"""
+    stream = build_stream('bench', chunks, key_len, chunk_len)
+    # compare the containers alone, bench_codec covers compression
+    stream.stream['bench']['codec'] = 'none'
+    recovery = BryckRecovery()
+    print("{:<8}{:>12}{:>14}{:>14}".format("format", "size(KB)", "encode MB/s", "decode MB/s"))
+    for name, encode, decode in (("v1", stream.encode_stream_v1, recovery.decode_stream_v1),
+                                 ("v2", stream.encode_stream_v2, recovery.decode_stream_v2)):
+        enc_time, data = timed(encode_fresh, stream, encode, 'bench')
+        dec_time, result = timed(decode, data)
+        assert result[0] == 0
+        size = len(data) / (1024 * 1024)
+        print("{:<8}{:>12.1f}{:>14.1f}{:>14.1f}".format(name, len(data) / 1024,
+                                                       size / enc_time, size / dec_time))
+
+
+def bench_verify(files=64, chunks=100, key_len=10, chunk_len=20000):
+    """Times read_streams over a backup directory by worker count"""
+    dir_location = mkdtemp() + "/"
+    try:
+        for i in range(files):
+            stream = build_stream('bench%d' % i, chunks, key_len, chunk_len)
+            stream.stream['bench%d' % i]['filename'] = dir_location + 'bench%d.bin' % i
+            stream.persist('bench%d' % i)
+        start = perf_counter()
+        serial = BryckRecovery().read_streams(dir_location)
+        base = perf_counter() - start
+        print("{:<10}{:>10}{:>10}".format("workers", "time(s)", "speedup"))
+        print("{:<10}{:>10.3f}{:>10.2f}".format("serial", base, 1.0))
+        workers = 1
+        while workers <= mp.cpu_count():
+            start = perf_counter()
+            result = BryckRecovery().read_streams(dir_location, parallel=True,
+                                                  num_workers=workers)
+            elapsed = perf_counter() - start
+            assert result == serial
+            print("{:<10}{:>10.3f}{:>10.2f}".format(workers, elapsed, base / elapsed))
+            workers *= 2
+    finally:
+        rmtree(dir_location)
+
+
+def legacy_get_type(file_name):
+    """The reader as it was before the mmap based BryckRecovery.get_type"""
+    f = open(file_name, "rb")
+    data_bytes = f.read()
+    f.close()
+    if data_bytes[:len(metastream.STREAM_MAGIC)] == metastream.STREAM_MAGIC:
+        return BryckRecovery().decode_stream(data_bytes)
+    ascii_stream = base64.b64decode(data_bytes).decode('ascii').replace("'", "\"")
+    data = loads(ascii_stream)
+    stream_type = list(data.keys())[0]
+    checksum = data[stream_type].pop('checksum')
+    return hashlib.md5(dumps(data, sort_keys=True).encode('utf-8')).hexdigest() == checksum
+
+
+def peak_rss():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def rss_child(reader, file_name):
+    # the high water mark is inherited from the parent, reset it first
+    with open("/proc/self/clear_refs", "w") as refs:
+        refs.write("5")
+    base = peak_rss()
+    if reader == 'legacy':
+        legacy_get_type(file_name)
+    else:
+        BryckRecovery().get_type(file_name)
+    print(peak_rss() - base)
+
+
+def bench_rss(chunks=100, key_len=10, chunk_len=1000000):
+    """Peak RSS growth of the readers on drtest.add_streams sized streams"""
+    dir_location = mkdtemp() + "/"
+    try:
+        print("{:<8}{:>12}{:>16}{:>16}".format("format", "file(MB)", "legacy RSS(MB)",
+                                               "mmap RSS(MB)"))
+        for version in (1, 2):
+            file_name = dir_location + "v%d.bin" % version
+            metastream.config['stream_format'] = version
+            stream = build_stream('bench', chunks, key_len, chunk_len)
+            stream.stream['bench']['filename'] = file_name
+            stream.persist('bench')
+            del stream
+            rss = []
+            for reader in ('legacy', 'mmap'):
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), 'rss_child',
+                                      reader, file_name], stdout=subprocess.PIPE,
+                                     check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+                rss.append(int(out.stdout.split()[-1]) / 1024)
+            print("{:<8}{:>12.1f}{:>16.1f}{:>16.1f}".format(
+                "v%d" % version, os.path.getsize(file_name) / (1024 * 1024), *rss))
+    finally:
+        rmtree(dir_location)
+
+
+def persist_child(writer, file_name, chunks):
+    stream = build_stream('bench', int(chunks), 10, 1000000)
+    stream.stream['bench']['filename'] = file_name
+    with open("/proc/self/clear_refs", "w") as refs:
+        refs.write("5")
+    base = peak_rss()
+    if writer == 'legacy':
+        # persist as it was before the streaming writer
+        data = stream.encode_stream('bench')
+        with open(file_name, "wb") as f:
+            f.write(data)
+    else:
+        stream.persist('bench')
+    print(peak_rss() - base)
+
+
+def bench_persist(sizes=(50, 100, 200)):
+    """Peak RSS growth of persist by stream size"""
+    dir_location = mkdtemp() + "/"
+    try:
+        print("{:<8}{:>12}{:>16}{:>16}{:>16}".format("format", "stream(MB)", "legacy RSS(MB)",
+                                                     "stream RSS(MB)", "file(MB)"))
+        for version in (1, 2):
+            for chunks in sizes:
+                file_name = dir_location + "v%d.bin" % version
+                rss = []
+                for writer in ('legacy', 'stream'):
+                    env = dict(os.environ, BENCH_STREAM_FORMAT=str(version))
+                    out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                          'persist_child', writer, file_name, str(chunks)],
+                                         stdout=subprocess.PIPE, check=True, env=env,
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+                    rss.append(int(out.stdout.split()[-1]) / 1024)
+                print("{:<8}{:>12}{:>16.1f}{:>16.1f}{:>16.1f}".format(
+                    "v%d" % version, chunks, *rss, os.path.getsize(file_name) / (1024 * 1024)))
+    finally:
+        rmtree(dir_location)
+
+
+def bench_exec(rounds=200, ballast_mb=(0, 1024)):
+    """Per command overhead of run_cmd (shell) and run_argv, with this
+    process small and after growing it by ballast_mb"""
+    print("{:<12}{:<14}{:>14}".format("RSS(MB)", "engine", "per cmd(ms)"))
+    ballast = None
+    for size in ballast_mb:
+        # touched memory, so a fork would have to copy its page tables
+        ballast = bytearray(os.urandom(1024 * 1024)) * size
+        for name, func, args in (("run_cmd", run_cmd, ("true",)),
+                                 ("run_argv", run_argv, (["true"],)),
+                                 ("run_cmd", run_cmd, ("echo abc | tr a-z A-Z",)),
+                                 ("run_argv", run_argv, (["tr", "a-z", "A-Z"], "abc\n"))):
+            func(*args)
+            elapsed, result = timed(func, *args, rounds=rounds)
+            label = name + (" pipe" if len(args) > 1 or "|" in args[0] else "")
+            print("{:<12}{:<14}{:>14.3f}".format(size, label, elapsed * 1000))
+    del ballast
+
+
+def luks_header(length=16 * 1024 * 1024, keyslot=258048):
+    """A LUKS2 header backup: binary header and JSON area, one keyslot of
+    random key material, zero padding up to the 16 MiB header size"""
+    json_area = dumps({'keyslots': {'0': {'type': 'luks2', 'key_size': 64,
+                                          'area': {'offset': '32768', 'size': str(keyslot)}}},
+                       'segments': {'0': {'type': 'crypt', 'offset': '16777216'}}})
+    header = b'LUKS\xba\xbe\x00\x02' + os.urandom(504) + json_area.encode('ascii')
+    header = header.ljust(32768, b'\x00') + os.urandom(keyslot)
+    return header.ljust(length, b'\x00')
+
+
+def sfdisk_dump(drive):
+    lines = ["label: gpt", "label-id: " + random_string(36), "device: " + drive,
+             "unit: sectors", "first-lba: 34", "last-lba: 3907029134", ""]
+    for i, (start, size) in enumerate(((2048, 67108864), (67110912, 3839918223))):
+        lines.append("{}p{} : start={}, size={}, type=0FC63DAF-8483-4772-8E79-3D69D8477DE4, "
+                     "uuid={}".format(drive, i + 1, start, size, random_string(36)))
+    return "\n".join(lines) + "\n"
+
+
+def bench_codec(drives=12):
+    """Size and encode/decode time per codec for the header streams"""
+    streams = {'encryption': build_stream('encryption', 0, 0, 0),
+               'partition': build_stream('partition', 0, 0, 0)}
+    for i in range(drives):
+        drive = "/dev/nvme%dn1" % i
+        streams['encryption'].append_chunk('encryption', drive, luks_header())
+        streams['partition'].append_chunk('partition', drive, sfdisk_dump(drive))
+    recovery = BryckRecovery()
+    print("{:<12}{:<7}{:>12}{:>12}{:>12}".format("stream", "codec", "size(KB)",
+                                                  "encode(ms)", "decode(ms)"))
+    for stream_type, stream in streams.items():
+        for codec in metastream.STREAM_CODECS:
+            stream.stream[stream_type]['codec'] = codec
+            enc_time, data = timed(stream.encode_stream_v2, stream_type, rounds=3)
+            dec_time, result = timed(recovery.decode_stream_v2, data, rounds=3)
+            assert result[0] == 0
+            print("{:<12}{:<7}{:>12.1f}{:>12.1f}{:>12.1f}".format(
+                stream_type, codec, len(data) / 1024, enc_time * 1000, dec_time * 1000))
+
+
+def dag_step(seconds):
+    sleep(seconds)
+    return 0, "", ""
+
+
+def bench_dag(drives=12, scale=0.1, seed=1):
+    """Format wall time on simulated drives: one step type after the
+    other over all drives (serial and with a barrier per step type)
+    against StepPipeline chains. Step times are in scale seconds, erase
+    times vary per drive as they do with drive size and firmware."""
+    rand = random.Random(seed)
+    steps = {drive: [("reset", 0.2), ("erase", rand.uniform(2, 8)), ("encrypt", 3),
+                     ("unlock", 3), ("partition", 0.5), ("partition", 0.5)]
+             for drive in range(drives)}
+    limits = {"encrypt": 4, "unlock": 4}
+
+    def serial():
+        for index in range(len(steps[0])):
+            for drive in steps:
+                dag_step(steps[drive][index][1] * scale)
+
+    def barrier():
+        for index in range(len(steps[0])):
+            step = steps[0][index][0]
+            with ThreadPoolExecutor(max_workers=limits.get(step) or drives) as executor:
+                list(executor.map(lambda drive: dag_step(steps[drive][index][1] * scale), steps))
+
+    def pipeline():
+        StepPipeline(limits).run({drive: [(step, dag_step, (seconds * scale,))
+                                          for step, seconds in chain]
+                                  for drive, chain in steps.items()})
+
+    print("{:<12}{:>12}".format("engine", "wall(s)"))
+    for name, func in (("serial", serial), ("barrier", barrier), ("pipeline", pipeline)):
+        elapsed, result = timed(func, rounds=1)
+        print("{:<12}{:>12.2f}".format(name, elapsed))
+
+
+def fake_sysfs(root, drives):
+    """sysfs tree of drives NVME namespaces and their multipath paths"""
+    for i in range(drives):
+        ctrl = os.path.join(root, "class", "nvme", "nvme%d" % i)
+        os.makedirs(ctrl)
+        for attr, value in (("model", "Linux" + " " * 35), ("serial", "%020x" % i),
+                            ("firmware_rev", "5.10    ")):
+            with open(os.path.join(ctrl, attr), "w") as f:
+                f.write(value + "\n")
+        for name in ("nvme%dn1" % i, "nvme%dc%dn1" % (i, i)):
+            block = os.path.join(root, "block", name)
+            os.makedirs(block)
+            os.symlink(ctrl, os.path.join(block, "device"))
+            with open(os.path.join(block, "size"), "w") as f:
+                f.write("7814037168\n")
+
+
+def bench_enum(drives=64, rounds=20):
+    """Drive enumeration from sysfs against nvme list and lsblk"""
+    root = mkdtemp()
+    try:
+        fake_sysfs(root, drives)
+        rc, found = nvme_sysfs_drives(root)
+        assert rc == 0 and len(found) == drives, found
+        print("{:<28}{:>10}{:>12}".format("enumerator", "drives", "time(ms)"))
+        for name, func, args in (("sysfs nvme (fake tree)", nvme_sysfs_drives, (root,)),
+                                 ("sysfs nvme", nvme_sysfs_drives, ()),
+                                 ("nvme list", nvme_list_drives, ()),
+                                 ("sysfs sata", sata_sysfs_drives, ()),
+                                 ("lsblk", sata_list_drives, ())):
+            elapsed, (rc, out) = timed(func, *args, rounds=rounds)
+            count = len(out) if not rc else "failed"
+            print("{:<28}{:>10}{:>12.3f}".format(name, count, elapsed * 1000))
+    finally:
+        rmtree(root)
+
+
+def gpt_image(file_name, size, sector_size=512):
+    """Sparse drive image with the Bryck GPT layout"""
+    sectors = size // sector_size
+    entries = bytearray(128 * 128)
+    for i, (start, count) in enumerate(partition_layout(size, sector_size, 32)):
+        struct.pack_into("<16s16sQQQ72s", entries, i * 128, uuid.UUID(LINUX_FS_TYPE).bytes_le,
+                         os.urandom(16), start, start + count - 1, 0, "primary".encode('utf-16-le'))
+    entries_lba = 128 * 128 // sector_size
+    guid = os.urandom(16)
+
+    def header(my_lba, alternate_lba, table_lba):
+        data = bytearray(struct.pack(GPT_HEADER, b"EFI PART", 0x10000, 92, 0, 0, my_lba, alternate_lba,
+                                     2 + entries_lba, sectors - 2 - entries_lba, guid, table_lba,
+                                     128, 128, zlib.crc32(entries)))
+        data[16:20] = struct.pack("<I", zlib.crc32(data))
+        return bytes(data).ljust(sector_size, b"\0")
+    with open(file_name, "wb") as f:
+        f.truncate(size)
+        f.seek(510)
+        f.write(b"\x55\xaa")
+        for lba, data in ((1, header(1, sectors - 1, 2)), (2, entries),
+                          (sectors - 1 - entries_lba, entries),
+                          (sectors - 1, header(sectors - 1, 1, sectors - 1 - entries_lba))):
+            f.seek(lba * sector_size)
+            f.write(data)
+
+
+def bench_gpt(drives=12, size=4 * 1000 ** 4):
+    """Concurrent raw GPT snapshot and restore of drive images, through
+    the partition stream as partition_backup and partition_recovery do"""
+    root = mkdtemp() + "/"
+    try:
+        images = [root + "nvme%dn1" % i for i in range(drives)]
+        for image in images:
+            gpt_image(image, size)
+        start = perf_counter()
+        tables = partition_map_drives(gpt_snapshot, images, 512)
+        stream = PartStream('1234', 'partition', filename=root + "pstream.bin")
+        for image, (rc, table) in zip(images, tables):
+            assert rc == 0, table
+            stream.backup_header(image, table)
+        stream.persist('partition')
+        backup = perf_counter() - start
+        for image in images:
+            # wipe the primary header and the backup entries
+            with open(image, "r+b") as f:
+                f.seek(512)
+                f.write(b"\0" * 512)
+                f.seek(size - 33 * 512)
+                f.write(b"\0" * 512)
+        assert all(gpt_snapshot(image, 512)[0] for image in images)
+        start = perf_counter()
+        recovery = PartRecovery()
+        recovery.read_stream_by_type(root, 'partition', images)
+        results = partition_map_drives(
+            lambda image: recovery.restore_header('partition', image, reread=False), images)
+        restore = perf_counter() - start
+        assert all(rc == 0 for rc, msg in results), results
+        assert partition_map_drives(gpt_snapshot, images, 512) == tables
+        print("{} drives: backup {:.1f}ms, restore {:.1f}ms".format(drives, backup * 1000,
+                                                                   restore * 1000))
+    finally:
+        rmtree(root)
+
+
+def fake_cryptsetup(latency, header_size=16 * 1024 * 1024):
+    """run_argv standing in for cryptsetup on drive images, each call
+    takes latency seconds"""
+    def run(argv, input=None, stdin_file=None, stdout_file=None, timeout=None):
+        sleep(latency)
+        if "luksHeaderBackup" in argv:
+            with open(argv[argv.index("luksHeaderBackup") + 1], "rb") as drive:
+                with open(argv[argv.index("--header-backup-file") + 1], "wb") as f:
+                    f.write(drive.read(header_size))
+        return 0, "", ""
+    return run
+
+
+def bench_luks(drives=12, latency=0.2, limits=(1, 4, 8)):
+    """encrypt_backup and encrypt_recovery wall time with cryptsetup calls
+    of latency seconds, per header_parallel_limit, then a backup of
+    unchanged drives and one with a single changed header"""
+    import encryption
+    import bryckrecovery
+    saved = encryption.run_argv, bryckrecovery.run_argv, encryption.encrypt_unlock_drives
+    encryption.run_argv = bryckrecovery.run_argv = fake_cryptsetup(latency)
+    encryption.encrypt_unlock_drives = lambda drives, key_file: (0, "", "", [])
+    root = mkdtemp() + "/"
+    names = [root + "nvme%dn1" % i for i in range(drives)]
+    print("{:<8}{:>12}{:>12}".format("limit", "backup(s)", "restore(s)"))
+    try:
+        for limit in limits:
+            for name in names:
+                with open(name, "wb") as f:
+                    f.write(luks_header())
+            encryption.config['header_parallel_limit'] = limit
+            backup, result = timed(encryption.encrypt_backup, root, names, rounds=1)
+            assert result[0] == 0, result
+            restore, result = timed(encryption.encrypt_recovery, root, names, "key", rounds=1)
+            assert result[0] == 0, result
+            print("{:<8}{:>12.2f}{:>12.2f}".format(limit, backup, restore))
+        for label, change in (("unchanged", False), ("one changed", True)):
+            if change:
+                with open(names[0], "r+b") as f:
+                    f.write(b"LUKS\xba\xbe\x00\x02" + os.urandom(504))
+            backup, result = timed(encryption.encrypt_backup, root, names, rounds=1)
+            assert result[0] == 0, result
+            print("{:<20}{:>12.2f}  {}".format(label, backup, result[1]))
+    finally:
+        encryption.run_argv, bryckrecovery.run_argv, encryption.encrypt_unlock_drives = saved
+        rmtree(root)
+
+
+def bench_devwait(nodes=12, spread=0.2, rounds=10, seed=1):
+    """Mean latency between the creation of the last of nodes device
+    nodes, at random times within spread seconds, and the return of
+    wait_for_devices, with inotify and with polling"""
+    rng = random.Random(seed)
+    saved = devwait.inotify_open
+    print("{:<10}{:>14}".format("mode", "latency(ms)"))
+    try:
+        for mode in ("inotify", "poll"):
+            if mode == "poll":
+                devwait.inotify_open = lambda: None
+            latency = 0
+            for r in range(rounds):
+                root = mkdtemp()
+                # the nodes land in directories created on the way
+                names = [os.path.join(root, "md" if i % 2 else "mapper", "node%d" % i)
+                         for i in range(nodes)]
+                delays = [rng.uniform(0, spread) for name in names]
+                created = []
+
+                def create(name):
+                    os.makedirs(os.path.dirname(name), exist_ok=True)
+                    open(name, "w").close()
+                    created.append(perf_counter())
+                with ThreadPoolExecutor(max_workers=nodes) as executor:
+                    for name, delay in zip(names, delays):
+                        executor.submit(lambda n=name, d=delay: (sleep(d), create(n)))
+                    rc, out, err = wait_for_devices(names, timeout=spread + 5)
+                    done = perf_counter()
+                assert rc == 0, err
+                latency += done - max(created)
+                rmtree(root)
+            print("{:<10}{:>14.2f}".format(mode, latency / rounds * 1000))
+    finally:
+        devwait.inotify_open = saved
+
+
+def fake_system(root, drives, others):
+    """procfs, sysfs and /dev of a host with a mounted Bryck of drives
+    unlocked and partitioned drives and others unrelated disks"""
+    for directory in ("proc", "sys/block", "dev/md"):
+        os.makedirs(os.path.join(root, directory))
+    knames = ["sd%d" % i for i in range(others)]
+    mounts = ["sysfs /sys sysfs rw 0 0", "/dev/vda / ext4 rw 0 0"]
+    members = {"md126": [], "md127": []}
+    dm = 0
+    for i in range(drives):
+        knames.append("nvme%dn1" % i)
+        crypt = "dm-%d" % dm
+        parts = ["dm-%d" % (dm + 1), "dm-%d" % (dm + 2)]
+        for kname, name in zip([crypt] + parts, ["cryptnvme%dn1" % i + suffix
+                                                 for suffix in ("", "p1", "p2")]):
+            os.makedirs(os.path.join(root, "sys/block", kname, "dm"))
+            os.makedirs(os.path.join(root, "sys/block", kname, "holders"))
+            with open(os.path.join(root, "sys/block", kname, "dm", "name"), "w") as f:
+                f.write(name + "\n")
+            knames.append(kname)
+        for part in parts:
+            open(os.path.join(root, "sys/block", crypt, "holders", part), "w").close()
+        members["md126"].append(parts[0] + "[%d]" % i)
+        members["md127"].append(parts[1] + "[%d]" % i)
+        dm += 3
+    knames += ["md126", "md127"]
+    os.symlink("../md126", os.path.join(root, "dev/md/bryckmetadata"))
+    os.symlink("../md127", os.path.join(root, "dev/md/bryckdata"))
+    mounts += ["/dev/md126 /tmp/bryckmetadata xfs rw 0 0", "/dev/md127 /mnt/bryck xfs rw 0 0"]
+    with open(os.path.join(root, "proc", "partitions"), "w") as f:
+        f.write("major minor  #blocks  name\n\n")
+        f.writelines("   8 {:>5} 1000 {}\n".format(i, kname) for i, kname in enumerate(knames))
+    with open(os.path.join(root, "proc", "mdstat"), "w") as f:
+        f.write("Personalities : [raid1] [raid6] [raid5] [raid4]\n")
+        f.write("md126 : active raid1 " + " ".join(members["md126"]) + "\n")
+        f.write("md127 : active raid5 " + " ".join(members["md127"]) + "\n")
+    with open(os.path.join(root, "proc", "mounts"), "w") as f:
+        f.write("\n".join(mounts) + "\n")
+
+
+def bench_snapshot(drives=12, others=500, rounds=20):
+    """The probes of is_mounted, is_ejected and the partition check of
+    mount answered from one SystemSnapshot, against an ls per probe"""
+    root = mkdtemp()
+    try:
+        fake_system(root, drives, others)
+        crypts = ["/dev/mapper/cryptnvme%dn1" % i for i in range(drives)]
+        start = perf_counter()
+        for r in range(rounds):
+            snapshot = SystemSnapshot(root)
+            found = [snapshot.md_device("/dev/md/bryckdata"), snapshot.md_device("/dev/md/bryckmetadata"),
+                     snapshot.is_mounted("/dev/md127"), snapshot.is_mounted("/dev/md126")]
+            found += [snapshot.exists(crypt) and snapshot.exists(crypt + "p1") for crypt in crypts]
+            found += [len(snapshot.device_holders(crypt)) for crypt in crypts]
+        snap = (perf_counter() - start) / rounds
+        assert found[:4] == ["/dev/md127", "/dev/md126", True, True], found
+        assert all(found[4:]), found
+        # one ls per md link and per drive for the existence and the partitions
+        probes = 2 + 3 * drives
+        start = perf_counter()
+        for i in range(probes):
+            run_argv(["ls", "-l", os.path.join(root, "dev/md/bryckdata")])
+        ls = perf_counter() - start
+        print("{:<28}{:>12}".format("probes", "time(ms)"))
+        print("{:<28}{:>12.2f}".format("snapshot, {} devices".format(others + 4 * drives + 2),
+                                       snap * 1000))
+        print("{:<28}{:>12.2f}".format("{} ls commands".format(probes), ls * 1000))
+    finally:
+        rmtree(root)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['rss_child']:
+        rss_child(*sys.argv[2:4])
+        sys.exit(0)
+    if sys.argv[1:2] == ['persist_child']:
+        metastream.config['stream_format'] = int(os.environ['BENCH_STREAM_FORMAT'])
+        persist_child(*sys.argv[2:5])
+        sys.exit(0)
+    benches = {'format': bench_format, 'verify': bench_verify, 'rss': bench_rss,
+               'codec': bench_codec, 'persist': bench_persist, 'exec': bench_exec,
+               'dag': bench_dag, 'enum': bench_enum,
+               'gpt': bench_gpt, 'luks': bench_luks, 'devwait': bench_devwait,
+               'snapshot': bench_snapshot}
+    for name in sys.argv[1:] or benches.keys():
+        benches[name]()
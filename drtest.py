@@ -4,9 +4,15 @@ from metastream import MetaStream
 from bryckrecovery import BryckRecovery
 
 from datetime import datetime
+from tempfile import mkdtemp
+from shutil import rmtree
 from json import load
+import builtins
 import random
+import signal
 import string
+import time
+import sys
 import os
 
 with open("config.json") as cfg:
@@ -23,11 +29,11 @@ def generate_binary(l_range,u_range):
 def invoke_error():
     file_name = config["metadata_backup_dir"] + random.choice(os.listdir(config["metadata_backup_dir"]))
     print("Invoked error in %s file",file_name)
-    f = open(file_name,"rt")
+    f = open(file_name,"rb")
     data = f.read()
-    data = data.replace('A','Z')
+    data = data.replace(b'A',b'Z')
     f.close()
-    f = open(file_name,"wt")
+    f = open(file_name,"wb")
     f.write(data)
     f.close()
     return file_name
@@ -71,7 +77,187 @@ def data_recovery():
     #     recovery.dump_stream(list(type)[0])
     return err_files
 
+class CrashingFile:
+    """Wraps a file opened for writing and kills the process once the
+    bytes written through all the wrapped files reach the limit
+    """
+    written = 0
+    limit = None
+
+    def __init__(self,f):
+        self.f = f
+
+    def write(self,data):
+        room = CrashingFile.limit - CrashingFile.written
+        if len(data) >= room:
+            self.f.write(data[:room])
+            self.f.flush()
+            os.kill(os.getpid(), signal.SIGKILL)
+        CrashingFile.written += len(data)
+        return self.f.write(data)
+
+    def __getattr__(self,name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        return self.f.__exit__(*args)
+
+def crash_open(file,mode='r',*args,**kwargs):
+    f = builtins.real_open(file, mode, *args, **kwargs)
+    if 'w' in mode or 'a' in mode:
+        return CrashingFile(f)
+    return f
+
+def persist_generation(file_name,generation,chunks,chunk_len):
+    stream = MetaStream()
+    stream.create_stream(id='1234', type='crash', filename=file_name)
+    stream.append_chunk('crash', 'generation', str(generation))
+    for i in range(chunks):
+        stream.append_chunk('crash', generate_string(10), os.urandom(chunk_len // 2).hex())
+    return stream.persist('crash')
+
+def crash_persist(rounds=200,chunks=20,chunk_len=100000):
+    """Kills a process after a random number of written bytes while it
+    persists a new generation of a stream file and checks that the file
+    then holds either the previous or the new generation, intact
+    """
+    print("Crash injection starts")
+    dir_location = mkdtemp() + "/"
+    file_name = dir_location + "crash.bin"
+    failures = 0
+    killed = 0
+    try:
+        persist_generation(file_name, 0, chunks, chunk_len)
+        size = os.path.getsize(file_name)
+        current = 0
+        for generation in range(1, rounds + 1):
+            pid = os.fork()
+            if not pid:
+                # some limits fall past the stream file, into the catalog
+                CrashingFile.limit = random.randint(0, size + size // 10)
+                builtins.real_open = builtins.open
+                builtins.open = crash_open
+                persist_generation(file_name, generation, chunks, chunk_len)
+                os._exit(0)
+            pid, status = os.waitpid(pid, 0)
+            if os.WIFSIGNALED(status):
+                killed += 1
+            recovery = BryckRecovery()
+            rc, msg = recovery.get_type(file_name)
+            found = int(recovery.stream['crash']['data']['generation']) if not rc else None
+            if found not in (current, generation):
+                print("Generation %d: stream file unreadable or wrong: %s" % (generation, msg))
+                failures += 1
+                continue
+            current = found
+    finally:
+        rmtree(dir_location)
+    print("Killed %d of %d writers, %d unreadable generations" % (killed, rounds, failures))
+    if not killed:
+        # the writer no longer goes through crash_open, nothing was tested
+        print("No writer was killed, the crash injection did not take effect")
+        failures += 1
+    return failures
+
+def alive(pid):
+    """Whether a process exists and is not a zombie"""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+def run_timeout(timeout=1, sleep=30):
+    """Runs a shell leaving a sleep behind it under a timeout and checks
+    that run_argv killed the whole process group, the sleep included
+    """
+    from libutils import run_argv
+    print("Command timeout check starts")
+    start = time.perf_counter()
+    # the sleep holds stdout, run_argv only returns once it is gone
+    rc, out, err = run_argv(["sh", "-c", "sleep %d & echo $!; wait" % sleep], timeout=timeout)
+    elapsed = time.perf_counter() - start
+    failures = 0
+    if not rc or "timed out" not in err:
+        print("The command was not timed out: rc %d, %s" % (rc, err))
+        failures += 1
+    if elapsed >= sleep:
+        print("The sleep outlived the timeout, %.1f s" % elapsed)
+        failures += 1
+    pids = [int(pid) for pid in out.split()]
+    if not pids or alive(pids[0]):
+        print("The sleep of the timed out command is still running")
+        failures += 1
+    print("Timed out after %.1f s, %d failures" % (elapsed, failures))
+    return failures
+
+# Modules a CLI command must not load before it needs them
+LAZY_MODULES = ("asyncio", "multiprocessing", "subprocess", "sqlite3", "tempfile",
+                "metastream", "bryckrecovery", "retention", "pipeline")
+# Cumulative import time of tsulib, generous for slow machines
+IMPORT_BUDGET_US = 80000
+
+def import_time():
+    """Imports tsulib and builds a Bryck in a fresh interpreter under
+    -X importtime, checks that no subsystem module got loaded and that
+    the import stays within IMPORT_BUDGET_US
+    """
+    import subprocess
+    print("Import time check starts")
+    code = "import sys, tsulib; tsulib.Bryck(); print(' '.join(sorted(sys.modules)))"
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode:
+        print(p.stderr)
+        return 1
+    failures = 0
+    loaded = [name for name in p.stdout.split() if name.split(".")[0] in LAZY_MODULES]
+    if loaded:
+        print("Loaded at startup: " + ", ".join(loaded))
+        failures += 1
+    # import time: self [us] | cumulative | imported package
+    cumulative = [int(line.split("|")[1]) for line in p.stderr.splitlines()
+                  if line.startswith("import time:") and line.split("|")[2].strip() == "tsulib"]
+    print("tsulib imported in %d us, budget %d us" % (cumulative[0], IMPORT_BUDGET_US))
+    if cumulative[0] > IMPORT_BUDGET_US:
+        failures += 1
+    return failures
+
+def cli_import():
+    """Imports tsucli and builds its commands in a fresh interpreter,
+    checks that neither tsulib nor a subsystem module got loaded, a
+    command imports them when it runs
+    """
+    import subprocess
+    print("CLI import check starts")
+    code = "import sys, tsucli; tsucli.build_cli(); print(' '.join(sorted(sys.modules)))"
+    p = subprocess.run([sys.executable, "-c", code],
+                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if p.returncode:
+        if "No module named 'click'" in p.stderr:
+            print("click is not installed, the CLI import is not checked")
+            return 0
+        print(p.stderr)
+        return 1
+    loaded = [name for name in p.stdout.split()
+              if name.split(".")[0] in ("tsulib",) + LAZY_MODULES]
+    if loaded:
+        print("Loaded by the CLI: " + ", ".join(loaded))
+        return 1
+    return 0
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["crash"]:
+        sys.exit(1 if crash_persist() else 0)
+    if sys.argv[1:] == ["importtime"]:
+        sys.exit(1 if import_time() + cli_import() else 0)
+    if sys.argv[1:] == ["timeout"]:
+        sys.exit(1 if run_timeout() else 0)
     print("Testing starts")
     files = []
 
@@ -1,29 +1,23 @@
-from logging import debug
-from libutils import run_cmd
-from metastream import EncStream
-from bryckrecovery import EncRecovery
+from logging import debug, info
+from libutils import run_argv, get_config
+from devwait import wait_for_devices
+from sysstate import get_snapshot, invalidate_snapshot
 
-from os import path,cpu_count,mkdir
-import multiprocessing as mp
+from os import path,cpu_count
 import concurrent.futures
 from itertools import repeat
 from datetime import datetime
-from os.path import dirname, exists
-from json import load
 
-config = dirname(__file__) + "/config.json"
-with open(config) as cfg:
-    config = load(cfg)
+config = get_config()
 
-def parallel_exe(func_name,*values, num_threads = int(0.8*mp.cpu_count())):
+def parallel_exe(func_name,*values, num_threads = int(0.8*cpu_count())):
     with concurrent.futures.ThreadPoolExecutor(max_workers = num_threads) as executor:
       results = executor.map(func_name, *values)
     return results
 
 def encrypt_is_enabled(drives):
     for drive in drives:
-        cmd = "sudo blkid " + drive
-        rc, out, err = run_cmd(cmd)
+        rc, out, err = run_argv(["sudo", "blkid", drive])
         if rc:
             continue
         if "crypto_LUKS" in out:
@@ -39,8 +33,7 @@ def encrypt_setup_drive(drive, key_path):
     A tuple: return code, stderr, stdout
     """
     debug("Setting up the encryption for Drive : " + drive)
-    cmd = "sudo cryptsetup -q luksFormat " + drive + " " + key_path + ""
-    return run_cmd(cmd)
+    return run_argv(["sudo", "cryptsetup", "-q", "luksFormat", drive, key_path])
 
 
 def encrypt_unlock_drive(drive, key_path):
@@ -53,13 +46,17 @@ def encrypt_unlock_drive(drive, key_path):
     """
     encrypt_drive = encrypt_drive_name(drive)
     debug("Unlocking the drive " + encrypt_drive)
-    cmd = "sudo cryptsetup open --key-file " + key_path + " " + drive + \
-          "  " + encrypt_drive + ""
-    rc, out, err = run_cmd(cmd)
+    rc, out, err = run_argv(["sudo", "cryptsetup", "open", "--key-file", key_path,
+                             drive, encrypt_drive])
+    invalidate_snapshot()
     if rc:
         return rc, out, err,drive
-    cmd = "sudo partprobe"
-    run_cmd(cmd)
+    # map the partitions of this drive only, once udev created its node
+    rc, out, err = wait_for_devices(["/dev/mapper/" + encrypt_drive])
+    if rc:
+        return rc, out, err, drive
+    run_argv(["sudo", "partprobe", "/dev/mapper/" + encrypt_drive])
+    invalidate_snapshot()
     return 0, "", "", ""
 
 
@@ -74,22 +71,19 @@ def encrypt_lock_drive(drive):
     # deactivate any partitions in the drive
     debug("Deactivating partitions on " + encrypt_drive)
 
-    cmd = "ls /dev/mapper/{}[p]*".format(encrypt_drive) #NVME partition p1 and p2
-    rc, out, err = run_cmd(cmd)
-    if rc:
-        cmd = "ls /dev/mapper/{}[1-2]".format(encrypt_drive) #SATA partition 1 and 2
-        rc, out, err = run_cmd(cmd)
-
-    if out:
-       parts = out.strip().rstrip("\n").split()
-       for part in parts:
-           cmd = "sudo dmsetup remove "+part
-           rc, out, err = run_cmd(cmd)
-           if rc:
-               return rc, out, err
+    # the partition maps, p1 and p2 for NVME and 1 and 2 for SATA, hold the drive
+    parts = [part for part in get_snapshot().device_holders("/dev/mapper/" + encrypt_drive)
+             if part.startswith("/dev/mapper/" + encrypt_drive)]
+
+    for part in parts:
+        rc, out, err = run_argv(["sudo", "dmsetup", "remove", part])
+        invalidate_snapshot()
+        if rc:
+            return rc, out, err
     debug("Locking the encrypted drive " + encrypt_drive)
-    cmd = "sudo cryptsetup close " + encrypt_drive + ""
-    return run_cmd(cmd)
+    result = run_argv(["sudo", "cryptsetup", "close", encrypt_drive])
+    invalidate_snapshot()
+    return result
 
 
 def encrypt_reset_drive(drive):
@@ -102,8 +96,9 @@ def encrypt_reset_drive(drive):
     debug("Resetting the encryption on drive " + drive)
     encrypt_lock_drive(drive)
     encrypt_drive = encrypt_drive_name(drive)
-    cmd = "sudo cryptsetup remove " + encrypt_drive + ""
-    return run_cmd(cmd)
+    result = run_argv(["sudo", "cryptsetup", "remove", encrypt_drive])
+    invalidate_snapshot()
+    return result
 
 
 def encrypt_drive_name(drive):
@@ -183,9 +178,8 @@ def encrypt_lock_drives(drives, parallel=True):
 
 def encrypt_change_key_drive(drive, old_key, new_key):
     debug("Changing the keys for the drive:" + drive)
-    cmd = "sudo cryptsetup luksChangeKey {} --key-file {} {}".format(drive,
-                                           old_key, new_key)
-    return run_cmd(cmd)
+    return run_argv(["sudo", "cryptsetup", "luksChangeKey", drive, "--key-file", old_key,
+                     new_key])
 
 
 def encrypt_change_key_drives(drives, old_key, new_key):
@@ -230,6 +224,50 @@ def encrypt_unlock_drives(drives, keyfile, parallel=True):
                 errdrives.append(drive)
     return return_code, outmsg, errmsg,errdrives
 
+def header_workers(drives):
+    """Threads for the header work on drives, header_parallel_limit of
+    the configuration bounds them, 0 for no limit"""
+    limit = config.get('header_parallel_limit', 8)
+    workers = len(drives)
+    if limit:
+        workers = min(workers, limit)
+    return max(1, workers)
+
+def encrypt_header_read(drive):
+    """Reads the LUKS header of a drive for a backup
+    Args:
+    drive: Name of the drive
+    Returns:
+    A tuple: return code, header bytes or error string
+    """
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    # cryptsetup only writes to a file, keep it off the metadata partition
+    tmp_dir = mkdtemp()
+    file_name = tmp_dir + "/header.bin"
+    try:
+        rc, out, err = run_argv(["sudo", "cryptsetup", "luksHeaderBackup", drive,
+                                 "--header-backup-file", file_name])
+        if rc:
+            return 1, err
+        with open(file_name, "rb") as f:
+            return 0, f.read()
+    finally:
+        rmtree(tmp_dir, ignore_errors=True)
+
+
+def encrypt_header_capture(enc_stream, drive):
+    """Reads the LUKS header of a drive and compresses it for the stream,
+    the part of a backup that can run for all the drives at once
+    Returns:
+    A tuple: return code, (header bytes, digest) or error string
+    """
+    rc, header = encrypt_header_read(drive)
+    if rc:
+        return rc, header
+    return 0, (header, enc_stream.prepare_header(header))
+
+
 def encrypt_backup(directory, drives):
     debug("Backup the encryption drives:" + ','.join(drives))
     outmsg = ""
@@ -237,24 +275,54 @@ def encrypt_backup(directory, drives):
     results = []
     stream = "estream.bin"
     stream_type = "encryption"
-    enc_dir = directory + config['enc_dir']
-
-    if not exists(enc_dir):
-        mkdir(enc_dir)
-
-    file = directory + stream
+    # the streams are only loaded by the commands that back up headers
+    from metastream import EncStream
+    from streambackend import stream_file
+    from headerdiff import previous_headers, region_digest
+    threads = header_workers(drives)
+
+    # a header whose live bytes match its last backup is not captured again
+    previous = previous_headers(directory, stream_type, drives)
+    known = [drive for drive in drives if drive in previous]
+    digests = parallel_exe(region_digest, known, [previous[drive]['size'] for drive in known],
+                           num_threads=threads)
+    unchanged = set(drive for drive, digest in zip(known, digests)
+                    if digest == previous[drive]['blob'])
+    changed = [drive for drive in drives if drive not in unchanged]
+    skipped = "Skipped {} of {} unchanged encryption headers".format(len(unchanged), len(drives))
+    info(skipped)
+    if not changed:
+        return 0, skipped
+
+    file = stream_file(directory, stream)
     enc_stream = EncStream(config['id'], stream_type, desc=None, filename=file)
-    for drive in drives:
-        results.append(enc_stream.backup_header(enc_dir,drive))
+    if not enc_stream.backend.generations:
+        rc, msg = enc_stream.open_journal(stream_type)
+        if rc:
+            return 1, msg
+    # the headers are read and compressed concurrently, the stream is
+    # updated in drive order, the unchanged drives stay in the
+    # generations they were backed up in
+    enc_stream.blob_stream(stream_type)
+    headers = dict(zip(changed, parallel_exe(encrypt_header_capture, repeat(enc_stream), changed,
+                                             num_threads=threads)))
+    for drive in changed:
+        rc, header = headers[drive]
+        if rc:
+            results.append((drive, (rc, header)))
+            continue
+        header, digest = header
+        results.append((drive, enc_stream.backup_header(drive, header, digest)))
     rc,msg = enc_stream.persist(stream_type)
 
     if rc:
         return 1, msg
-    for result in results:
-        rc, out = result
+    for drive, (rc, out) in results:
         if rc:
             return_code = 1
-            outmsg += out
+            outmsg += "{}: {}\n".format(drive, out)
+    if not return_code:
+        outmsg = skipped
     return return_code, outmsg
 
 def encrypt_recovery(directory,drives,key_file):
@@ -263,22 +331,25 @@ def encrypt_recovery(directory,drives,key_file):
     return_code = 0
     results = []
     stream_type = "encryption"
+    from bryckrecovery import EncRecovery
 
     enc_rec = EncRecovery()
-    suc_count, err_count, err_files, types = enc_rec.read_streams(directory)
-    if stream_type in types:
-        for drive in drives:
-                results.append(enc_rec.restore_header(stream_type,drive))
-        for result in results:
+    rc, types = enc_rec.read_stream_by_type(directory, stream_type, drives)
+    if rc != 1:
+        results = parallel_exe(enc_rec.restore_header, repeat(stream_type), drives,
+                               num_threads=header_workers(drives))
+        for drive, result in zip(drives, results):
             rc, out = result
             if rc:
                 return_code = 1
-                outmsg += out
+                outmsg += "{}: {}\n".format(drive, out)
 
         lock, stdout, stderr, errdrives = encrypt_unlock_drives(drives, key_file)
         if lock:  # unlock fails
             debug("Failed to recover : "+ ','.join(drives))
             debug(stderr)
             return 1, stderr
+        if return_code:
+            return return_code, outmsg
         return return_code, "Recovered successfully from corruption"
     return 1, "Backup file is not exists"
@@ -1,6 +1,7 @@
 from logging import debug
 from libutils import *
-import time
+from devwait import wait_for_devices
+from sysstate import get_snapshot, invalidate_snapshot
 import os
 
 def filesystem_create(drive):
@@ -10,14 +11,11 @@ def filesystem_create(drive):
     Returns:
     A tuple: return code, stderr, stdout"""
     debug("creating file system")
-    time_to_wait = 500
-    while not os.path.exists(drive):
-         time.sleep(0.032)
-         time_to_wait = time_to_wait - 1
-         if(time_to_wait<0):
-             return 1,"","Path doesn't exist"
-    cmd = "sudo mkfs.xfs -f -K " + drive
-    return run_cmd(cmd)
+    # udev creates the raid symlink after mdadm returns
+    rc, out, err = wait_for_devices([drive])
+    if rc:
+        return rc, out, err
+    return run_argv(["sudo", "mkfs.xfs", "-f", "-K", drive])
 
 
 def filesystem_mount(drive, path, create=False):
@@ -30,16 +28,14 @@ def filesystem_mount(drive, path, create=False):
     A tuple: return code, stderr, stdout"""
     debug("Mounting the drive : {} to path : {}".format(drive, path))
     if create:
-         cmd = "mkdir -p " + path
-         rc, out, err = run_cmd(cmd)
+         rc, out, err = run_argv(["mkdir", "-p", path])
          if rc:
              return rc, out, err
-    cmd = "sudo mount " + drive + " " + path
-    rc, out, err = run_cmd(cmd)
+    rc, out, err = run_argv(["sudo", "mount", drive, path])
+    invalidate_snapshot()
     if rc:
         return rc, out, err
-    cmd = "sudo chmod 777 "+path
-    return run_cmd(cmd)
+    return run_argv(["sudo", "chmod", "777", path])
 
 
 def filesystem_unmount(path):
@@ -51,18 +47,17 @@ def filesystem_unmount(path):
     Returns:
     A tuple: return code, stderr, stdout"""
     debug("Unmounting the drive at path : {}".format(path))
-    cmd = "sudo umount " + path
-    return run_cmd(cmd)
+    result = run_argv(["sudo", "umount", path])
+    invalidate_snapshot()
+    return result
 
 
 def filesystem_flush():
     debug("Flushing file system cache")
-    cmd = "sync"
-    rc, out, err = run_cmd(cmd)
+    rc, out, err = run_argv(["sync"])
     if rc:
         return rc, out, err
-    cmd = "sudo sysctl -w vm.drop_caches=3"
-    return run_cmd(cmd)
+    return run_argv(["sudo", "sysctl", "-w", "vm.drop_caches=3"])
 
 
 def filesystem_is_mounted(drive):
@@ -74,20 +69,37 @@ def filesystem_is_mounted(drive):
         True if the drive is mounted or False if not
     """
     debug("Check if the drive {} is mounted".format(drive))
-    with open("/proc/mounts") as proc_file:
-        for line in proc_file:
-            if drive == line.split()[0]:
-                return True
-        return False
+    return get_snapshot().is_mounted(drive)
+
+
+def filesystem_mount_point(drive):
+    """ Mount point of a drive, None if it is not mounted
+    Args:
+        drive: Name of the drive, symlinks like /dev/md/name are resolved
+    """
+    return get_snapshot().mount_point(drive)
 
 
 def filesystem_usage(mount_dir):
     fsdata = {}
-    cmd = "df {} | grep -v Filesystem".format(mount_dir)
-    rc, out, err = run_cmd(cmd)
+    mount_point = filesystem_mount_point(mount_dir)
+    if mount_point:
+        st = os.statvfs(mount_point)
+        # 1K blocks, as df reports them
+        size = st.f_blocks * st.f_frsize // 1024
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize // 1024
+        available = st.f_bavail * st.f_frsize // 1024
+        fsdata['usable_capacity'] = round(size/(1024 * 1024),2)
+        fsdata['used_space'] = round(used/(1024 * 1024),2)
+        fsdata['available_space'] = round(available/(1024 * 1024),2)
+        # df rounds the percentage up
+        fsdata['usage'] = "{}%".format(-(-used * 100 // (used + available)) if used + available else 0)
+        return 0, fsdata
+    rc, out, err = run_argv(["df", mount_dir])
     if rc:
         return 1, fsdata
-    fields = out.split()
+    # skip the header line
+    fields = out.split("\n", 1)[-1].split()
     fsdata['usable_capacity'] = round(int(fields[1])/(1024 * 1024),2)
     fsdata['used_space'] = round(int(fields[2])/(1024 * 1024),2)
     fsdata['available_space'] = round(int(fields[3])/(1024 * 1024),2)
@@ -0,0 +1,188 @@
+# !/usr/bin/env python
+from logging import debug
+from struct import pack, unpack_from, calcsize, error as StructError
+from libutils import run_argv
+import zlib
+import os
+
+# A snapshot holds the raw sectors of both GPT copies of a drive:
+# magic, sector size, drive sectors, region count, then per region its
+# first LBA, its length and its bytes
+GPT_SNAPSHOT_MAGIC = b"GPTSNAP\x01"
+GPT_SNAPSHOT_HEADER = ">IQI"
+GPT_REGION_HEADER = ">QI"
+GPT_SIGNATURE = b"EFI PART"
+# signature, revision, header size, header crc, reserved, my lba,
+# alternate lba, first and last usable lba, disk guid, entries lba,
+# number of entries, entry size, entries crc
+GPT_HEADER = "<8sIIII4Q16sQIII"
+GPT_HEADER_CRC = 16
+GPT_MAX_ENTRIES_SIZE = 1024 * 1024
+
+
+class GPTError(Exception):
+    pass
+
+
+def gpt_parse_header(sector, lba):
+    """Parses and verifies a GPT header sector
+    Args:
+    sector: bytes of the sector
+    lba: LBA the sector was read from
+    Returns:
+    dict of the header fields
+    Raises:
+    GPTError when the header is missing, misplaced or fails its CRC
+    """
+    try:
+        fields = unpack_from(GPT_HEADER, sector)
+    except StructError:
+        raise GPTError("short GPT header at LBA {}".format(lba))
+    (signature, revision, header_size, header_crc, reserved, my_lba, alternate_lba,
+     first_usable, last_usable, guid, entries_lba, entries, entry_size, entries_crc) = fields
+    if signature != GPT_SIGNATURE:
+        raise GPTError("no GPT header at LBA {}".format(lba))
+    if not calcsize(GPT_HEADER) <= header_size <= len(sector) or my_lba != lba:
+        raise GPTError("invalid GPT header at LBA {}".format(lba))
+    header = sector[:GPT_HEADER_CRC] + b"\0\0\0\0" + sector[GPT_HEADER_CRC + 4:header_size]
+    if zlib.crc32(header) != header_crc:
+        raise GPTError("GPT header CRC mismatch at LBA {}".format(lba))
+    if not 0 < entries * entry_size <= GPT_MAX_ENTRIES_SIZE:
+        raise GPTError("invalid GPT entry array at LBA {}".format(lba))
+    return {'alternate_lba': alternate_lba, 'entries_lba': entries_lba,
+            'entries_size': entries * entry_size, 'entries_crc': entries_crc}
+
+
+def gpt_read_copy(fd, sector_size, lba):
+    """Reads and verifies one GPT copy, its header and its entry array
+    Returns:
+    A tuple: header fields, list of (lba, bytes) regions
+    """
+    sector = os.pread(fd, sector_size, lba * sector_size)
+    header = gpt_parse_header(sector, lba)
+    entries = os.pread(fd, header['entries_size'], header['entries_lba'] * sector_size)
+    if zlib.crc32(entries) != header['entries_crc']:
+        raise GPTError("GPT entries CRC mismatch at LBA {}".format(header['entries_lba']))
+    return header, [(lba, sector), (header['entries_lba'], entries)]
+
+
+def gpt_snapshot_fd(fd, sector_size):
+    sectors = os.lseek(fd, 0, os.SEEK_END) // sector_size
+    # protective MBR and primary copy, then the backup copy at the end
+    regions = [(0, os.pread(fd, sector_size, 0))]
+    header, primary = gpt_read_copy(fd, sector_size, 1)
+    if header['alternate_lba'] != sectors - 1:
+        raise GPTError("backup GPT header is not on the last LBA")
+    backup_header, backup = gpt_read_copy(fd, sector_size, header['alternate_lba'])
+    regions += primary + backup
+    data = GPT_SNAPSHOT_MAGIC + pack(GPT_SNAPSHOT_HEADER, sector_size, sectors, len(regions))
+    for lba, region in regions:
+        data += pack(GPT_REGION_HEADER, lba, len(region)) + region
+    return data
+
+
+def gpt_snapshot(drive, sector_size):
+    """Reads the protective MBR and both GPT copies of a drive, after
+    verifying their CRCs
+    Args:
+    drive: Name of the drive
+    sector_size: logical sector size of the drive
+    Returns:
+    A tuple: return code, snapshot bytes or error string
+    """
+    debug("Taking the GPT snapshot of drive {}".format(drive))
+    try:
+        fd = os.open(drive, os.O_RDONLY)
+        try:
+            return 0, gpt_snapshot_fd(fd, sector_size)
+        finally:
+            os.close(fd)
+    except (OSError, GPTError) as e:
+        return 1, str(e)
+
+
+def is_gpt_snapshot(data):
+    return isinstance(data, bytes) and data.startswith(GPT_SNAPSHOT_MAGIC)
+
+
+def gpt_snapshot_regions(data):
+    """Parses a snapshot and verifies the GPT copies it holds
+    Returns:
+    A tuple: sector size, drive sectors, list of (lba, bytes) regions
+    """
+    try:
+        offset = len(GPT_SNAPSHOT_MAGIC)
+        sector_size, sectors, count = unpack_from(GPT_SNAPSHOT_HEADER, data, offset)
+        offset += calcsize(GPT_SNAPSHOT_HEADER)
+        regions = []
+        for i in range(count):
+            lba, length = unpack_from(GPT_REGION_HEADER, data, offset)
+            offset += calcsize(GPT_REGION_HEADER)
+            regions.append((lba, data[offset:offset + length]))
+            offset += length
+    except StructError:
+        raise GPTError("truncated GPT snapshot")
+    # MBR, primary header, primary entries, backup header, backup entries
+    if count != 5:
+        raise GPTError("invalid GPT snapshot")
+    for header_index in (1, 3):
+        lba, sector = regions[header_index]
+        header = gpt_parse_header(sector, lba)
+        entries_lba, entries = regions[header_index + 1]
+        if entries_lba != header['entries_lba'] or zlib.crc32(entries) != header['entries_crc']:
+            raise GPTError("GPT snapshot entries CRC mismatch")
+    return sector_size, sectors, regions
+
+
+def gpt_write_fd(fd, sector_size, sectors, regions):
+    if os.lseek(fd, 0, os.SEEK_END) // sector_size != sectors:
+        raise GPTError("drive size differs from the GPT snapshot")
+    for lba, region in regions:
+        written = os.pwrite(fd, region, lba * sector_size)
+        if written != len(region):
+            raise GPTError("short write of {} of {} bytes at LBA {}".format(
+                written, len(region), lba))
+    os.fsync(fd)
+
+
+def gpt_write_sudo(drive, sector_size, sectors, regions):
+    """Writes the regions through sudo dd, for a user who can not open
+    the drive, as every other device write of the library does"""
+    rc, out, err = run_argv(["sudo", "blockdev", "--getsize64", drive])
+    if rc:
+        raise GPTError(err)
+    if int(out) // sector_size != sectors:
+        raise GPTError("drive size differs from the GPT snapshot")
+    for lba, region in regions:
+        rc, out, err = run_argv(["sudo", "dd", "of=" + drive, "bs=" + str(sector_size),
+                                 "seek=" + str(lba), "iflag=fullblock", "conv=notrunc,fsync",
+                                 "status=none"], input=region)
+        if rc:
+            raise GPTError("writing LBA {} failed: {}".format(lba, err))
+
+
+def gpt_restore(drive, data):
+    """Writes the sectors of a snapshot back to a drive of the same
+    geometry. The kernel is not told, see partition_recovery. A drive
+    this user can not open is written through sudo
+    Args:
+    drive: Name of the drive
+    data: snapshot bytes from gpt_snapshot
+    Returns:
+    A tuple: return code, error string
+    """
+    debug("Restoring the GPT snapshot of drive {}".format(drive))
+    try:
+        sector_size, sectors, regions = gpt_snapshot_regions(data)
+        try:
+            fd = os.open(drive, os.O_WRONLY)
+        except PermissionError:
+            gpt_write_sudo(drive, sector_size, sectors, regions)
+            return 0, ""
+        try:
+            gpt_write_fd(fd, sector_size, sectors, regions)
+        finally:
+            os.close(fd)
+    except (OSError, ValueError, GPTError) as e:
+        return 1, str(e)
+    return 0, ""
@@ -0,0 +1,62 @@
+# !/usr/bin/env python
+from logging import debug
+from bryckrecovery import BryckRecovery
+from metastream import DIGEST_LEN
+import hashlib
+import os
+
+
+def header_digest(data):
+    """hex digest of header bytes as blobs are keyed"""
+    return hashlib.blake2b(data, digest_size=DIGEST_LEN).hexdigest()
+
+
+def region_digest(drive, length):
+    """Digest of the first length bytes of a drive, read directly
+    Args:
+    drive: Name of the drive
+    length: size of the header region, that of its last backup
+    Returns:
+    hex digest as blobs are keyed, None if the drive can not be read
+    """
+    try:
+        fd = os.open(drive, os.O_RDONLY)
+        try:
+            data = os.pread(fd, length, 0)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        debug("Can not read the header of {}: {}".format(drive, e))
+        return None
+    return header_digest(data)
+
+
+def header_unchanged(ref, data):
+    """Whether header bytes match the blob a chunk refers to"""
+    return len(data) == ref['size'] and header_digest(data) == ref['blob']
+
+
+def previous_headers(directory, stream_type, drives):
+    """Newest backed up headers of the drives, from the generations of a
+    stream. Only the chunks are loaded, they hold the digest and size of
+    each header
+    Args:
+    directory: backup directory
+    stream_type: encryption or partition
+    drives: list of drive names
+    Returns:
+    dict of drive name to chunk value, drives backed up by older
+    releases, as file names or without a size, are left out
+    """
+    recovery = BryckRecovery()
+    rc, types = recovery.read_stream_by_type(directory, stream_type, drives, blobs=False)
+    if rc == 1:
+        return {}
+    headers = {}
+    for drive in drives:
+        rc, ref = recovery.read_chunk(stream_type, drive)
+        if rc or not isinstance(ref, dict) or 'size' not in ref:
+            continue
+        headers[drive] = ref
+    return headers
+
@@ -0,0 +1,76 @@
+# !/usr/bin/env python
+from logging import debug
+from libutils import load_cache, save_cache
+import os
+
+# Bumped by every uevent, block device add, remove and change included
+UEVENT_SEQNUM = "/sys/kernel/uevent_seqnum"
+SYSFS_BLOCK = "/sys/block"
+
+
+def read_attr(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def block_fingerprint(block=SYSFS_BLOCK):
+    """Block devices with their device numbers, disk sequence numbers,
+    sizes and firmware revisions, NVME and SCSI. An added, removed or
+    replaced disk changes it, so does a firmware update
+    Returns:
+    list of [name, dev, diskseq, size, firmware_rev, rev] lists, in name order
+    """
+    try:
+        names = sorted(os.listdir(block))
+    except OSError:
+        return []
+    return [[name] + [read_attr(os.path.join(block, name, attr))
+                      for attr in ("dev", "diskseq", "size",
+                                   "device/firmware_rev", "device/rev")]
+            for name in names]
+
+
+def inventory_state():
+    """Snapshot taken before the drives are enumerated, so an event during
+    the enumeration makes the cached inventory stale"""
+    return {'seqnum': read_attr(UEVENT_SEQNUM), 'fingerprint': block_fingerprint()}
+
+
+def load_inventory(cache_file, config_key):
+    """Loads the cached drive inventory. It is valid while no uevent
+    happened since it was written and, after some did, while the block
+    devices are the same
+    Args:
+    cache_file: inventory cache file
+    config_key: configuration the inventory was enumerated with
+    Returns:
+    the cached inventory or None when it is missing or stale
+    """
+    cache = load_cache(cache_file, "inventory")
+    if cache is None or cache.get('config') != config_key:
+        return None
+    seqnum = read_attr(UEVENT_SEQNUM)
+    if seqnum is not None and seqnum == cache.get('seqnum'):
+        return cache['inventory']
+    state = inventory_state()
+    if state['fingerprint'] != cache.get('fingerprint'):
+        debug("Drive inventory cache is stale")
+        return None
+    # the events did not touch the block devices
+    save_inventory(cache_file, config_key, state, cache['inventory'])
+    return cache['inventory']
+
+
+def save_inventory(cache_file, config_key, state, inventory):
+    """Writes the inventory cache, a failure only costs the next
+    invocation an enumeration
+    Args:
+    state: inventory_state taken before the enumeration
+    """
+    cache = {'config': config_key, 'seqnum': state['seqnum'],
+             'fingerprint': state['fingerprint'], 'inventory': inventory}
+    save_cache(cache_file, "inventory", cache)
+
@@ -1,15 +1,171 @@
-from subprocess import Popen, PIPE
 from logging import debug
+from json import load, dump
+import os
+
+# Executables resolved once, so a spawn does not search PATH again
+EXECUTABLES = {}
+# config.json, parsed once and shared by all the modules
+CONFIG = None
+
+
+def get_config():
+    """Reads config.json on the first call
+    Returns:
+    the configuration dict, the same object for every caller
+    """
+    global CONFIG
+    if CONFIG is None:
+        with open(os.path.join(os.path.dirname(__file__), "config.json")) as cfg:
+            CONFIG = load(cfg)
+    return CONFIG
+
+
+def get_version():
+    """ Reads the version from the config json and returns it"""
+    return get_config()['version']
+
+
+def get_tsutil_name():
+    """ Reads the name of the CLI from the config json and returns it"""
+    return get_config()['tsutil_name']
 
 
 def run_cmd(cmd):
-    """Runs a Linux system command
+    """Runs a Linux system command through the shell. Kept for scripts,
+    the library runs its commands with run_argv
     Args:
     cmd: Command to be executed
     Returns:
     A tuple: return code, stderr, stdout
     """
+    from subprocess import Popen, PIPE
     debug("Running the command: " + cmd)
     p = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
     stdout, stderr = p.communicate()
     return p.returncode, stdout.decode('utf-8'), stderr.decode('utf-8')
+
+
+def resolve_executable(name):
+    from shutil import which
+    if os.path.dirname(name):
+        return name
+    if name not in EXECUTABLES:
+        path = which(name)
+        if path is None:
+            return name
+        EXECUTABLES[name] = path
+    return EXECUTABLES[name]
+
+
+def run_argv(argv, input=None, stdin_file=None, stdout_file=None, timeout=None):
+    """Runs a command without a shell
+    A command with a timeout gets its own session, and with it its own
+    process group, which is killed as a whole when the timeout expires,
+    so helpers spawned by sudo do not linger. A command without a
+    timeout stays in the session and process group of this process, so
+    sudo can still ask for a password on the terminal.
+    Without preexec hooks or uid changes Popen spawns through vfork, the
+    cost of a spawn does not grow with the memory of this process.
+    Args:
+    argv: command and its arguments as a list
+    input: bytes or str fed to stdin, replaces "yes |" and "echo |"
+    stdin_file: file fed to stdin, replaces "< file"
+    stdout_file: file receiving stdout, replaces "> file"
+    timeout: seconds before the command is killed, None to wait forever
+    Returns:
+    A tuple: return code, stdout, stderr
+    """
+    # subprocess is imported on the first command, commands answered
+    # from sysfs and the caches never pay for it
+    from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+    import shlex
+    debug("Running the command: " + shlex.join(argv))
+    argv = [resolve_executable(argv[0])] + list(argv[1:])
+    if isinstance(input, str):
+        input = input.encode('utf-8')
+    stdin = DEVNULL
+    stdout = PIPE
+    files = []
+    group = {'start_new_session': True} if timeout is not None else {}
+    try:
+        if stdin_file is not None:
+            stdin = open(stdin_file, "rb")
+            files.append(stdin)
+        elif input is not None:
+            stdin = PIPE
+        if stdout_file is not None:
+            stdout = open(stdout_file, "wb")
+            files.append(stdout)
+        p = Popen(argv, stdin=stdin, stdout=stdout, stderr=PIPE, **group)
+    except OSError as e:
+        for f in files:
+            f.close()
+        return 127, "", str(e)
+    try:
+        out, err = p.communicate(input, timeout=timeout)
+    except TimeoutExpired:
+        kill_group(p)
+        out, err = p.communicate()
+        err = (err or b"") + "Command timed out after {} seconds".format(timeout).encode('utf-8')
+    except BaseException:
+        if group:
+            kill_group(p)
+        else:
+            p.kill()
+        p.wait()
+        raise
+    finally:
+        for f in files:
+            f.close()
+    return p.returncode, (out or b"").decode('utf-8'), err.decode('utf-8')
+
+
+def kill_group(p):
+    import signal
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def load_cache(cache_file, name):
+    """Loads a JSON cache kept on this host
+    Args:
+    cache_file: cache file
+    name: of the cache, for the log
+    Returns:
+    the cached dict or None when it is missing, invalid or written by
+    another user
+    """
+    try:
+        with open(cache_file) as f:
+            # only trust a cache written by this user
+            if os.fstat(f.fileno()).st_uid != os.getuid():
+                debug("Ignoring the {} cache of another user".format(name))
+                return None
+            cache = load(f)
+    except (OSError, ValueError):
+        return None
+    return cache if isinstance(cache, dict) else None
+
+
+def save_cache(cache_file, name, cache):
+    """Writes a JSON cache kept on this host, a failure only costs the
+    next invocation the work the cache saves
+    Args:
+    cache_file: cache file
+    name: of the cache, for the log
+    cache: dict to be stored
+    """
+    from tempfile import mkstemp
+    try:
+        fd, tmp_name = mkstemp(dir=os.path.dirname(cache_file) or ".")
+        try:
+            with os.fdopen(fd, "w") as f:
+                dump(cache, f)
+            os.replace(tmp_name, cache_file)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+    except OSError as e:
+        debug("Failed to write the {} cache: {}".format(name, e))
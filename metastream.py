@@ -1,20 +1,76 @@
 # !/usr/bin/env python
-from json import dumps, loads, load
+from json import dumps, loads, load, JSONEncoder
 from datetime import datetime
 from os.path import dirname
-from libutils import run_cmd
+from libutils import get_config
+from struct import pack, calcsize
+from logging import debug
+import threading
 import hashlib
+import zlib
+import lzma
 import base64
+import io
 import sys
 import os
 
-config = dirname(__file__) + "/config.json"
-with open(config) as cfg:
-    config = load(cfg)
+config = get_config()
+
+# v2 container: magic, version, section count followed by one length
+# prefixed section per stream. v1 files are plain base64 text so the
+# non-ascii first byte of the magic can never collide with them.
+STREAM_MAGIC = b"\x89BMS"
+STREAM_VERSION = 2
+STREAM_HEADER = ">HI"
+SECTION_LEN = ">I"
+DIGEST_LEN = 16
+
+# Journal entries are
+# len | op | type len | type | codec len | codec | chunk record | digest
+JOURNAL_SUFFIX = ".log"
+TEMP_SUFFIX = ".tmp"
+JOURNAL_APPEND = b'A'
+JOURNAL_DELETE = b'D'
+
+# Chunk value codecs of a v2 stream, name mapped to (compress, decompress).
+# The codec is recorded in the section header, new codecs can be added here.
+STREAM_CODECS = {
+    'none': (bytes, bytes),
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+}
+
+# Header blobs of a stream are kept content addressed in a sibling
+# stream <type>.blobs in the same file, chunks refer to them by digest
+BLOB_SUFFIX = ".blobs"
+
+# Streams are written in pieces of about this size, a multiple of 3 so
+# the v1 base64 text can be encoded piece by piece
+WRITE_PIECE = 3 << 14
+
+# Catalog of the streams in a backup directory, stream type mapped to
+# file, size, mtime and root checksum
+CATALOG_FILE = "catalog.json"
+
+# Every backup is a generation file <stream>_<time>.bin, the retention
+# policy expires the old ones
+GENERATION_FORMAT = "%Y_%m_%d_%H_%M_%S_%f"
 
 class MetaStream:
     def __init__(self):
         self.stream = {}
+        self.journal = {}
+        self.journal_lock = threading.Lock()
+        self.compactions = {}
+        self.stream_roots = {}
+        self.stored_blobs = {}
+        # stored blobs handed out again, their new chunk may not be
+        # journaled yet when a compaction starts
+        self.reused_blobs = set()
+        # records compressed ahead by prepare_chunk
+        self.prepared = {}
+        from streambackend import get_backend
+        self.backend = get_backend(config.get('stream_backend', 'file'))
         msg_file = dirname(__file__) + "/messages.json"
         with open(msg_file) as msg:
             self.msg = load(msg)
@@ -25,6 +81,8 @@ class MetaStream:
     def append_chunk(self,stream_type,key,value):
         if stream_type in self.stream.keys():
             self.stream[stream_type]['data'][key]=value
+            if stream_type in self.journal:
+                return self.backend.append(self, JOURNAL_APPEND, stream_type, key, value)
             return 0, self.msg['Chunk_add']
         return 1,type + self.msg['Stream_err']
 
@@ -39,6 +97,8 @@ class MetaStream:
         if stream_type in self.stream.keys():
             if key in self.stream[stream_type]['data'].keys():
                 del self.stream[stream_type]['data'][key]
+                if stream_type in self.journal:
+                    return self.backend.append(self, JOURNAL_DELETE, stream_type, key)
                 return 0, self.msg['Chunk_del']
             return 0, key + self.msg['Chunk_no_del']
         return 1, type + self.msg['Stream_err']
@@ -46,24 +106,419 @@ class MetaStream:
     def dump_stream(self,stream_type):
         return self.stream[stream_type]
 
-    def persist(self,stream_type,enc_key=None):
-        bytes = self.encode_stream(stream_type)
+    def persist(self,stream_type,enc_key=None,codec=None):
+        """Writes the stream to the storage backend
+        Args:
+        stream_type: stream to be persisted
+        codec: compression for the chunk values, one of STREAM_CODECS.
+        Defaults to the stream's current codec or config stream_codec
+        Returns:
+        A tuple: return code, message
+        """
+        if codec is not None:
+            if codec not in STREAM_CODECS:
+                return 1, codec + self.msg['codec_err']
+            self.stream[stream_type]['codec'] = codec
+        try:
+            if stream_type in self.journal:
+                # every chunk is already durable in the journal
+                self.wait_compaction()
+                return 0, self.msg['persist']
+            return self.backend.write(self, stream_type)
+        finally:
+            self.backend.close()
+
+    def write_stream_file(self,stream_type):
+        types = list(self.stream.keys())
+        file_name = self.stream[stream_type]['filename']
         try:
-            f = open(self.stream[stream_type]['filename'], "wb")
-            f.write(bytes)
-            f.close()
+            # the previous generation stays in place until the rename
+            self.write_atomic(file_name, lambda f: self.write_stream(f, stream_type))
+            # a journal left by an earlier journaled writer would be
+            # replayed over the stream just written
+            if os.path.exists(file_name + JOURNAL_SUFFIX):
+                os.remove(file_name + JOURNAL_SUFFIX)
             rc,msg = self.delete_stream(stream_type)
-            return 0, self.msg['persist']
         except IOError as e:
             return 1, self.msg['persist_err']
+        self.update_catalog(file_name, types)
+        return 0, self.msg['persist']
+
+    def open_journal(self,stream_type):
+        """Switches a stream to journal mode. Chunk updates go to the
+        storage backend one by one instead of rewriting the whole stream,
+        and the stream is kept in memory after persist.
+        """
+        if stream_type not in self.stream.keys():
+            return 1, stream_type + self.msg['Stream_err']
+        return self.backend.open_journal(self, stream_type)
+
+    def open_file_journal(self,stream_type):
+        """Chunk updates are appended to <filename>.log, which is
+        compacted into the stream file in the background
+        """
+        file_name = self.stream[stream_type]['filename']
+        if not os.path.exists(file_name):
+            try:
+                self.write_atomic(file_name, lambda f: self.write_stream(f, stream_type))
+            except OSError as e:
+                return 1, self.msg['persist_err']
+            self.update_catalog(file_name, list(self.stream.keys()))
+        else:
+            # remember the blobs already stored so they are not journaled again
+            from bryckrecovery import BryckRecovery
+            recovery = BryckRecovery()
+            blob_type = stream_type + BLOB_SUFFIX
+            if recovery.get_type(file_name, keys=())[0] != 1:
+                self.stored_blobs[blob_type] = recovery.stream_keys.get(blob_type, set())
+        log_name = file_name + JOURNAL_SUFFIX
+        if not os.path.exists(log_name):
+            # the appends only sync the journal, its directory entry has
+            # to be durable before the first of them returns
+            try:
+                with open(log_name, "ab") as f:
+                    os.fsync(f.fileno())
+                self.sync_directory(log_name)
+            except OSError as e:
+                return 1, self.msg['persist_err']
+        self.journal[stream_type] = log_name
+        return 0, self.msg['journal_open']
+
+    def journal_append(self,op,stream_type,key,value=None):
+        type_name = stream_type.encode('utf-8')
+        codec = self.stream[stream_type].get('codec') or config.get('stream_codec', 'none')
+        codec_name = codec.encode('utf-8')
+        record = self.prepared_record(stream_type, key, value, codec) or \
+                 self.encode_record(key, value, STREAM_CODECS[codec][0])
+        payload = op + pack(SECTION_LEN, len(type_name)) + type_name + \
+                  pack(SECTION_LEN, len(codec_name)) + codec_name + record
+        entry = pack(SECTION_LEN, len(payload)) + payload + self.chunk_digest(payload)
+        try:
+            with self.journal_lock:
+                with open(self.journal[stream_type], "ab") as f:
+                    f.write(entry)
+                    f.flush()
+                    os.fsync(f.fileno())
+                size = os.path.getsize(self.journal[stream_type])
+        except OSError as e:
+            return 1, self.msg['persist_err']
+        if size > config.get('journal_compact_size', 1048576):
+            self.start_compaction(stream_type)
+        return 0, self.msg['Chunk_add'] if op == JOURNAL_APPEND else self.msg['Chunk_del']
+
+    def start_compaction(self,stream_type):
+        log_name = self.journal[stream_type]
+        worker = self.compactions.get(log_name)
+        if worker and worker.is_alive():
+            return
+        worker = threading.Thread(target=self.compact_journal, args=(stream_type,))
+        self.compactions[log_name] = worker
+        worker.start()
+
+    def wait_compaction(self):
+        for log_name in list(self.compactions.keys()):
+            self.compactions.pop(log_name).join()
+
+    def compact_journal(self,stream_type):
+        """Folds the journal into the stream file
+        The merged stream replaces the stream file by rename, then the
+        journal is cut down to the entries appended since compaction
+        started. A crash in between only replays entries that are
+        already in the stream file, which is harmless.
+        """
+        from bryckrecovery import BryckRecovery
+        file_name = self.stream[stream_type]['filename']
+        log_name = self.journal[stream_type]
+        with self.journal_lock:
+            offset = os.path.getsize(log_name)
+        recovery = BryckRecovery()
+        rc, msg = recovery.get_type(file_name)
+        if rc:
+            debug("Skipping compaction of corrupted stream " + file_name)
+            return 1, msg
+        # a blob is journaled before the chunk referring to it, which may
+        # land past offset; journaled and reused blobs wait for the next
+        # compaction to be collected
+        with self.journal_lock:
+            keep = recovery.journal_blobs | self.reused_blobs
+        for s_type in list(recovery.stream.keys()):
+            if not s_type.endswith(BLOB_SUFFIX):
+                recovery.collect_blobs(s_type, keep)
+        try:
+            self.write_atomic(file_name, lambda f: recovery.write_stream(f, stream_type))
+            with self.journal_lock:
+                with open(log_name, "rb") as f:
+                    f.seek(offset)
+                    tail = f.read()
+                self.write_atomic(log_name, tail)
+        except OSError as e:
+            debug("Compaction failed for " + file_name + ": " + str(e))
+            return 1, self.msg['persist_err']
+        recovery.update_catalog(file_name, list(recovery.stream.keys()))
+        debug("Compacted journal of " + file_name)
+        return 0, self.msg['persist']
+
+    def prepare_chunk(self,stream_type,key,value):
+        """Compresses a chunk value ahead of append_chunk or persist.
+        Several chunks can be compressed concurrently this way while the
+        stream itself is still updated in order.
+        """
+        codec = self.stream[stream_type].get('codec') or config.get('stream_codec', 'none')
+        record = self.encode_record(key, value, STREAM_CODECS[codec][0])
+        self.prepared[(stream_type, key)] = (value, codec, record)
+
+    def prepared_record(self,stream_type,key,value,codec):
+        """Takes the record prepare_chunk compressed for this value
+        Returns:
+        the record or None when it has to be encoded now
+        """
+        prepared = self.prepared.pop((stream_type, key), None)
+        if prepared and prepared[0] is value and prepared[1] == codec:
+            return prepared[2]
+        return None
+
+    def store_blob(self,stream_type,blob,digest=None):
+        """Stores a blob once in the blob stream of stream_type
+        Args:
+        digest: hex digest of the blob when already computed
+        Returns:
+        A tuple: return code, reference to be stored as a chunk value.
+        It holds the digest and the size of the blob, so a blob can be
+        compared with other bytes without loading it
+        """
+        blob_type = self.blob_stream(stream_type)
+        if digest is None:
+            digest = self.chunk_digest(blob).hex()
+        ref = {'blob': digest, 'size': len(blob)}
+        if digest in self.stream[blob_type]['data']:
+            return 0, ref
+        if digest in self.stored_blobs.get(blob_type, ()):
+            with self.journal_lock:
+                self.reused_blobs.add(digest)
+            return 0, ref
+        if config.get('stream_format', STREAM_VERSION) == 1:
+            # the v1 container is json, it cannot carry raw bytes
+            blob = base64.b64encode(blob).decode('ascii')
+        rc, msg = self.append_chunk(blob_type, digest, blob)
+        if rc:
+            return rc, msg
+        return 0, ref
+
+    def blob_stream(self,stream_type):
+        blob_type = stream_type + BLOB_SUFFIX
+        if blob_type not in self.stream.keys():
+            stream = self.stream[stream_type]
+            self.create_stream(id=stream['id'], type=blob_type,
+                               desc=stream['description'], filename=stream['filename'])
+            if 'codec' in stream:
+                self.stream[blob_type]['codec'] = stream['codec']
+            if stream_type in self.journal:
+                self.journal[blob_type] = self.journal[stream_type]
+        return blob_type
+
+    def read_blob(self,stream_type,ref):
+        if not isinstance(ref, dict) or 'blob' not in ref:
+            return 1, self.msg['blob_err']
+        rc, blob = self.read_chunk(stream_type + BLOB_SUFFIX, ref['blob'])
+        if not rc and isinstance(blob, str):
+            blob = base64.b64decode(blob)
+        return rc, blob
+
+    def collect_blobs(self,stream_type,keep=()):
+        """Deletes the blobs no chunk of stream_type refers to
+        Args:
+        keep: digests of blobs to be kept anyway
+        Returns:
+        number of blobs deleted
+        """
+        blob_type = stream_type + BLOB_SUFFIX
+        if stream_type not in self.stream.keys() or blob_type not in self.stream.keys():
+            return 0
+        used = set(value['blob'] for value in self.stream[stream_type]['data'].values()
+                   if isinstance(value, dict) and 'blob' in value)
+        unused = [digest for digest in self.stream[blob_type]['data']
+                  if digest not in used and digest not in keep]
+        for digest in unused:
+            self.delete_chunk(blob_type, digest)
+        if unused:
+            debug("Collected {} unused blobs of {}".format(len(unused), stream_type))
+        return len(unused)
+
+    def catalog_name(self,dir_location):
+        return os.path.join(dir_location, config.get('catalog_file', CATALOG_FILE))
+
+    def load_catalog(self,dir_location):
+        try:
+            with open(self.catalog_name(dir_location)) as f:
+                catalog = load(f)
+            if isinstance(catalog, dict):
+                return catalog
+        except (OSError, ValueError) as e:
+            pass
+        return {}
+
+    def update_catalog(self,file_name,types):
+        """Records the given stream types as stored in file_name. The
+        catalog is only an index, failing to write it is not fatal.
+        """
+        dir_location = dirname(os.path.abspath(file_name))
+        try:
+            catalog = self.load_catalog(dir_location)
+            st = os.stat(file_name)
+            for stream_type in types:
+                catalog[stream_type] = {'file': os.path.basename(file_name),
+                                        'size': st.st_size,
+                                        'mtime': st.st_mtime_ns,
+                                        'checksum': self.stream_roots.get(stream_type)}
+            self.write_atomic(self.catalog_name(dir_location),
+                              dumps(catalog, sort_keys=True).encode('utf-8'))
+        except OSError as e:
+            debug("Failed to update the stream catalog: " + str(e))
+
+    def write_atomic(self,file_name,data):
+        """Replaces file_name by a fully written and synced temporary
+        file, so a crash leaves either the old or the new content
+        Args:
+        file_name: file to be replaced
+        data: bytes, or a function writing the content to an open file
+        """
+        tmp_name = file_name + TEMP_SUFFIX
+        try:
+            with open(tmp_name, "wb") as f:
+                if callable(data):
+                    data(f)
+                else:
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        os.replace(tmp_name, file_name)
+        self.sync_directory(file_name)
+
+    def sync_directory(self,file_name):
+        """Flushes the directory entry of file_name to the disk"""
+        dir_fd = os.open(dirname(os.path.abspath(file_name)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def encode_stream(self,stream_type):
+        f = io.BytesIO()
+        self.write_stream(f, stream_type)
+        return f.getvalue()
+
+    def encode_stream_v1(self,stream_type):
+        f = io.BytesIO()
+        self.write_stream_v1(f, stream_type)
+        return f.getvalue()
+
+    def encode_stream_v2(self,stream_type):
+        f = io.BytesIO()
+        self.write_stream_v2(f, stream_type)
+        return f.getvalue()
+
+    def write_stream(self,f,stream_type):
+        """Serializes all the streams to a binary file object, a piece
+        at a time, without building the whole encoding in memory
+        """
+        if config.get('stream_format', STREAM_VERSION) == 1:
+            return self.write_stream_v1(f, stream_type)
+        return self.write_stream_v2(f, stream_type)
+
+    def write_stream_v1(self,f,stream_type):
+        # one pass for the checksum and one for the base64 text
+        encoder = JSONEncoder(sort_keys=True)
         hasher = hashlib.md5()
-        hasher.update(dumps(self.stream,sort_keys=True).encode('utf-8'))
+        for piece in encoder.iterencode(self.stream):
+            hasher.update(piece.encode('utf-8'))
         self.stream[stream_type]['checksum'] = hasher.hexdigest()
-        ascii_stream = dumps(self.stream,sort_keys=True).encode('ascii')
-        bytes = base64.b64encode(ascii_stream)
-        return bytes
+        self.stream_roots[stream_type] = hasher.hexdigest()
+        pending = bytearray()
+        for piece in encoder.iterencode(self.stream):
+            pending += piece.encode('ascii')
+            if len(pending) >= WRITE_PIECE:
+                end = len(pending) - len(pending) % 3
+                f.write(base64.b64encode(pending[:end]))
+                del pending[:end]
+        f.write(base64.b64encode(pending))
+
+    def write_stream_v2(self,f,stream_type):
+        """Writes all the streams as the binary v2 container
+        Every section is laid out as
+        len | header len | header json | chunk count | chunks | merkle root
+        and every chunk as len | key len | key | value tag | value | digest
+        The value is compressed with the codec named in the header, the
+        digest covers the stored bytes so verifying needs no decompression.
+        Chunks are written one by one and the section length is filled in
+        once the section is complete, so f has to be seekable.
+        """
+        f.write(STREAM_MAGIC + pack(STREAM_HEADER, STREAM_VERSION, len(self.stream)))
+        for s_type in sorted(self.stream.keys()):
+            stream = self.stream[s_type]
+            header = {k: v for k, v in stream.items() if k not in ('data', 'checksum')}
+            header['type'] = s_type
+            codec = header['codec'] = stream.get('codec') or config.get('stream_codec', 'none')
+            compress = STREAM_CODECS[codec][0]
+            header = dumps(header, sort_keys=True).encode('utf-8')
+            start = f.tell()
+            f.write(pack(SECTION_LEN, 0))
+            f.write(pack(SECTION_LEN, len(header)) + header +
+                    pack(SECTION_LEN, len(stream['data'])))
+            digests = [self.chunk_digest(header)]
+            for key, value in stream['data'].items():
+                chunk, digest = self.encode_chunk(key, value, compress,
+                                                  self.prepared_record(s_type, key, value, codec))
+                f.write(chunk)
+                digests.append(digest)
+            end = f.tell()
+            f.seek(start)
+            f.write(pack(SECTION_LEN, end - start - calcsize(SECTION_LEN)))
+            f.seek(end)
+            root = self.merkle_root(digests)
+            self.stream_roots[s_type] = root.hex()
+            f.write(root)
+
+    def encode_chunk(self,key,value,compress=bytes,record=None):
+        """Encodes a chunk record
+        Args:
+        record: the record already encoded by prepare_chunk
+        Returns:
+        A tuple: encoded chunk, digest of the chunk record
+        """
+        if record is None:
+            record = self.encode_record(key, value, compress)
+        digest = self.chunk_digest(record)
+        return pack(SECTION_LEN, len(record)) + record + digest, digest
+
+    def encode_record(self,key,value,compress=bytes):
+        key = key.encode('utf-8')
+        if isinstance(value, bytes):
+            tag = b'b'
+        elif isinstance(value, str):
+            tag = b's'
+            value = value.encode('utf-8')
+        else:
+            tag = b'j'
+            value = dumps(value, sort_keys=True).encode('utf-8')
+        return pack(SECTION_LEN, len(key)) + key + tag + compress(value)
+
+    def chunk_digest(self,record):
+        return hashlib.blake2b(record, digest_size=DIGEST_LEN).digest()
+
+    def merkle_root(self,digests):
+        """Folds the chunk digests pairwise up to a single root digest.
+        An odd digest at the end of a level is carried up unchanged.
+        """
+        level = list(digests)
+        while len(level) > 1:
+            level = [self.chunk_digest(b''.join(level[i:i + 2]))
+                     if i + 1 < len(level) else level[i]
+                     for i in range(0, len(level), 2)]
+        return level[0]
 
     def delete_stream(self,stream_type):
         if stream_type in self.stream.keys():
@@ -87,13 +542,37 @@ class EncStream(MetaStream):
         self.create_stream(id=id,type=type,desc=desc,filename=filename)
         self.filename = filename
 
-    def backup_header(self,path,drive_name):
-        file_name = path +drive_name.split('0n')[-1] + ".bin"
-        cmd = "sudo cryptsetup luksHeaderBackup " + drive_name + " --header-backup-file " + file_name
-        rc, msg, err = run_cmd(cmd)
+    def prepare_header(self,header):
+        """Digests and compresses a LUKS header ahead of backup_header,
+        concurrently with the headers of the other drives. The blob
+        stream has to exist already
+        Returns:
+        hex digest of the header, for backup_header
+        """
+        blob_type = 'encryption' + BLOB_SUFFIX
+        digest = self.chunk_digest(header).hex()
+        if digest not in self.stream[blob_type]['data'] and \
+                digest not in self.stored_blobs.get(blob_type, ()) and \
+                config.get('stream_format', STREAM_VERSION) != 1:
+            self.prepare_chunk(blob_type, digest, header)
+        return digest
+
+    def backup_header(self,drive_name,header=None,digest=None):
+        """Stores the LUKS header of a drive
+        Args:
+        drive_name: Name of the drive
+        header: output of encrypt_header_read, read here when None
+        digest: output of prepare_header for header
+        """
+        if header is None:
+            from encryption import encrypt_header_read
+            rc, header = encrypt_header_read(drive_name)
+            if rc:
+                return 1, header
+        rc, ref = self.store_blob('encryption', header, digest)
         if rc:
-            return 1, err
-        return self.append_chunk('encryption', drive_name, file_name)
+            return 1, ref
+        return self.append_chunk('encryption', drive_name, ref)
 
 class PartStream(MetaStream):
     def __init__(self,id,type,desc=None,filename=""):
@@ -101,10 +580,18 @@ class PartStream(MetaStream):
         self.create_stream(id=id,type=type,desc=desc,filename=filename)
         self.filename = filename
 
-    def backup_header(self,path,drive_name):
-        file_name = path +drive_name.split('0n')[-1] + ".bin"
-        cmd = "sudo sfdisk -d " + drive_name + " > " + file_name
-        rc, msg, err = run_cmd(cmd)
+    def backup_header(self,drive_name,table=None):
+        """Stores the partition table of a drive
+        Args:
+        drive_name: Name of the drive
+        table: output of partition_snapshot_drive, read here when None
+        """
+        if table is None:
+            from partition import partition_snapshot_drive
+            rc, table = partition_snapshot_drive(drive_name)
+            if rc:
+                return 1, table
+        rc, ref = self.store_blob('partition', table)
         if rc:
-            return 1, "partition backup failed"
-        return self.append_chunk('partition', drive_name, file_name)
\ No newline at end of file
+            return 1, ref
+        return self.append_chunk('partition', drive_name, ref)
\ No newline at end of file
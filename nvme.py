@@ -8,15 +8,28 @@
 #
 # Written by: Manavalan Krishnan 11/12/20
 #
-from logging import debug
-from libutils import run_cmd
+from logging import debug, info
+from libutils import run_argv
+from time import perf_counter
 from json import loads
+import os
+import re
 import concurrent.futures
 from itertools import repeat
-import multiprocessing as mp
 
+# Drives are enumerated from the block devices of sysfs, SATA serial
+# numbers come from the udev database
+SYSFS_ROOT = "/sys"
+UDEV_DATA = "/run/udev/data"
+# nvme0n1, not the nvme0c0n1 paths of a multipath namespace
+NVME_NAMESPACE = re.compile(r"nvme\d+n\d+$")
+SECTOR_SIZE = 512
 
-def parallel_exe(func_name,*values, num_threads = 0.8*mp.cpu_count()):
+# Seconds between the reports of the drives still being erased
+ERASE_PROGRESS_INTERVAL = 30
+
+
+def parallel_exe(func_name,*values, num_threads = int(0.8*os.cpu_count())):
     with concurrent.futures.ThreadPoolExecutor(max_workers = num_threads) as executor:
       results = executor.map(func_name, *values)
     return results
@@ -30,8 +43,7 @@ def nvme_list_drives():
         value: list of drives as json on success or error string on failure
     """
     debug("Listing all nvme drives in the system")
-    cmd = "sudo nvme list -o json"
-    rc, stdout, stderr = run_cmd(cmd)
+    rc, stdout, stderr = run_argv(["sudo", "nvme", "list", "-o", "json"])
     out = stderr
     if not rc:
         out = loads(stdout)['Devices']
@@ -46,14 +58,141 @@ def sata_list_drives():
             value: list of drives as json on success or error string on failure
         """
     debug("Listing all sata drives in the system")
-    cmd = "lsblk -o KNAME,TYPE,SIZE,SERIAL,MODEL,SUBSYSTEMS --json -b"
-    rc, stdout, stderr = run_cmd(cmd)
+    rc, stdout, stderr = run_argv(["lsblk", "-o", "KNAME,TYPE,SIZE,SERIAL,MODEL,SUBSYSTEMS",
+                                   "--json", "-b"])
     out = stderr
     if not rc:
         out = loads(stdout)['blockdevices']
     return rc, out
 
 
+def read_sysfs(path, strip=True):
+    """ Value of a sysfs attribute, None when it does not exist
+    Args:
+        path: attribute path
+        strip: strip the space padding, SCSI models keep theirs like lsblk
+    """
+    try:
+        with open(path) as f:
+            value = f.read()
+    except OSError:
+        return None
+    value = value.rstrip("\n")
+    return value.strip() if strip else value
+
+
+def sysfs_size(path):
+    sectors = read_sysfs(path + "/size")
+    return None if sectors is None else int(sectors) * SECTOR_SIZE
+
+
+def nvme_sysfs_drives(root=SYSFS_ROOT):
+    """ Enumerates all NVME namespaces from sysfs, without nvme-cli
+    Args:
+        root: sysfs mount point
+    Returns:
+        return code and value tuple
+        return code: 0 for success and non-zero when sysfs misses a drive attribute
+        value: list of drives in the nvme list json format on success or error string on failure
+    """
+    debug("Listing all nvme drives from sysfs")
+    block = os.path.join(root, "block")
+    try:
+        names = sorted(os.listdir(block))
+    except OSError as e:
+        return 1, str(e)
+    drives = []
+    for name in names:
+        if not NVME_NAMESPACE.match(name):
+            continue
+        path = os.path.join(block, name)
+        # the controller, or the subsystem of a multipath namespace
+        drive = {'DevicePath': "/dev/" + name,
+                 'ModelNumber': read_sysfs(path + "/device/model"),
+                 'SerialNumber': read_sysfs(path + "/device/serial"),
+                 'Firmware': read_sysfs(path + "/device/firmware_rev"),
+                 'PhysicalSize': sysfs_size(path)}
+        if None in drive.values():
+            return 1, "Missing sysfs attributes of " + name
+        drives.append(drive)
+    return 0, drives
+
+
+def sata_serial(path):
+    """ Serial number of a SCSI disk, as udev and lsblk report it"""
+    dev = read_sysfs(path + "/dev")
+    if dev:
+        try:
+            with open(os.path.join(UDEV_DATA, "b" + dev)) as f:
+                for line in f:
+                    if line.startswith("E:ID_SERIAL_SHORT="):
+                        return line.rstrip("\n").split("=", 1)[1]
+        except OSError:
+            pass
+    try:
+        # unit serial number VPD page, after its 4 byte header
+        with open(path + "/device/vpd_pg80", "rb") as f:
+            return f.read()[4:].decode('ascii', 'replace').strip("\x00 ")
+    except OSError:
+        return None
+
+
+def sata_sysfs_drives(root=SYSFS_ROOT):
+    """ Enumerates all SATA drives from sysfs, without lsblk
+    Args:
+        root: sysfs mount point
+    Returns:
+        return code and value tuple
+        return code: 0 for success and non-zero when sysfs misses a drive attribute
+        value: list of drives in the lsblk json format on success or error string on failure
+    """
+    debug("Listing all sata drives from sysfs")
+    block = os.path.join(root, "block")
+    try:
+        names = sorted(os.listdir(block))
+    except OSError as e:
+        return 1, str(e)
+    drives = []
+    for name in names:
+        path = os.path.join(block, name)
+        model = read_sysfs(path + "/device/model", strip=False)
+        if model is None:
+            # loop, ram, md and dm devices
+            continue
+        drive = {'kname': name, 'type': "disk", 'size': sysfs_size(path),
+                 'serial': sata_serial(path), 'model': model}
+        if None in drive.values():
+            return 1, "Missing sysfs attributes of " + name
+        drives.append(drive)
+    return 0, drives
+
+
+def nvme_enumerate_drives():
+    """ Enumerates all NVME drives from sysfs, falls back to nvme list
+    when sysfs is incomplete
+    Returns:
+        return code and value tuple as nvme_list_drives
+    """
+    rc, drives = nvme_sysfs_drives()
+    if rc:
+        debug(drives + ", running nvme list")
+        return nvme_list_drives()
+    return rc, drives
+
+
+def sata_enumerate_drives():
+    """ Enumerates all SATA drives from sysfs, falls back to lsblk
+    when sysfs is incomplete
+    Returns:
+        return code and value tuple as sata_list_drives
+    """
+    rc, drives = sata_sysfs_drives()
+    if rc:
+        debug(drives + ", running lsblk")
+        return sata_list_drives()
+    return rc, drives
+
+
 def nvme_get_drive_info(drive):
     """ Gets the detailed runtime info about the drive
     Args:
@@ -65,8 +204,7 @@ def nvme_get_drive_info(drive):
                on failure
     """
     debug("Getting detailed information for the drive {}".format(drive))
-    cmd = 'sudo nvme smart-log {} -o json'.format(drive)
-    rc, stdout, stderr = run_cmd(cmd)
+    rc, stdout, stderr = run_argv(["sudo", "nvme", "smart-log", drive, "-o", "json"])
     out = stderr
     if not rc:
         out = stdout
@@ -83,8 +221,7 @@ def nvme_erase_drive(drive):
         value: error string on failure, success message on success
     """
     debug("Securely erasing the drive {}".format(drive))
-    cmd = "sudo nvme format --force --ses=1 {}".format(drive)
-    return run_cmd(cmd)
+    return run_argv(["sudo", "nvme", "format", "--force", "--ses=1", drive])
 
 
 def sata_erase_drive(drive):
@@ -100,79 +237,89 @@ def sata_erase_drive(drive):
     return 0, 'Erase Success of drive {}'.format(drive), ''
 
 
-def nvme_erase_drives(drives, parallel=False):
-    """ Securely erases the drive content of given drives
+def erase_drives(erase, drives, parallel=True, limit=0, interval=ERASE_PROGRESS_INTERVAL):
+    """ Runs the erase function on the drives, all at once when parallel.
+    Every finished drive is reported with its elapsed time and the drives
+    still running are reported every interval seconds
     Args:
+        erase: function erasing one drive, nvme_erase_drive or sata_erase_drive
         drives: list of drive paths ex. /dev/nvme0n1,/dev/nvme1n1
         parallel: Execute the erasing in parallel
+        limit: most drives erased at once, 0 for all of them. Drives behind
+               one PCIe switch may have to share its bandwidth
+        interval: seconds between progress reports
     Returns:
         return code, stdout and stderr tuple
         return code: 0 for success and non zero for failure
     """
     debug("Securely erasing drives: {}".format(",".join(drives)))
-    errmsg = ""
+    if not drives:
+        return 0, "", ""
+    workers = len(drives) if parallel else 1
+    if limit:
+        workers = min(workers, limit)
+    start = perf_counter()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(timed_erase, erase, drive): drive for drive in drives}
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=interval, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                drive = futures[future]
+                elapsed, results[drive] = future.result()
+                info("Erased {} in {:.1f}s, {} ({}/{} done)".format(
+                    drive, elapsed, "failed" if results[drive][0] else "ok",
+                    len(results), len(drives)))
+            if pending and not done:
+                info("Still erasing {} after {:.0f}s".format(
+                    ",".join(sorted(futures[future] for future in pending)),
+                    perf_counter() - start))
+    debug("Erased {} drives in {:.1f}s".format(len(drives), perf_counter() - start))
+
+    return_code = 0
     outmsg = ""
-    rc = 0
-    results = []
-    if(parallel):
-        # values = drives,repeat(keyfile)
-        results = parallel_exe(nvme_erase_drive,drives)
-    else:
-        for drive in drives:
-            results.append(nvme_erase_drive(drive))
-
-    for result in results:
-        rc, out, err = result
+    errmsg = ""
+    for drive in drives:
+        rc, out, err = results[drive]
+        outmsg += out
         if rc:
-            errmsg += err
             return_code = 1
-            outmsg += out
+            errmsg += "{}: {}".format(drive, err)
     return return_code, outmsg, errmsg
 
-    # if not parallel:
-    #     for drive in drives:
-    #         rcode, out, err = nvme_erase_drive(drive)
-    #         if rcode:
-    #             rc = 1
-    #             err_msg += err
-    #         out_msg += out
-    # return rc, out_msg, err_msg
 
+def timed_erase(erase, drive):
+    start = perf_counter()
+    try:
+        result = erase(drive)
+    except Exception as e:
+        result = 1, "", str(e)
+    return perf_counter() - start, result
 
-def sata_erase_drives(drives, parallel=False):
+
+def nvme_erase_drives(drives, parallel=True, limit=0):
     """ Securely erases the drive content of given drives
     Args:
         drives: list of drive paths ex. /dev/nvme0n1,/dev/nvme1n1
         parallel: Execute the erasing in parallel
+        limit: most drives erased at once, 0 for all of them
     Returns:
         return code, stdout and stderr tuple
         return code: 0 for success and non zero for failure
     """
-    debug("Securely erasing drives: {}".format(",".join(drives)))
-    errmsg = ""
-    outmsg = ""
-    rc = 0
-    results = []
-    if(parallel):
-        # values = drives,repeat(keyfile)
-        results = parallel_exe(sata_erase_drive,drives)
-    else:
-        for drive in drives:
-            results.append(sata_erase_drive(drive))
-
-    for result in results:
-        rc, out, err = result
-        if rc:
-            errmsg += err
-            rc = 1
-            outmsg += out
-    return rc, outmsg, errmsg
-
-    # if not parallel:
-    #     for drive in drives:
-    #         rcode, out, err = nvme_erase_drive(drive)
-    #         if rcode:
-    #             rc = 1
-    #             err_msg += err
-    #         out_msg += out
-    # return rc, out_msg, err_msg
\ No newline at end of file
+    return erase_drives(nvme_erase_drive, drives, parallel, limit)
+
+
+def sata_erase_drives(drives, parallel=True, limit=0):
+    """ Securely erases the drive content of given drives
+    Args:
+        drives: list of drive paths ex. /dev/nvme0n1,/dev/nvme1n1
+        parallel: Execute the erasing in parallel
+        limit: most drives erased at once, 0 for all of them
+    Returns:
+        return code, stdout and stderr tuple
+        return code: 0 for success and non zero for failure
+    """
+    return erase_drives(sata_erase_drive, drives, parallel, limit)
@@ -1,15 +1,19 @@
-from logging import debug
-from libutils import run_cmd
-from metastream import PartStream
-from bryckrecovery import PartRecovery
+from logging import debug, info
+from libutils import run_argv, get_config
 from datetime import datetime
-from os.path import dirname, exists
-from json import load
-from os import mkdir
+from gpt import gpt_snapshot
+from sysstate import invalidate_snapshot
+import concurrent.futures
+import os
 
-config = dirname(__file__) + "/config.json"
-with open(config) as cfg:
-    config = load(cfg)
+config = get_config()
+
+# Partitions start and end on 1 MiB boundaries, as parted aligns them
+PART_ALIGN = 1024 * 1024
+# 128 GPT entries of 128 bytes, also kept in front of the backup header
+# at the end of the drive
+GPT_ENTRIES_SIZE = 128 * 128
+LINUX_FS_TYPE = "0FC63DAF-8483-4772-8E79-3D69D8477DE4"
 
 def partition_create_label(drive, label):
     """Creates a partition label for a drive.
@@ -20,8 +24,7 @@ def partition_create_label(drive, label):
     A tuple: return code, stderr, stdout
     """
     debug("creating partition label for drive {}".format(drive))
-    cmd = "sudo parted -s " + drive + " mklabel " + label + ""
-    return run_cmd(cmd)
+    return run_argv(["sudo", "parted", "-s", drive, "mklabel", label])
 
 
 def partition_create_drive(drive, size):
@@ -34,17 +37,18 @@ def partition_create_drive(drive, size):
     """
 
     debug("Creating partition on drive {} of size {} GB".format(drive, size))
-    cmd = "sudo parted -s " + drive + " unit MB print free | grep Free | tail -n 1"
-    returncode, stdout, stderr = run_cmd(cmd)
-    fields_mb = stdout.split()
+    returncode, stdout, stderr = run_argv(["sudo", "parted", "-s", drive, "unit", "MB",
+                                           "print", "free"])
+    # the last free space of the drive
+    free = [line for line in stdout.split("\n") if "Free" in line]
+    fields_mb = free[-1].split() if free else []
     if returncode == 0 and len(fields_mb) >= 2:
         start = float(fields_mb[0].replace("MB",""))
         end = float(fields_mb[1].replace("MB",""))
         start = 1 if start < 1 else start
         end = end if size < 0 else start + size
-        cmd = "sudo parted -s " + drive + " mkpart primary " + str(start) + \
-              " " + str(end) + ""
-        return run_cmd(cmd)
+        return run_argv(["sudo", "parted", "-s", drive, "mkpart", "primary",
+                         str(start), str(end)])
     else:
         return returncode, stdout, stderr
 
@@ -58,8 +62,7 @@ def partition_delete_drive(drive, partition_number):
     A tuple: return code, stderr, stdout
     """
     debug("Deleting partition {} on drive {}".format(partition_number, drive))
-    cmd = "sudo parted -s " + drive + " rm " + partition_number
-    return run_cmd(cmd)
+    return run_argv(["sudo", "parted", "-s", drive, "rm", partition_number])
 
 def partition_create_drives(drives, size, mklabel=False):
     """ create parition on given list of drives
@@ -85,6 +88,138 @@ def partition_create_drives(drives, size, mklabel=False):
         out_msg += out
     return return_code, out_msg, err_msg
 
+def partition_drive_geometry(drive):
+    """Reads the size and the logical sector size of a drive from sysfs
+    Args:
+    drive: Name of the drive, /dev/mapper names are resolved
+    Returns:
+    A tuple: return code, (size in bytes, sector size) or error string
+    """
+    sys_dir = "/sys/class/block/" + os.path.basename(os.path.realpath(drive))
+    try:
+        with open(sys_dir + "/size") as f:
+            # sysfs counts 512 byte sectors whatever the drive uses
+            size = int(f.read()) * 512
+        with open(sys_dir + "/queue/logical_block_size") as f:
+            sector_size = int(f.read())
+    except (OSError, ValueError) as e:
+        return 1, str(e)
+    return 0, (size, sector_size)
+
+
+def partition_layout(size, sector_size, meta_size):
+    """Computes the aligned metadata and data partitions of a drive
+    Args:
+    size: size of the drive in bytes
+    sector_size: logical sector size of the drive
+    meta_size: size of the metadata partition in MB, the data partition
+    takes the rest of the drive
+    Returns:
+    list of (start, size) in sectors per partition, None if the drive is too small
+    """
+    align = PART_ALIGN // sector_size
+    sectors = size // sector_size
+    # the backup GPT header is the last sector, its entries precede it
+    last_usable = sectors - 2 - GPT_ENTRIES_SIZE // sector_size
+    meta_start = align
+    meta_sectors = -(-meta_size * 1000 * 1000 // PART_ALIGN) * align
+    data_start = meta_start + meta_sectors
+    data_sectors = (last_usable + 1 - data_start) // align * align
+    if data_sectors <= 0:
+        return None
+    return [(meta_start, meta_sectors), (data_start, data_sectors)]
+
+
+def partition_script(layout):
+    """sfdisk script creating a GPT label with the partitions of a layout"""
+    script = "label: gpt\n"
+    for start, sectors in layout:
+        script += 'start={}, size={}, type={}, name="primary"\n'.format(start, sectors, LINUX_FS_TYPE)
+    return script
+
+
+def partition_write_drive(drive, meta_size):
+    """Writes a new GPT label with the metadata and data partitions in a
+    single sfdisk run and has the kernel re-read that drive only
+    Args:
+    drive: Name of the drive to be partitioned
+    meta_size: size of the metadata partition in MB
+    Returns:
+    A tuple: return code, stdout, stderr
+    """
+    debug("Writing the partitions of drive {}".format(drive))
+    rc, geometry = partition_drive_geometry(drive)
+    if rc:
+        return 1, "", geometry
+    layout = partition_layout(geometry[0], geometry[1], meta_size)
+    if layout is None:
+        return 1, "", "Drive {} is too small to be partitioned".format(drive)
+    rc, out, err = run_argv(["sudo", "sfdisk", "--no-reread", "--no-tell-kernel", drive],
+                            input=partition_script(layout))
+    if rc:
+        return rc, out, err
+    # partprobe also maps the partitions of device mapper drives
+    result = run_argv(["sudo", "partprobe", drive])
+    invalidate_snapshot()
+    return result
+
+
+def partition_write_drives(drives, meta_size):
+    """Partitions the given drives concurrently, see partition_write_drive
+    Args:
+    drives: List of drive names
+    meta_size: size of the metadata partition in MB
+    Returns:
+    A tuple: return code, stdout, stderr
+    """
+    err_msg = ""
+    out_msg = ""
+    return_code = 0
+    if not drives:
+        return 0, "", ""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(drives)) as executor:
+        results = list(executor.map(partition_write_drive, drives, [meta_size] * len(drives)))
+    for drive, (rc, out, err) in zip(drives, results):
+        if rc:
+            return_code = 1
+            err_msg += "{}: {}".format(drive, err)
+        out_msg += out
+    return return_code, out_msg, err_msg
+
+
+def partition_snapshot_drive(drive):
+    """Reads the partition table of a drive for a backup: the raw sectors
+    of both GPT copies, or the sfdisk dump when the drive has no valid GPT
+    or can not be opened without sudo
+    Args:
+    drive: Name of the drive
+    Returns:
+    A tuple: return code, partition table bytes or error string
+    """
+    rc, geometry = partition_drive_geometry(drive)
+    if not rc:
+        rc, table = gpt_snapshot(drive, geometry[1])
+        if not rc:
+            return 0, table
+        geometry = table
+    debug("Dumping drive {} with sfdisk: {}".format(drive, geometry))
+    rc, out, err = run_argv(["sudo", "sfdisk", "-d", drive])
+    if rc:
+        return 1, "partition backup failed"
+    return 0, out.encode('utf-8')
+
+
+def partition_map_drives(func, drives, *args):
+    """Runs func(drive, *args) on all the drives concurrently
+    Returns:
+    list of the results, in drives order
+    """
+    if not drives:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(drives)) as executor:
+        return list(executor.map(lambda drive: func(drive, *args), drives))
+
+
 def partition_reset_drives(drives):
     """ Remove all partitions from the drive
     Args:
@@ -96,13 +231,13 @@ def partition_reset_drives(drives):
     out_msg = ""
     return_code = 0
     for drive in drives:
-        cmd="sudo parted -s "+drive+" print 2>/dev/null |awk '/^ / {print $1}'"
-        rc, out, err = run_cmd(cmd)
+        rc, out, err = run_argv(["sudo", "parted", "-s", drive, "print"])
         if rc:
             #No partition. return success
             return 0, out, err
-        #delete all partitions
-        partitions = out.strip().split("\n")
+        #delete all partitions, their lines start with a space and the number
+        partitions = [line.split()[0] for line in out.split("\n")
+                      if line.startswith(" ") and line.strip()]
         for part in partitions:
             rc, out, err = partition_delete_drive(drive, part)
             if rc:
@@ -119,25 +254,49 @@ def partition_backup(directory, drives):
     results = []
     stream = "pstream.bin"
     stream_type = "partition"
-    part_dir = directory + config['part_dir']
+    # the streams are only loaded by the commands that back up headers
+    from metastream import PartStream
+    from streambackend import stream_file
+    from headerdiff import previous_headers, header_unchanged
 
-    if not exists(part_dir):
-        mkdir(part_dir)
+    # the tables are read concurrently, those matching their last backup
+    # are not stored again
+    tables = dict(zip(drives, partition_map_drives(partition_snapshot_drive, drives)))
+    previous = previous_headers(directory, stream_type, drives)
+    unchanged = set(drive for drive in drives if drive in previous and tables[drive][0] == 0
+                    and header_unchanged(previous[drive], tables[drive][1]))
+    skipped = "Skipped {} of {} unchanged partition tables".format(len(unchanged), len(drives))
+    info(skipped)
+    if len(unchanged) == len(drives):
+        return 0, skipped
 
-    file = directory + stream
+    file = stream_file(directory, stream)
     part_stream = PartStream(config['id'], stream_type, desc=None, filename=file)
+    if not part_stream.backend.generations:
+        rc, msg = part_stream.open_journal(stream_type)
+        if rc:
+            return 1, msg
 
+    # the stream is updated in drive order, the unchanged drives stay in
+    # the generations they were backed up in
     for drive in drives:
-        results.append(part_stream.backup_header(part_dir,drive))
+        if drive in unchanged:
+            continue
+        rc, table = tables[drive]
+        if rc:
+            results.append((drive, (rc, table)))
+            continue
+        results.append((drive, part_stream.backup_header(drive, table)))
 
     rc, msg = part_stream.persist(stream_type)
     if rc:
         return 1, msg
-    for result in results:
-        rc, out = result
+    for drive, (rc, out) in results:
         if rc:
             return_code = 1
-            outmsg += out
+            outmsg += "{}: {}\n".format(drive, out)
+    if not return_code:
+        outmsg = skipped
     return return_code, outmsg
 
 
@@ -147,12 +306,16 @@ def partition_recovery(directory, drives):
     return_code = 0
     results = []
     stream_type = "partition"
+    from bryckrecovery import PartRecovery
 
     part_rec = PartRecovery()
-    suc_count, err_count, err_files, types = part_rec.read_streams(directory)
-    if stream_type in types:
-        for drive in drives:
-            results.append(part_rec.restore_header(stream_type,drive))
+    rc, types = part_rec.read_stream_by_type(directory, stream_type, drives)
+    if rc != 1:
+        results = partition_map_drives(
+            lambda drive: part_rec.restore_header(stream_type, drive, reread=False), drives)
+        # one re-read for all the restored drives
+        run_argv(["sudo", "partprobe"] + list(drives))
+        invalidate_snapshot()
         for result in results:
             rc, out = result
             if rc:
@@ -1,16 +1,12 @@
 # !/usr/bin/env python
 from metastream import MetaStream
 from bryckrecovery import BryckRecovery
-from libutils import run_cmd
+from libutils import run_argv, get_config
 
 from datetime import datetime
-from json import load
-from os.path import dirname
 import os
 
-config = dirname(__file__) + "/config.json"
-with open(config) as cfg:
-    config = load(cfg)
+config = get_config()
 
 class PartStream(MetaStream):
     def __init__(self,id,type,desc=None,filename=""):
@@ -22,9 +18,7 @@ class PartStream(MetaStream):
         file_name = config['metadata_mount'] + \
                     config['backup_dir'] + "part_drives/" + \
                     drive_name.split('/')[-1] + datetime.now().strftime("%Y_%m_%d_%H_%M_%S_%f") + ".bin"
-        cmd = "sudo sfdisk -d " + drive_name + " > " + file_name
-        print(cmd)
-        rc, msg, err = run_cmd(cmd)
+        rc, msg, err = run_argv(["sudo", "sfdisk", "-d", drive_name], stdout_file=file_name)
         if rc:
             return 1, "partition backup failed"
         return self.append_chunk('partition', drive_name, file_name)
@@ -35,11 +29,8 @@ class PartRecovery(BryckRecovery):
 
     def restore_header(self,drive_name):
         file_name = self.stream['partition']['data'][drive_name]
-        cmd = "sudo sfdisk --force " + drive_name + " < " + file_name
-        print(cmd)
-        rc, msg, err = run_cmd(cmd)
-        cmd = "sudo partprobe"
-        run_cmd(cmd)
+        rc, msg, err = run_argv(["sudo", "sfdisk", "--force", drive_name], stdin_file=file_name)
+        run_argv(["sudo", "partprobe"])
         if rc:
             return 1, "Failed to restore the partition drive"
         return 0, "Successfully recovered"
@@ -0,0 +1,76 @@
+# !/usr/bin/env python
+from logging import debug
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import asyncio
+
+
+class StepPipeline:
+    """Runs chains of blocking steps, typically one chain per drive, as
+    asyncio tasks. A chain moves on as soon as its own previous step is
+    done, so there is no barrier between the chains. The number of steps
+    of one type running at once can be limited.
+    """
+    def __init__(self, limits=None):
+        """
+        Args:
+        limits: step type mapped to the most steps of that type allowed
+        to run at once, 0 or a missing type means no limit
+        """
+        self.limits = limits or {}
+        self.semaphores = {}
+        self.executor = None
+
+    def semaphore(self, step):
+        if step not in self.semaphores:
+            limit = self.limits.get(step, 0)
+            self.semaphores[step] = asyncio.Semaphore(limit) if limit > 0 else None
+        return self.semaphores[step]
+
+    async def run_step(self, name, step, func, *args):
+        semaphore = self.semaphore(step)
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            start = perf_counter()
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            debug("Step {} of {} took {:.2f}s".format(step, name, perf_counter() - start))
+        finally:
+            if semaphore:
+                semaphore.release()
+        return result
+
+    async def run_chain(self, name, chain):
+        """Runs the steps of a chain in order, up to the first failure
+        Args:
+        name: name of the chain for the logs, a drive name
+        chain: list of (step type, function, arguments) tuples. The
+        functions return a tuple starting with the return code
+        Returns:
+        A tuple: return code, failed step type, result of the failed step
+        """
+        for step, func, args in chain:
+            result = await self.run_step(name, step, func, *args)
+            if result[0]:
+                debug("Step {} of {} failed".format(step, name))
+                return 1, step, result
+        return 0, None, None
+
+    async def run_chains(self, chains):
+        # a chain runs one step at a time, one thread per chain is enough
+        with ThreadPoolExecutor(max_workers=max(1, len(chains))) as executor:
+            self.executor = executor
+            results = await asyncio.gather(*(self.run_chain(name, chain)
+                                             for name, chain in chains.items()))
+        self.executor = None
+        return dict(zip(chains.keys(), results))
+
+    def run(self, chains):
+        """Runs all the chains concurrently and waits for all of them
+        Args:
+        chains: chain name mapped to a chain, see run_chain
+        Returns:
+        chain name mapped to the result of run_chain, in chains order
+        """
+        self.semaphores = {}
+        return asyncio.run(self.run_chains(chains))
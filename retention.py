@@ -0,0 +1,263 @@
+# !/usr/bin/env python
+from logging import debug
+from libutils import get_config
+from metastream import BLOB_SUFFIX, JOURNAL_SUFFIX, TEMP_SUFFIX, CATALOG_FILE, GENERATION_FORMAT
+from bryckrecovery import BryckRecovery
+
+from datetime import datetime
+from json import dumps
+import os
+
+config = get_config()
+
+# Streams of expired generations are merged into <type>.archive streams of
+# one archive file, the chunk keys get the generation time appended
+ARCHIVE_SUFFIX = ".archive"
+ARCHIVE_FILE = "archive.bin"
+
+
+def backup_generations(directory):
+    """Lists the stream files of a backup directory, newest first
+    Args:
+    directory: backup directory, with a trailing slash
+    Returns:
+    list of (file name, {stream type: set of chunk keys}) tuples
+    """
+    recovery = BryckRecovery()
+    archive = config.get('archive_file', ARCHIVE_FILE)
+    files = [file_name for file_name in recovery.list_stream_files(directory)
+             if os.path.basename(file_name) != archive]
+    files.sort(key=lambda file_name: os.stat(file_name).st_mtime_ns, reverse=True)
+    generations = []
+    for file_name in files:
+        recovery.stream = {}
+        recovery.stream_keys = {}
+        # only the keys are needed, no chunk is decoded
+        rc, msg = recovery.get_type(file_name, keys=())
+        if rc == 1:
+            debug("Skipping corrupted stream file " + file_name)
+            continue
+        types = {}
+        for stream_type in recovery.stream:
+            if stream_type.endswith(BLOB_SUFFIX):
+                continue
+            keys = recovery.stream_keys.get(stream_type)
+            if keys is None:
+                # v1 streams are always decoded in full
+                keys = recovery.stream[stream_type]['data'].keys()
+            types[stream_type] = set(keys)
+        generations.append((file_name, types))
+    return generations
+
+
+def compaction_due(directory):
+    """Whether the backup directory holds more stream files than config
+    backup_compact_files. Only the directory is listed, so a backup can
+    check it every time and leave the policy to bryck compact otherwise
+    """
+    recovery = BryckRecovery()
+    if not recovery.backend.files:
+        return False
+    limit = config.get('backup_compact_files', 16)
+    return len(recovery.list_stream_files(directory)) > limit
+
+
+def expired_generations(generations, keep):
+    """Picks the stream files holding no chunk that is among the keep
+    newest generations of its drive and stream type
+    Args:
+    generations: output of backup_generations
+    keep: number of generations to keep per drive and stream type
+    Returns:
+    list of expired file names, newest first
+    """
+    seen = {}
+    expired = []
+    for file_name, types in generations:
+        needed = False
+        for stream_type, keys in types.items():
+            # an empty stream still counts as a generation of its type
+            for key in list(keys) + [None]:
+                count = seen.get((stream_type, key), 0) + 1
+                seen[(stream_type, key)] = count
+                if count <= keep:
+                    needed = True
+        if not needed:
+            expired.append(file_name)
+    return expired
+
+
+def archive_value(recovery, archive, stream_type, value, loose_files):
+    """Moves the header a chunk value refers to into the archive blobs
+    Returns:
+    A tuple: return code, archived chunk value or error message
+    """
+    archive_type = stream_type + ARCHIVE_SUFFIX
+    if isinstance(value, dict) and 'blob' in value:
+        rc, blob = recovery.read_blob(stream_type, value)
+        if rc:
+            return 1, blob
+        return archive.store_blob(archive_type, blob)
+    if isinstance(value, str) and os.path.isfile(value):
+        # header file of an older release, kept next to the streams
+        with open(value, "rb") as f:
+            blob = f.read()
+        loose_files.append(value)
+        return archive.store_blob(archive_type, blob)
+    return 0, value
+
+
+def archive_generations(directory, files):
+    """Merges the streams of the given files into the archive file
+    Returns:
+    A tuple: return code, message, list of files that can be removed
+    """
+    archive_file = directory + config.get('archive_file', ARCHIVE_FILE)
+    archive = BryckRecovery()
+    if os.path.exists(archive_file):
+        rc, msg = archive.get_type(archive_file)
+        if rc == 1:
+            return 1, "Archive " + archive_file + " is corrupted", []
+    archived = []
+    loose_files = []
+    count = 0
+    for file_name in reversed(files):
+        recovery = BryckRecovery()
+        rc, msg = recovery.get_type(file_name)
+        if rc:
+            # keep damaged generations for a manual look
+            debug("Not archiving damaged stream file " + file_name)
+            continue
+        generation = datetime.fromtimestamp(os.stat(file_name).st_mtime).strftime(GENERATION_FORMAT)
+        for stream_type, stream in recovery.stream.items():
+            if stream_type.endswith(BLOB_SUFFIX):
+                continue
+            archive_type = stream_type + ARCHIVE_SUFFIX
+            if archive_type not in archive.stream:
+                archive.create_stream(id=stream['id'], type=archive_type,
+                                      desc=stream['description'], filename=archive_file)
+            for key, value in stream['data'].items():
+                rc, value = archive_value(recovery, archive, stream_type, value, loose_files)
+                if rc:
+                    debug("Dropping chunk {} of {}: {}".format(key, file_name, value))
+                    continue
+                archive.append_chunk(archive_type, key + "@" + generation, value)
+        archived.append(file_name)
+        count += 1
+        if os.path.exists(file_name + JOURNAL_SUFFIX):
+            archived.append(file_name + JOURNAL_SUFFIX)
+    if not archived:
+        return 0, "Nothing to archive", []
+    try:
+        archive_type = sorted(archive.stream.keys())[0]
+        archive.write_atomic(archive_file, lambda f: archive.write_stream(f, archive_type))
+    except OSError as e:
+        return 1, archive.msg['persist_err'], []
+    return 0, "Archived {} generations".format(count), archived + loose_files
+
+
+def referenced_files(files):
+    """Header files of older releases the given stream files refer to"""
+    referenced = set()
+    for file_name in files:
+        recovery = BryckRecovery()
+        recovery.get_type(file_name)
+        for stream in recovery.stream.values():
+            for value in stream['data'].values():
+                if isinstance(value, str) and os.path.isfile(value):
+                    referenced.add(value)
+    return referenced
+
+
+def backup_usage(directory):
+    """Space used by a backup directory
+    Returns:
+    dict of file counts and sizes in bytes per kind of file
+    """
+    usage = {}
+    archive = config.get('archive_file', ARCHIVE_FILE)
+    catalog = config.get('catalog_file', CATALOG_FILE)
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            file_name = os.path.join(root, file)
+            if os.path.normpath(root) != os.path.normpath(directory):
+                kind = 'loose'
+            elif file == archive:
+                kind = 'archive'
+            elif file.endswith(JOURNAL_SUFFIX):
+                kind = 'journal'
+            elif file.endswith(TEMP_SUFFIX) or file == catalog or \
+                    file.startswith(config.get('stream_db', 'streams.db')):
+                kind = 'other'
+            else:
+                kind = 'stream'
+            try:
+                size = os.path.getsize(file_name)
+            except OSError:
+                continue
+            usage[kind + '_files'] = usage.get(kind + '_files', 0) + 1
+            usage[kind + '_bytes'] = usage.get(kind + '_bytes', 0) + size
+            usage['total_bytes'] = usage.get('total_bytes', 0) + size
+    return usage
+
+
+def format_usage(usage):
+    out = ""
+    for kind in ('stream', 'journal', 'archive', 'loose', 'other'):
+        if usage.get(kind + '_files'):
+            out += "{}: {} files, {:.2f} MB\n".format(kind.capitalize(), usage[kind + '_files'],
+                                                     usage[kind + '_bytes'] / (1024 * 1024))
+    out += "Total: {:.2f} MB\n".format(usage.get('total_bytes', 0) / (1024 * 1024))
+    return out
+
+
+def remove_catalog_entries(directory, files):
+    catalog_file = directory + config.get('catalog_file', CATALOG_FILE)
+    recovery = BryckRecovery()
+    catalog = recovery.load_catalog(directory)
+    names = set(os.path.basename(file_name) for file_name in files)
+    kept = {k: v for k, v in catalog.items() if v.get('file') not in names}
+    if len(kept) != len(catalog):
+        recovery.write_atomic(catalog_file, dumps(kept, sort_keys=True).encode('utf-8'))
+
+
+def compact_backups(directory, keep=None):
+    """Applies the retention policy to a backup directory. Generations
+    beyond the keep newest per drive and stream type are merged into the
+    archive file and removed, along with the header files they refer to.
+    Args:
+    directory: backup directory, with a trailing slash
+    keep: generations to keep, defaults to config backup_generations
+    Returns:
+    A tuple: return code, message
+    """
+    if keep is None:
+        keep = config.get('backup_generations', 3)
+    if keep < 1:
+        return 1, "At least one backup generation has to be kept"
+    recovery = BryckRecovery()
+    if not recovery.backend.files:
+        return 1, config.get('stream_backend') + recovery.msg['backend_files_err']
+    debug("Compacting the backup directory " + directory)
+    generations = backup_generations(directory)
+    expired = expired_generations(generations, keep)
+    if not expired:
+        return 0, "No expired generations"
+    rc, msg, removable = archive_generations(directory, expired)
+    if rc:
+        return 1, msg
+    # a header file can be shared with a generation that is kept
+    kept = referenced_files([file_name for file_name, types in generations
+                             if file_name not in expired])
+    for file_name in removable:
+        if file_name in kept:
+            continue
+        try:
+            os.remove(file_name)
+        except OSError as e:
+            debug("Failed to remove " + file_name + ": " + str(e))
+    try:
+        remove_catalog_entries(directory, removable)
+    except OSError as e:
+        debug("Failed to update the stream catalog: " + str(e))
+    return 0, msg
@@ -0,0 +1,400 @@
+# !/usr/bin/env python
+from metastream import JOURNAL_APPEND, BLOB_SUFFIX, GENERATION_FORMAT, STREAM_CODECS, config
+from logging import debug
+from datetime import datetime
+import threading
+import sqlite3
+import base64
+import time
+import os
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS streams (
+    file TEXT NOT NULL,
+    type TEXT NOT NULL,
+    id TEXT,
+    description TEXT,
+    codec TEXT,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (file, type)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    file TEXT NOT NULL,
+    type TEXT NOT NULL,
+    key TEXT NOT NULL,
+    record BLOB NOT NULL,
+    digest BLOB NOT NULL,
+    blob TEXT,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (file, type, key)
+);
+CREATE INDEX IF NOT EXISTS chunks_latest ON chunks (type, key, updated);
+CREATE INDEX IF NOT EXISTS chunks_blob ON chunks (blob);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+# Blobs no chunk of any stream refers to
+SQLITE_GC = "DELETE FROM blobs WHERE digest NOT IN " \
+            "(SELECT blob FROM chunks WHERE blob IS NOT NULL)"
+# A blob once the last chunk referring to it is gone
+SQLITE_GC_BLOB = "DELETE FROM blobs WHERE digest = ? AND NOT EXISTS " \
+                 "(SELECT 1 FROM chunks WHERE blob = ?)"
+
+
+def get_backend(name):
+    """Returns the storage backend for a config stream_backend name"""
+    if name not in STREAM_BACKENDS:
+        raise ValueError(name + " is not a supported stream backend")
+    return STREAM_BACKENDS[name]()
+
+
+def stream_file(directory, stream):
+    """Name of the stream file a backup of stream persists to, as the
+    configured backend stores it
+    Args:
+    directory: backup directory, with a trailing slash
+    stream: stream file name, estream.bin or pstream.bin
+    """
+    return get_backend(config.get('stream_backend', 'file')).stream_file(directory, stream)
+
+
+class FileBackend:
+    """Streams are files in the backup directory, written whole by
+    persist or incrementally through a journal next to the file
+    """
+    # read_streams and the retention policy work on the stream files
+    files = True
+    # a backup is a new generation file holding the drives that changed,
+    # written whole once, the readers merge the generations per drive
+    generations = True
+
+    def stream_file(self, directory, stream):
+        # a new generation file per backup, stream_<time>.bin
+        name, ext = os.path.splitext(stream)
+        return directory + name + "_" + datetime.now().strftime(GENERATION_FORMAT) + ext
+
+    def open_journal(self, meta, stream_type):
+        return meta.open_file_journal(stream_type)
+
+    def append(self, meta, op, stream_type, key, value=None):
+        return meta.journal_append(op, stream_type, key, value)
+
+    def write(self, meta, stream_type):
+        return meta.write_stream_file(stream_type)
+
+    def read_type(self, recovery, dir_location, stream_type, keys=None, blobs=None):
+        return recovery.read_file_by_type(dir_location, stream_type, keys, blobs)
+
+    def read_all(self, recovery, dir_location, keys=None, parallel=False, num_workers=1):
+        return recovery.read_stream_files(dir_location, keys, parallel, num_workers)
+
+    def latest_chunk(self, recovery, dir_location, stream_type, key):
+        rc, msg = recovery.read_file_by_type(dir_location, stream_type, [key])
+        if rc == 1:
+            return 1, msg
+        return recovery.read_chunk(stream_type, key)
+
+    def close(self):
+        # nothing is kept open between calls
+        pass
+
+
+class SqliteBackend:
+    """Streams, chunks and header blobs are rows of an SQLite database in
+    the backup directory, kept in WAL mode. The stream file name only
+    names a set of streams, every update is one small transaction and
+    blobs are shared by all the streams of the directory.
+    """
+    files = False
+    # a backup updates the rows of the drives that changed in place,
+    # through the journal, the rows of the other drives stay
+    generations = False
+
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def stream_file(self, directory, stream):
+        # a backup replaces the rows of the stream in one transaction
+        return directory + stream
+
+    def connect(self, dir_location):
+        db_name = os.path.join(dir_location, config.get('stream_db', 'streams.db'))
+        if db_name not in self.connections:
+            conn = sqlite3.connect(db_name, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.executescript(SQLITE_SCHEMA)
+            self.connections[db_name] = conn
+        return self.connections[db_name]
+
+    def close(self):
+        """Closes the cached connections, the next call opens them again"""
+        with self.lock:
+            for conn in self.connections.values():
+                conn.close()
+            self.connections = {}
+
+    def stream_codec(self, stream):
+        return stream.get('codec') or config.get('stream_codec', 'none')
+
+    def stream_row(self, stream_type, stream):
+        file_name = os.path.basename(stream['filename'])
+        return (file_name, stream_type, stream['id'], stream['description'],
+                self.stream_codec(stream), time.time_ns())
+
+    def chunk_row(self, meta, file_name, stream_type, key, value):
+        # the record is compressed with the codec its stream row names
+        codec = self.stream_codec(meta.stream[stream_type])
+        record = meta.prepared_record(stream_type, key, value, codec) or \
+                 meta.encode_record(key, value, STREAM_CODECS[codec][0])
+        blob = value['blob'] if isinstance(value, dict) and 'blob' in value else None
+        return (file_name, stream_type, key, record, meta.chunk_digest(record),
+                blob, time.time_ns())
+
+    def blob_row(self, digest, value):
+        if isinstance(value, str):
+            # base64 blob of a v1 stream
+            value = base64.b64decode(value)
+        return (digest, value)
+
+    def open_journal(self, meta, stream_type):
+        stream = meta.stream[stream_type]
+        dir_location = os.path.dirname(stream['filename'])
+        try:
+            with self.lock:
+                conn = self.connect(dir_location)
+                with conn:
+                    conn.execute("INSERT OR REPLACE INTO streams VALUES (?,?,?,?,?,?)",
+                                 self.stream_row(stream_type, stream))
+                    conn.execute(SQLITE_GC)
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, meta.msg['db_err']
+        meta.journal[stream_type] = dir_location
+        return 0, meta.msg['journal_open']
+
+    def append(self, meta, op, stream_type, key, value=None):
+        stream = meta.stream[stream_type]
+        file_name = os.path.basename(stream['filename'])
+        try:
+            with self.lock:
+                conn = self.connect(os.path.dirname(stream['filename']))
+                with conn:
+                    if stream_type.endswith(BLOB_SUFFIX):
+                        if op == JOURNAL_APPEND:
+                            conn.execute("INSERT OR IGNORE INTO blobs VALUES (?,?)",
+                                         self.blob_row(key, value))
+                        else:
+                            # other streams of the directory may share the blob
+                            conn.execute(SQLITE_GC_BLOB, (key, key))
+                    else:
+                        row = conn.execute("SELECT blob FROM chunks WHERE file = ? AND type = ? "
+                                           "AND key = ?", (file_name, stream_type, key)).fetchone()
+                        if op == JOURNAL_APPEND:
+                            conn.execute("INSERT OR REPLACE INTO chunks VALUES (?,?,?,?,?,?,?)",
+                                         self.chunk_row(meta, file_name, stream_type, key, value))
+                        else:
+                            conn.execute("DELETE FROM chunks WHERE file = ? AND type = ? "
+                                         "AND key = ?", (file_name, stream_type, key))
+                        # only the blob the old chunk referred to, the blob
+                        # of a new chunk is stored before the chunk
+                        if row is not None and row[0] is not None:
+                            conn.execute(SQLITE_GC_BLOB, (row[0], row[0]))
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, meta.msg['db_err']
+        return 0, meta.msg['Chunk_add'] if op == JOURNAL_APPEND else meta.msg['Chunk_del']
+
+    def write(self, meta, stream_type):
+        """Replaces all the streams of the file in one transaction"""
+        file_name = meta.stream[stream_type]['filename']
+        name = os.path.basename(file_name)
+        try:
+            with self.lock:
+                conn = self.connect(os.path.dirname(file_name))
+                with conn:
+                    for s_type, stream in meta.stream.items():
+                        if stream['filename'] != file_name:
+                            continue
+                        if s_type.endswith(BLOB_SUFFIX):
+                            conn.executemany("INSERT OR IGNORE INTO blobs VALUES (?,?)",
+                                             (self.blob_row(digest, value)
+                                              for digest, value in stream['data'].items()))
+                            continue
+                        conn.execute("INSERT OR REPLACE INTO streams VALUES (?,?,?,?,?,?)",
+                                     self.stream_row(s_type, stream))
+                        conn.execute("DELETE FROM chunks WHERE file = ? AND type = ?",
+                                     (name, s_type))
+                        conn.executemany("INSERT INTO chunks VALUES (?,?,?,?,?,?,?)",
+                                         (self.chunk_row(meta, name, s_type, key, value)
+                                          for key, value in stream['data'].items()))
+                    conn.execute(SQLITE_GC)
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, meta.msg['db_err']
+        meta.delete_stream(stream_type)
+        return 0, meta.msg['persist']
+
+    def read_type(self, recovery, dir_location, stream_type, keys=None, blobs=None):
+        """Loads the most recently updated stream of a type, only the
+        chunks in keys when given, and the blobs they refer to unless
+        blobs is False
+        """
+        try:
+            with self.lock:
+                conn = self.connect(dir_location)
+                row = conn.execute("SELECT file, id, description, codec FROM streams "
+                                   "WHERE type = ? ORDER BY updated DESC LIMIT 1",
+                                   (stream_type,)).fetchone()
+                if row is None:
+                    return 1, stream_type + recovery.msg['Stream_err']
+                file_name, id, desc, codec = row
+                query = "SELECT key, record, digest FROM chunks WHERE file = ? AND type = ?"
+                args = [file_name, stream_type]
+                if keys is not None:
+                    keys = list(keys)
+                    query += " AND key IN (" + ",".join("?" * len(keys)) + ")"
+                    args += keys
+                rows = conn.execute(query, args).fetchall()
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, recovery.msg['db_err']
+        stream = {'id': id, 'description': desc, 'filename': os.path.join(dir_location, file_name),
+                  'data': {}}
+        if codec:
+            stream['codec'] = codec
+        recovery.stream[stream_type] = stream
+        bad = self.load_chunks(recovery, stream_type, rows, codec)
+        types = [stream_type]
+        if blobs is False:
+            return (2 if bad else 0), types
+        rc, blob_type = self.load_blobs(recovery, stream_type)
+        if rc == 1:
+            return 1, blob_type
+        if blob_type:
+            types.append(blob_type)
+        if bad or rc:
+            return 2, types
+        return 0, types
+
+    def latest_chunk(self, recovery, dir_location, stream_type, key):
+        try:
+            with self.lock:
+                conn = self.connect(dir_location)
+                row = conn.execute("SELECT c.file, c.key, c.record, c.digest, s.id, s.description, "
+                                   "s.codec FROM chunks c JOIN streams s "
+                                   "ON s.file = c.file AND s.type = c.type "
+                                   "WHERE c.type = ? AND c.key = ? ORDER BY c.updated DESC LIMIT 1",
+                                   (stream_type, key)).fetchone()
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, recovery.msg['db_err']
+        if row is None:
+            return 1, key + recovery.msg['Chunk_err']
+        file_name, key, record, digest, id, desc, codec = row
+        if stream_type not in recovery.stream:
+            recovery.create_stream(id=id, type=stream_type, desc=desc,
+                                   filename=os.path.join(dir_location, file_name))
+        if self.load_chunks(recovery, stream_type, [(key, record, digest)], codec):
+            return 1, key + recovery.msg['Chunk_err']
+        rc, msg = self.load_blobs(recovery, stream_type)
+        if rc == 1:
+            return 1, msg
+        return recovery.read_chunk(stream_type, key)
+
+    def load_chunks(self, recovery, stream_type, rows, codec=None):
+        """Decodes chunk rows into the stream, the records of rows written
+        without a codec are not compressed
+        Returns:
+        list of the keys of corrupted chunks
+        """
+        decompress = STREAM_CODECS.get(codec or 'none', (None, None))[1]
+        bad = []
+        for key, record, digest in rows:
+            if decompress is None or not isinstance(record, bytes) or \
+                    recovery.chunk_digest(record) != digest:
+                bad.append(key)
+                continue
+            recovery.stream[stream_type]['data'][key] = recovery.chunk_value(record, decompress)
+        if bad:
+            debug("Corrupted chunks: {}".format({stream_type: bad}))
+            recovery.corrupt_chunks.setdefault(stream_type, []).extend(bad)
+        return bad
+
+    def read_all(self, recovery, dir_location, keys=None, parallel=False, num_workers=1):
+        """Loads the latest stream of every type, what read_streams does
+        with the stream files of the file backend. The queries are cheap,
+        parallel is ignored
+        Returns:
+        A tuple: success count, error count, names of the streams with
+        errors, stream types
+        """
+        db_name = os.path.join(dir_location, config.get('stream_db', 'streams.db'))
+        try:
+            with self.lock:
+                conn = self.connect(dir_location)
+                rows = conn.execute("SELECT type, file FROM streams "
+                                    "ORDER BY updated DESC").fetchall()
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 0, 1, [db_name], []
+        latest = {}
+        for stream_type, file_name in rows:
+            latest.setdefault(stream_type, file_name)
+        suc_count = 0
+        err_count = 0
+        err_files = []
+        types = []
+        for stream_type, file_name in latest.items():
+            rc, msg = self.read_type(recovery, dir_location, stream_type, keys)
+            if rc:
+                err_files.append(os.path.join(dir_location, file_name))
+                err_count += 1
+                if rc == 2:
+                    # intact chunks of a damaged stream are still usable
+                    types.append(stream_type)
+            else:
+                suc_count += 1
+                types.append(stream_type)
+        return suc_count, err_count, err_files, types
+
+    def load_blobs(self, recovery, stream_type):
+        """Loads the blobs the chunks of stream_type refer to
+        Returns:
+        A tuple: return code, blob stream type or None, or error message
+        return code 2 means some blobs were corrupted
+        """
+        digests = list(set(value['blob'] for value in recovery.stream[stream_type]['data'].values()
+                           if isinstance(value, dict) and 'blob' in value))
+        if not digests:
+            return 0, None
+        try:
+            with self.lock:
+                conn = self.connect(os.path.dirname(recovery.stream[stream_type]['filename']))
+                rows = conn.execute("SELECT digest, data FROM blobs WHERE digest IN (" +
+                                    ",".join("?" * len(digests)) + ")", digests).fetchall()
+        except sqlite3.Error as err:
+            debug("Stream database error: " + str(err))
+            return 1, recovery.msg['db_err']
+        blob_type = recovery.blob_stream(stream_type)
+        bad = set(digests)
+        for digest, data in rows:
+            if isinstance(data, bytes) and recovery.chunk_digest(data).hex() == digest:
+                recovery.stream[blob_type]['data'][digest] = bytes(data)
+                bad.discard(digest)
+        if bad:
+            debug("Corrupted blobs: {}".format(sorted(bad)))
+            recovery.corrupt_chunks.setdefault(blob_type, []).extend(sorted(bad))
+            return 2, blob_type
+        return 0, blob_type
+
+
+# Storage backends by config stream_backend name
+STREAM_BACKENDS = {
+    'file': FileBackend,
+    'sqlite': SqliteBackend,
+}
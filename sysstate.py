@@ -0,0 +1,148 @@
+# !/usr/bin/env python
+from logging import debug
+import os
+
+# Device paths callers pass in, the snapshot reads below root
+DEV_DIR = "/dev/"
+MAPPER_DIR = "/dev/mapper/"
+MD_DIR = "/dev/md/"
+
+# Snapshot shared by all the modules, dropped by every operation that
+# changes the block devices or the mounts
+SNAPSHOT = None
+
+
+def get_snapshot():
+    """Returns the current SystemSnapshot, taken on the first call after
+    an invalidate_snapshot"""
+    global SNAPSHOT
+    snapshot = SNAPSHOT
+    if snapshot is None:
+        snapshot = SNAPSHOT = SystemSnapshot()
+    return snapshot
+
+
+def invalidate_snapshot():
+    """Called after mdadm, cryptsetup, dmsetup, partprobe, mount and
+    umount, the next query takes a new snapshot"""
+    global SNAPSHOT
+    SNAPSHOT = None
+
+
+def read_lines(file_name):
+    try:
+        with open(file_name) as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+def list_dir(directory):
+    try:
+        return os.listdir(directory)
+    except OSError:
+        return []
+
+
+class SystemSnapshot:
+    """Block devices, raids, device mapper names, holders and mounts of
+    the host, read from procfs, sysfs and /dev in one pass without a
+    command. Devices are keyed by their kernel names, md127 or dm-3, so
+    /dev/md/<name>, /dev/mapper/<name> and /dev/<kernel name> paths of a
+    device give the same answers.
+    """
+    def __init__(self, root="/"):
+        """
+        Args:
+        root: directory holding proc, sys and dev, / but for tests
+        """
+        proc = os.path.join(root, "proc")
+        block = os.path.join(root, "sys", "block")
+        # /proc/partitions lists disks, partitions, md and dm devices
+        self.blocks = set(line.split()[3] for line in read_lines(os.path.join(proc, "partitions"))
+                          if len(line.split()) == 4 and line.split()[0].isdigit())
+        self.md_links = {}
+        md_dir = os.path.join(root, "dev", "md")
+        for name in list_dir(md_dir):
+            try:
+                self.md_links[name] = os.path.basename(os.readlink(os.path.join(md_dir, name)))
+            except OSError:
+                continue
+        self.arrays = self.read_mdstat(os.path.join(proc, "mdstat"))
+        self.dm_names = {}
+        self.holders = {}
+        for kname in list_dir(block):
+            if kname.startswith("dm-"):
+                lines = read_lines(os.path.join(block, kname, "dm", "name"))
+                if lines:
+                    self.dm_names[lines[0]] = kname
+            holders = list_dir(os.path.join(block, kname, "holders"))
+            if holders:
+                self.holders[kname] = holders
+        self.dm_knames = {kname: name for name, kname in self.dm_names.items()}
+        self.mounts = {}
+        for line in read_lines(os.path.join(proc, "mounts")):
+            fields = line.split()
+            kname = self.kname(fields[0]) if len(fields) > 1 else None
+            if kname and kname not in self.mounts:
+                # spaces in the mount point are escaped as \040
+                self.mounts[kname] = fields[1].replace("\\040", " ")
+        debug("System snapshot: {} block devices, {} raids, {} mounts".format(
+            len(self.blocks), len(self.arrays), len(self.mounts)))
+
+    def read_mdstat(self, file_name):
+        """Raids the kernel knows, running or not
+        Returns:
+        md kernel name mapped to a dict of state and member kernel names
+        """
+        arrays = {}
+        for line in read_lines(file_name):
+            # md127 : active raid1 dm-3[1] dm-1[0]
+            fields = line.split()
+            if len(fields) < 3 or not fields[0].startswith("md") or fields[1] != ":":
+                continue
+            arrays[fields[0]] = {'state': fields[2],
+                                 'members': [field.split("[")[0] for field in fields[3:]
+                                             if "[" in field]}
+        return arrays
+
+    def kname(self, path):
+        """Kernel name of a device path, None when it is not a device"""
+        if path.startswith(MAPPER_DIR):
+            return self.dm_names.get(path[len(MAPPER_DIR):])
+        if path.startswith(MD_DIR):
+            return self.md_links.get(path[len(MD_DIR):])
+        if path.startswith(DEV_DIR) and "/" not in path[len(DEV_DIR):]:
+            return path[len(DEV_DIR):]
+        return None
+
+    def device_path(self, kname):
+        if kname in self.dm_knames:
+            return MAPPER_DIR + self.dm_knames[kname]
+        return DEV_DIR + kname
+
+    def exists(self, path):
+        """True when the device of path exists"""
+        return self.kname(path) in self.blocks
+
+    def md_device(self, raid_name):
+        """/dev/mdN of a raid the kernel knows, "" when there is none"""
+        kname = self.kname(raid_name)
+        if kname not in self.arrays:
+            return ""
+        return DEV_DIR + kname
+
+    def mount_point(self, path):
+        """Mount point of a device, None when it is not mounted"""
+        return self.mounts.get(self.kname(path))
+
+    def is_mounted(self, path):
+        return self.mount_point(path) is not None
+
+    def device_holders(self, path):
+        """Devices built on top of a device, the partition maps of a
+        device mapper drive or the raid of a partition
+        Returns:
+        list of device paths, /dev/mapper/<name> for device mapper ones
+        """
+        return sorted(self.device_path(kname) for kname in self.holders.get(self.kname(path), []))
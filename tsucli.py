@@ -10,7 +10,8 @@
 #
 
 import click
-from tsulib import Bryck, get_version, get_tsutil_name, set_log_level
+# tsulib loads the drive subsystems, only the command that runs imports it
+from libutils import get_version, get_tsutil_name
 import sys
 
 
@@ -22,6 +23,13 @@ class Options(object):
         self.json = json
 
 
+def load_bryck(obj):
+    """ Imports tsulib for the command that runs and returns its Bryck"""
+    from tsulib import Bryck, set_log_level
+    set_log_level(obj.verbose)
+    return Bryck(obj.verbose)
+
+
 # Command group for bryck management
 @click.group()
 def bryck():
@@ -62,12 +70,11 @@ def cli(ctx, verbose,json):
                                   'permanently**\n**Do you want to continue?')
 def format(obj, no_enc, no_erase, raid_chunk, raid_level, key_file):
     """ Format the Bryck """
-    set_log_level(obj.verbose)
-    rc, msg = Bryck(obj.verbose).format(no_auth=False, no_enc=no_enc,
-                                        no_erase=no_erase,
-                                        raid_chunk=raid_chunk,
-                                        raid_level=int(raid_level),
-                                        key_file=key_file)
+    rc, msg = load_bryck(obj).format(no_auth=False, no_enc=no_enc,
+                                     no_erase=no_erase,
+                                     raid_chunk=raid_chunk,
+                                     raid_level=int(raid_level),
+                                     key_file=key_file)
     if not rc:
         msg = "Bryck formatted"
     click.echo(msg)
@@ -81,8 +88,7 @@ def format(obj, no_enc, no_erase, raid_chunk, raid_level, key_file):
 @click.argument("mount_dir", type=click.Path(exists=True))
 def mount(obj, key_file, mount_dir):
     """ Mount the Bryck """
-    set_log_level(obj.verbose)
-    rc, msg = Bryck(obj.verbose).mount(key_file=key_file, mount_dir=mount_dir)
+    rc, msg = load_bryck(obj).mount(key_file=key_file, mount_dir=mount_dir)
     if not rc:
         msg = "Bryck mounted"
     click.echo(msg)
@@ -94,8 +100,7 @@ def mount(obj, key_file, mount_dir):
 @click.pass_obj
 def eject(obj):
     """ Eject the Bryck """
-    set_log_level(obj.verbose)
-    rc, msg = Bryck(obj.verbose).eject()
+    rc, msg = load_bryck(obj).eject()
     if not rc:
         msg = "Bryck ejected"
     click.echo(msg)
@@ -109,8 +114,7 @@ def eject(obj):
                                   'permanently**\n**Do you want to continue?')
 def erase(obj):
     """ Erase the Bryck data """
-    set_log_level(obj.verbose)
-    rc, msg = Bryck(obj.verbose).erase()
+    rc, msg = load_bryck(obj).erase()
     if not rc:
         msg = "Bryck erased"
     click.echo(msg)
@@ -124,8 +128,7 @@ def erase(obj):
 @click.argument("new_key", type=click.Path(exists=True))
 def setkey(obj, old_key, new_key):
     """ Change the encryption key """
-    set_log_level(obj.verbose)
-    rc, msg = Bryck(obj.verbose).setkey(old_key=old_key, new_key=new_key)
+    rc, msg = load_bryck(obj).setkey(old_key=old_key, new_key=new_key)
     if not rc:
         msg = "Secret key changed"
     click.echo(msg)
@@ -137,8 +140,7 @@ def setkey(obj, old_key, new_key):
 @click.pass_obj
 def info(obj):
     """ Display Bryck information"""
-    set_log_level(obj.verbose)
-    rc, binfo = Bryck(obj.verbose).info()
+    rc, binfo = load_bryck(obj).info()
     if rc:
         click.echo("Bryck not found")
     else:
@@ -154,8 +156,7 @@ def info(obj):
 @click.pass_obj
 def list(obj):
     """ Display Bryck information"""
-    set_log_level(obj.verbose)
-    rc, binfo = Bryck(obj.verbose).list()
+    rc, binfo = load_bryck(obj).list()
     if rc:
         click.echo("Bryck not found")
     else:
@@ -163,6 +164,18 @@ def list(obj):
     sys.exit(rc)
 
 
+# Bryck compact sub command definition
+@bryck.command()
+@click.pass_obj
+@click.option("--keep", type=click.IntRange(min=1),
+              help="Backup generations to keep per drive. Default from configuration")
+def compact(obj, keep):
+    """ Archive old metadata backups and report their space"""
+    rc, msg = load_bryck(obj).compact(keep)
+    click.echo(msg)
+    sys.exit(rc)
+
+
 def build_cli():
     """ Builds CLI sub commands"""
     cli.add_command(bryck)
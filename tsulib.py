@@ -10,31 +10,35 @@
 #
 from logging import debug, info, DEBUG, INFO, basicConfig
 from json import load, dumps, dump
-from os.path import dirname, exists
-from nvme import nvme_list_drives, nvme_erase_drives, sata_list_drives, sata_erase_drives
+from os.path import dirname
+from nvme import nvme_enumerate_drives, nvme_erase_drives, sata_enumerate_drives, sata_erase_drives, \
+    nvme_erase_drive, sata_erase_drive
 from data_protection import *
 from partition import *
 from encryption import *
 from filesystem import *
+from inventory import load_inventory, save_inventory, inventory_state
+from devwait import wait_for_devices
+from sysstate import get_snapshot
+from libutils import get_config
 from datetime import datetime
 from time import tzname
-import subprocess
 import json
 
-def get_config():
-    """ Get the Bryck static configuration parameters"""
-    config = dirname(__file__) + "/config.json"
-    with open(config) as cfg:
-        json_cfg = load(cfg)
-        return json_cfg
+# Message for a failed step of the per drive format chains
+FORMAT_STEP_ERRORS = {
+    'reset': 'bryck_format_err_reset',
+    'erase': 'bryck_format_err_erase',
+    'encrypt': 'bryck_format_err_encryption',
+    'unlock': 'bryck_format_err_unlock',
+    'partition': 'bryck_format_err_partition',
+    'wait': 'bryck_format_err_partition',
+    ('metadata', 'raid'): 'bryck_format_err_metaraid',
+    ('data', 'raid'): 'bryck_format_err_dataraid',
+    ('metadata', 'mkfs'): 'bryck_format_err_metadata_fs',
+    ('data', 'mkfs'): 'bryck_format_err_data_fs',
+}
 
-def get_version():
-    """ Reads the version from the config json and returns it"""
-    return get_config()['version']
-
-def get_tsutil_name():
-    """ Reads the version from the config json and returns it"""
-    return get_config()['tsutil_name']
 
 def set_log_level(verbose):
     log_level = INFO
@@ -48,28 +52,48 @@ class Bryck(object):
     def __init__(self, verbose=0):
         self.config = get_config()
         self.messages = self.load_messages()
-        self.drives = self.get_drives()
+        # drives are discovered on first access
+        self._drives = None
         self.verbose = verbose
         self.encryption = False
         self.data_protection = 'raid'
         self.data_raid_level = 5
         self.metadata_raid_level = 1
         self.format_time = None
-        self.serial_number = None
-        self.firmware_rev = 1.0
-        self.raw_capacity = 0
+        # uuids and members of the raids, recorded at format time
+        self.raid_identity = None
         self.product_name = self.messages['product_name']
-        if self.drives:
-            if self.config['drive_type'] == 'NVME':
-                self.firmware_rev = self.drives[0]['Firmware']
-            else:
-                self.firmware_rev = 'Firmware'
-            self.serial_number = self.drives[0]['SerialNumber']
-            capacity = 0
-            for drive in self.drives:
-                capacity += int(drive['PhysicalSize'])
-            self.raw_capacity = capacity/(1024 * 1024 * 1024)
 
+    @property
+    def drives(self):
+        """ Bryck drives, enumerated or loaded from the inventory cache
+        the first time they are needed"""
+        if self._drives is None:
+            self._drives = self.load_drives()
+        return self._drives
+
+    @property
+    def serial_number(self):
+        if not self.drives:
+            return None
+        return self.drives[0]['SerialNumber']
+
+    @property
+    def firmware_rev(self):
+        if not self.drives:
+            return 1.0
+        if self.config['drive_type'] == 'NVME':
+            return self.drives[0]['Firmware']
+        return 'Firmware'
+
+    @property
+    def raw_capacity(self):
+        if not self.drives:
+            return 0
+        capacity = 0
+        for drive in self.drives:
+            capacity += int(drive['PhysicalSize'])
+        return capacity/(1024 * 1024 * 1024)
 
     def load_messages(self):
         """ Load the error and information messages"""
@@ -117,18 +141,60 @@ class Bryck(object):
             message: Description for the error code
         """
 
-        # Create metadata partition
-        rc, out, err = partition_create_drives(drives,
-                                            self.config['metadata_part_size'],
-                                            mklabel=True)
-        if rc:
-            return rc, err
-        # Create data partition on the remaining space
-        rc, out, err = partition_create_drives(drives, -1)
+        # metadata partition, then the data partition on the remaining space
+        rc, out, err = partition_write_drives(drives, self.config['metadata_part_size'])
         if rc:
             out = err
         return rc, out
 
+    def reset_drive(self, drive):
+        """ Clears the raid superblocks, partitions and encryption of a
+        drive. Nothing of it may be set up, so failures are ignored
+        Args:
+            drive: drive name
+        Returns:
+            return code, stdout and stderr tuple
+        """
+        data_protection_zero(self.get_partition_names("data", [drive]) +
+                             self.get_partition_names("meta", [drive]))
+        partition_reset_drives(self.get_encrypt_drive_names([drive]))
+        encrypt_reset_drive(drive)
+        return 0, "", ""
+
+    def format_drive_chain(self, drive, no_enc, no_erase, key_file):
+        """ Steps that take one drive from reset to its partitions
+        Args:
+            drive: drive name
+            no_enc, no_erase, key_file: as for format
+        Returns:
+            list of (step type, function, arguments) for StepPipeline
+        """
+        chain = [("reset", self.reset_drive, (drive,))]
+        if not no_erase:
+            if self.config['drive_type'] == 'NVME':
+                chain.append(("erase", nvme_erase_drive, (drive,)))
+            else:
+                chain.append(("erase", sata_erase_drive, (drive,)))
+        if not no_enc:
+            chain.append(("encrypt", encrypt_setup_drive, (drive, key_file)))
+            chain.append(("unlock", encrypt_unlock_drive, (drive, key_file)))
+            drive = self.get_encrypt_drive_names([drive])[0]
+        chain.append(("partition", partition_write_drive,
+                      (drive, self.config['metadata_part_size'])))
+        # the raids need the partition nodes udev creates
+        chain.append(("wait", wait_for_devices, (self.get_partition_names("meta", [drive]) +
+                                                 self.get_partition_names("data", [drive]),)))
+        return chain
+
+    def format_error(self, results, chain=None):
+        """ Message of the first failed chain of a StepPipeline run or
+        None when all the chains succeeded"""
+        for name, (rc, step, result) in results.items():
+            if rc:
+                key = (name, step) if chain else step
+                return self.messages[FORMAT_STEP_ERRORS[key]] + result[2]
+        return None
+
     def get_partition_names(self, ptype, drive_names):
         """ Returns the partition names for a given drive name
         Args:
@@ -171,6 +237,8 @@ class Bryck(object):
         meta["format_time"] = self.format_time
         meta["serial_number"] = self.serial_number
         meta["drives"] = self.drives
+        if self.raid_identity:
+            meta["raid_identity"] = self.raid_identity
         #json_meta = dumps(meta)
 
         #logical card store.json
@@ -225,6 +293,15 @@ class Bryck(object):
         if rc:
             debug(msg)
 
+        # every backup adds a generation, the old ones are only merged
+        # into the archive once enough of them piled up
+        from retention import compact_backups, compaction_due
+        backup_dir = self.config['metadata_mount'] + self.config['backup_dir']
+        if compaction_due(backup_dir):
+            rc, msg = compact_backups(backup_dir)
+            if rc:
+                debug(msg)
+
         if mount_meta:
             filesystem_unmount(self.config['metadata_mount'])
         return 0, ""
@@ -256,74 +333,50 @@ class Bryck(object):
         if self.is_mounted():
             return 1, self.messages['bryck_format_err_mounted']
 
-        self.serial_number = self.drives[0]['SerialNumber']
         self.format_time = str(datetime.now()) + " " + tzname[1]
 
         drive_names = self.get_drive_names()
-        # skip erasing if specified
-        info("Resetting the Bryck")
-        debug("Resetting raid and encryption on Bryck drives")
-        data_protection_reset(self.config['data_drive_name'], self.get_partition_names("data", drive_names))
-        data_protection_reset(self.config['metadata_drive_name'], self.get_partition_names("meta", drive_names))
-        partition_reset_drives(self.get_encrypt_drive_names(drive_names))
-        encrypt_reset_drives(drive_names)
+        if not no_enc and not key_file:
+            return 1, self.messages['bryck_format_err_nokeyfile']
 
-        if not no_erase:
-            debug("Secure erasing Bryck drives")
-            if self.config['drive_type'] == 'NVME':
-                rc, out, err = nvme_erase_drives(self.drives)
-            else:
-                rc, out, err = sata_erase_drives(self.drives)
-            if rc:
-                return 1, self.messages['bryck_format_err_erase'] + err
-
-        # setup encryption on Bryck drives
+        info("Resetting the Bryck")
+        debug("Stopping the Bryck raids")
+        data_protection_stop(self.config['data_drive_name'])
+        data_protection_stop(self.config['metadata_drive_name'])
+
+        # every drive goes through reset, erase, encryption and
+        # partitioning on its own, mdadm then needs all of them
+        info("Setting up the drives")
+        limits = dict(self.config.get('format_step_limits', {}),
+                      erase=self.config.get('erase_parallel_limit', 0))
+        # asyncio is only loaded by format
+        from pipeline import StepPipeline
+        pipeline = StepPipeline(limits)
+        results = pipeline.run({drive: self.format_drive_chain(drive, no_enc, no_erase, key_file)
+                                for drive in drive_names})
+        msg = self.format_error(results)
+        if msg:
+            return 1, msg
         if not no_enc:
-            info("Setting up the encryption")
-            if not key_file:
-                return 1, self.messages['bryck_format_err_nokeyfile']
-            rc, out, msg = encrypt_setup_drives(drive_names, key_file)
-            if rc:
-                return 1, self.messages['bryck_format_err_encryption'] + msg
-            rc, out, msg,err_dives = encrypt_unlock_drives(drive_names, key_file)
-            if rc:
-                return 1, self.messages['bryck_format_err_unlock'] + msg
             drive_names = self.get_encrypt_drive_names(drive_names)
 
-        info("Setting up the partitions")
-        rc, msg = self.create_partitions(drive_names)
-        if rc:
-            return 1, self.messages['bryck_format_err_partition'] + msg
-
         data_partitions = self.get_partition_names("data", drive_names)
         metadata_partitions = self.get_partition_names("meta", drive_names)
 
-        # Setup data protection on Bryck partitions
-        info("Setting up the data protection")
-        debug("Setting up the data protection for metadata")
-        rc, out, err = data_protection_setup(
-            metadata_partitions, self.config['metadata_drive_name'], 1)
-        if rc:
-            return 1, self.messages['bryck_format_err_metaraid'] + err
-
-        debug("Setting up the data protection for data")
-        rc, out, err = data_protection_setup(
-            data_partitions, self.config['data_drive_name'], raid_level)
-        if rc:
-            return 1, self.messages['bryck_format_err_dataraid'] + err
-
-        debug("Setting up the data file system")
-        info("Setting up the file systems")
-        # setup file systems on the data partition
-        rc, out, err = filesystem_create(self.config['data_drive_name'])
-        if rc:
-            return 1, self.messages['bryck_format_err_data_fs'] + err
-
-        # setup file systems on the metadata partitions
-        debug("Setting up the meta data file system")
-        rc, out, err = filesystem_create(self.config['metadata_drive_name'])
-        if rc:
-            return 1, self.messages['bryck_format_err_metadata_fs'] + err
+        # Setup data protection and file systems, the metadata and the
+        # data raid are independent
+        info("Setting up the data protection and the file systems")
+        results = pipeline.run({
+            'metadata': [("raid", data_protection_setup,
+                          (metadata_partitions, self.config['metadata_drive_name'], 1)),
+                         ("mkfs", filesystem_create, (self.config['metadata_drive_name'],))],
+            'data': [("raid", data_protection_setup,
+                      (data_partitions, self.config['data_drive_name'], raid_level)),
+                     ("mkfs", filesystem_create, (self.config['data_drive_name'],))]})
+        msg = self.format_error(results, chain=True)
+        if msg:
+            return 1, msg
+        self.record_raid_identity(metadata_partitions, data_partitions)
 
         # Write metadata to the metadata file system
         info("Writing meta data")
@@ -393,10 +446,11 @@ class Bryck(object):
 
         #Reconstruct of metadata
         debug("Reconstruction of metadata")
-        rc, err,out = data_protection_start()
+        rc, err, out, stored = self.start_raids()
 
         if rc:
             return 1, self.messages['bryck_mount_err_metadata']
+        wait_for_devices([self.config['metadata_drive_name'], self.config['data_drive_name']])
         info("Metadata reconstructed succesfully")
 
         #Metadata path exists
@@ -412,6 +466,8 @@ class Bryck(object):
         if rc:
             return 1,self.messages['bryck_mount_err_metadata']
         info("Mounted Meta data successfully")
+        if not stored:
+            self.cache_raid_identity()
 
         if lock:
             rc,msg = encrypt_recovery(self.config['metadata_mount'] +
@@ -422,11 +478,13 @@ class Bryck(object):
             self.redo_mount()
 
         encrypt_drives = self.get_encrypt_drive_names(drives)
+        # partitions of intact drives show up shortly after the unlock
+        wait_for_devices(self.get_partition_names("meta", encrypt_drives),
+                         timeout=self.config.get('partition_wait_timeout', 2))
+        snapshot = get_snapshot()
         errdrives = []
         for drive in encrypt_drives:
-            cmd = "ls " + drive + "p*"
-            rc,msg,err = run_cmd(cmd)
-            if rc:
+            if not snapshot.exists(self.get_partition_names("meta", [drive])[0]):
                 errdrives.append(drive)
 
         if len(errdrives)>0:
@@ -483,8 +541,9 @@ class Bryck(object):
             return False
 
         #Check if the encrypt device exists
+        snapshot = get_snapshot()
         for enc_drive in self.get_encrypt_drive_names(self.get_drive_names()):
-            if exists(enc_drive):
+            if snapshot.exists(enc_drive):
                 return False
 
         return True
@@ -560,9 +619,11 @@ class Bryck(object):
         #ejecting the Bryck
         self.eject()
         if self.config['drive_type'] == 'NVME':
-            rc, out, err = nvme_erase_drives(self.get_drive_names())
+            rc, out, err = nvme_erase_drives(self.get_drive_names(),
+                                             limit=self.config.get('erase_parallel_limit', 0))
         else:
-            rc, out, err = sata_erase_drives(self.get_drive_names())
+            rc, out, err = sata_erase_drives(self.get_drive_names(),
+                                             limit=self.config.get('erase_parallel_limit', 0))
         if rc:
             return 1, self.messages['bryck_erase_failed'] + "\n"+err
 
@@ -656,6 +717,37 @@ class Bryck(object):
             out += self.messages['bryck_info_unable_df']
         return 0, out
 
+    def compact(self, keep=None):
+        """ Merges the old metadata backup generations into the archive
+        Args:
+            keep: backup generations to keep per drive and stream type,
+            defaults to backup_generations of the configuration
+        Returns:
+             return code and message as tuple
+             return code: 0 for success and non-zero for failure
+             message: space used by the metadata backups
+        """
+        debug("Compacting the metadata backups")
+        if not self.drives:
+            return 1, self.messages['bryck_not_found']
+
+        rc, out, err = filesystem_mount(self.config['metadata_drive_name'],
+                                        self.config['metadata_mount'],
+                                        create=True)
+        if rc:
+            return 1, self.messages['bryck_compact_err_mount'] + err
+        backup_dir = self.config['metadata_mount'] + self.config['backup_dir']
+        if not os.path.exists(backup_dir):
+            filesystem_unmount(self.config['metadata_mount'])
+            return 1, self.messages['bryck_compact_err_no_backup']
+        from retention import compact_backups, backup_usage, format_usage
+        rc, msg = compact_backups(backup_dir, keep)
+        out = format_usage(backup_usage(backup_dir))
+        filesystem_unmount(self.config['metadata_mount'])
+        if rc:
+            return 1, self.messages['bryck_compact_err'] + msg
+        return 0, msg + "\n" + out
+
     def get_drives(self):
         """ Returns all drive paths for all Bryck drives in a list
         Returns:
@@ -665,9 +757,9 @@ class Bryck(object):
         debug("Enumerate all Bryck drives")
         bryck_drives = []
         if self.config['drive_type'] == 'NVME':
-            rc, drives = nvme_list_drives()
+            rc, drives = nvme_enumerate_drives()
         else:
-            rc, drives = sata_list_drives()
+            rc, drives = sata_enumerate_drives()
 
         if rc:
             debug("No Bryck drives found")
@@ -687,6 +779,25 @@ class Bryck(object):
                     bryck_drives.append(sata_drives)
         return bryck_drives
 
+    def load_drives(self):
+        """ Returns the Bryck drives from the inventory cache, enumerates
+        them when the cache is missing or stale
+        Returns:
+            list of drives as get_drives
+        """
+        cache_file = self.config.get('inventory_cache')
+        if not cache_file:
+            return self.get_drives()
+        config_key = [self.config['drive_type'], self.config['bryck_drive_model']]
+        drives = load_inventory(cache_file, config_key)
+        if drives is not None:
+            debug("Using the cached Bryck drives")
+            return drives
+        state = inventory_state()
+        drives = self.get_drives()
+        save_inventory(cache_file, config_key, state, drives)
+        return drives
+
     def get_drive_info(self, drive):
         """ Return the information about a Bryck drive
         Args:
@@ -696,11 +807,62 @@ class Bryck(object):
         """
         return 0, {}
 
+    def record_raid_identity(self, metadata_partitions, data_partitions):
+        """ Reads the uuids of the new raids and stores them with their
+        members on this host, write_metadata stores them on the Bryck
+        Args:
+            metadata_partitions, data_partitions: members of the raids
+        """
+        arrays = {}
+        for raid_name, devices in ((self.config['metadata_drive_name'], metadata_partitions),
+                                   (self.config['data_drive_name'], data_partitions)):
+            rc, identity = data_protection_identity(raid_name, devices)
+            if rc:
+                debug("Not recording the raid identity: " + identity)
+                return
+            arrays[raid_name] = identity
+        self.raid_identity = arrays
+        save_raid_identity(self.config['raid_identity_cache'], self.serial_number, arrays)
+
+    def cache_raid_identity(self):
+        """ Copies the raid identity from the mounted metadata to this
+        host, so the next mount of the Bryck needs no scan"""
+        metafile = self.config['metadata_mount'] + "/" + self.config['metadata_file_name']
+        try:
+            with open(metafile) as f:
+                meta = load(f)
+            if isinstance(meta, str):
+                # the metadata is a json string without the agylagent store
+                meta = json.loads(meta)
+        except (OSError, ValueError):
+            return
+        if meta.get("raid_identity"):
+            save_raid_identity(self.config['raid_identity_cache'], self.serial_number,
+                               meta["raid_identity"])
+
+    def start_raids(self):
+        """ Assembles the raids by the identity stored on this host, both
+        at once. Without a stored identity or when it does not match the
+        drives any more all the devices are scanned
+        Returns:
+            return code, stdout, stderr and whether the stored identity
+            was used
+        """
+        arrays = load_raid_identity(self.config['raid_identity_cache'], self.serial_number)
+        if arrays:
+            rc, out, err = data_protection_start_arrays(arrays)
+            if not rc:
+                return rc, out, err, True
+            debug("Assembling by the stored raid identity failed: " + err)
+        rc, out, err = data_protection_start()
+        return rc, out, err, False
+
     def redo_mount(self):
         filesystem_unmount(self.config['metadata_mount'])
         data_protection_stop(self.config['metadata_mount'])
         data_protection_stop(self.config['data_drive_name'])
-        data_protection_start()
+        self.start_raids()
+        wait_for_devices([self.config['metadata_drive_name'], self.config['data_drive_name']])
         filesystem_mount(self.config['metadata_drive_name'],
                          self.config['metadata_mount'],
                          create=True)
\ No newline at end of file